@@ -10,4 +10,14 @@ const COLORS = {
     default: '#f6f6f7',
 }
 
-export { DEFAULT_SERVER_URL, WS_SERVER_URL, TRANSMISSION_RETRY_TIME, BUFFER_SENTENCES, COLORS };
\ No newline at end of file
+// binary audio frames on the socket, see server/audio_frames.py
+const AUDIO_CODECS = {
+    1: 'audio/mpeg',
+}
+
+const FRAME_FLAGS = {
+    end: 0x01,
+    complete: 0x02,
+}
+
+export { DEFAULT_SERVER_URL, WS_SERVER_URL, TRANSMISSION_RETRY_TIME, BUFFER_SENTENCES, COLORS, AUDIO_CODECS, FRAME_FLAGS };
\ No newline at end of file
@@ -1,11 +1,19 @@
 import { get_server_url, get_user_profile } from './user.js';
 
-async function loadTextEntries() {
+async function loadTextEntries(cursor = null) {
+    /*
+    One page of the text entries, newest first,
+    with a "more" link for the next page while there is one
+    */
     try {
         const serverUrl = await get_server_url();
         const userProfile = await get_user_profile();
 
-        const response = await fetch(`${serverUrl}/text_entries/`, {
+        let url = `${serverUrl}/text_entries/?limit=50`;
+        if (cursor) {
+            url += `&cursor=${encodeURIComponent(cursor)}`;
+        }
+        const response = await fetch(url, {
             credentials: 'include'
         });
 
@@ -13,8 +21,9 @@ async function loadTextEntries() {
             throw new Error('Failed to load text entries');
         }
 
-        const entries = await response.json();
+        const { entries, next_cursor } = await response.json();
         const listContainer = document.getElementById('list-of-links');
+        document.getElementById('more-text-entries')?.remove();
 
         entries.forEach(entry => {
             const li = document.createElement('li');
@@ -29,8 +38,8 @@ async function loadTextEntries() {
             icon.className = 'fas fa-book me-2';
 
             let displayText = entry.url ? new URL(entry.url).hostname : 'Text Entry';
-            if (entry.full_text) {
-                displayText = entry.full_text.substring(0, 20).trim() + '...';
+            if (entry.preview) {
+                displayText = entry.preview.substring(0, 20).trim() + '...';
             }
             const text = document.createTextNode(displayText);
 
@@ -39,45 +48,120 @@ async function loadTextEntries() {
             li.appendChild(link);
             listContainer.appendChild(li);
         });
+
+        if (next_cursor) {
+            const li = document.createElement('li');
+            li.className = 'nav-item';
+            li.id = 'more-text-entries';
+
+            const link = document.createElement('a');
+            link.className = 'nav-link';
+            link.href = '#';
+            link.textContent = 'More...';
+            link.addEventListener('click', (event) => {
+                event.preventDefault();
+                loadTextEntries(next_cursor);
+            });
+
+            li.appendChild(link);
+            listContainer.appendChild(li);
+        }
     } catch (error) {
         console.error('Error loading text entries:', error);
     }
 }
 
-async function loadTTSRequests() {
+async function loadStats() {
+    /*
+    Latency, cache hits and the daily series of the last 30 days,
+    aggregated on the server over the whole history, not just the latest requests
+    */
     try {
         const serverUrl = await get_server_url();
-        const response = await fetch(`${serverUrl}/tts_requests/`, {
+        const response = await fetch(`${serverUrl}/stats/?days=30`, {
             credentials: 'include'
         });
 
         if (!response.ok) {
-            throw new Error('Failed to load TTS requests');
+            throw new Error('Failed to load stats');
         }
 
-        const requests = await response.json();
+        const stats = await response.json();
 
-        console.log({ log: 'TTS Requests Tracking', requests });
+        console.log({ log: 'TTS Request Stats', stats });
 
-        // Update the dashboard statistics
-        document.getElementById('total-requests').textContent = requests.length;
+        const avg = Math.round(stats.avg_processing_time_ms || 0);
+        const p95 = Math.round(stats.p95_processing_time_ms || 0);
+        document.getElementById('processing-time').textContent = `${avg}ms (p95 ${p95}ms)`;
 
-        let totalChars = 0;
-        requests.forEach(req => {
-            totalChars += req.sentence_text.length;
+        // Requests served from the audio cache, without a new synthesis
+        // coalesced requests shared a synthesis, no deepgram call either
+        document.getElementById('cache-hits').textContent =
+            `${stats.cache_hits} / ${stats.total_requests}`;
+
+        drawDailyChart(stats.days);
+    } catch (error) {
+        console.error('Error loading stats:', error);
+    }
+}
+
+function drawDailyChart(days) {
+    const canvas = document.getElementById('daily-chart');
+    if (!canvas || typeof Chart === 'undefined') {
+        return;
+    }
+    new Chart(canvas, {
+        type: 'bar',
+        data: {
+            labels: days.map(day => day.day),
+            datasets: [
+                {
+                    label: 'Requests',
+                    data: days.map(day => day.total_requests),
+                    yAxisID: 'requests',
+                },
+                {
+                    label: 'p95 latency (ms)',
+                    data: days.map(day => day.p95_processing_time_ms),
+                    type: 'line',
+                    yAxisID: 'latency',
+                },
+            ],
+        },
+        options: {
+            scales: {
+                requests: { position: 'left', beginAtZero: true },
+                latency: { position: 'right', beginAtZero: true, grid: { drawOnChartArea: false } },
+            },
+        },
+    });
+}
+
+async function loadUsage() {
+    /*
+    Totals of the current month, from the server side monthly rollups
+    */
+    try {
+        const serverUrl = await get_server_url();
+        const response = await fetch(`${serverUrl}/usage/?months=1`, {
+            credentials: 'include'
         });
-        document.getElementById('total-characters').textContent =
-            totalChars.toLocaleString();
 
-        // Calculate average processing time
-        const avgProcessingTime = requests.reduce((acc, req) =>
-            acc + (req.processing_time_ms || 0), 0) / requests.length;
-        document.getElementById('processing-time').textContent =
-            `${Math.round(avgProcessingTime)}ms`;
+        if (!response.ok) {
+            throw new Error('Failed to load usage');
+        }
 
+        const months = await response.json();
+        const now = new Date();
+        const current = months.find(usage =>
+            usage.year === now.getUTCFullYear() && usage.month === now.getUTCMonth() + 1);
 
+        document.getElementById('total-requests').textContent =
+            (current ? current.total_requests : 0).toLocaleString();
+        document.getElementById('total-characters').textContent =
+            (current ? current.total_characters : 0).toLocaleString();
     } catch (error) {
-        console.error('Error loading TTS requests:', error);
+        console.error('Error loading usage:', error);
     }
 }
 
@@ -85,5 +169,6 @@ async function loadTTSRequests() {
 // Initialize the dashboard
 document.addEventListener('DOMContentLoaded', () => {
     loadTextEntries();
-    loadTTSRequests();
+    loadStats();
+    loadUsage();
 });
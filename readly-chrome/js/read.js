@@ -1,6 +1,6 @@
 import { get_user_profile, get_server_url, login_redirect } from './user.js';
 import { updateSentenceVisibility, generateProgressSegments } from './visual_effects.js';
-import { COLORS, WS_SERVER_URL, TRANSMISSION_RETRY_TIME, BUFFER_SENTENCES } from './constants.js';
+import { COLORS, WS_SERVER_URL, TRANSMISSION_RETRY_TIME, BUFFER_SENTENCES, AUDIO_CODECS, FRAME_FLAGS } from './constants.js';
 // Get the key from URL parameters
 const urlParams = new URLSearchParams(window.location.search);
 const storageKey = urlParams.get('key');
@@ -12,6 +12,12 @@ let player_state = {
     speed: 1.0,
     metadata: null,
     on_transmission: {},
+    // audio_id => received binary frames of the clip, until its end frame
+    streaming_clips: {},
+    // audio_id => Blob, clips received as binary frames
+    audio_clips: {},
+    // the server throttled us, no speak events before this time (ms)
+    throttled_until: 0,
 };
 
 const fetch_text_metadata = async (text) => {
@@ -22,10 +28,20 @@ const fetch_text_metadata = async (text) => {
     and then measure the length of each sentence
     */
     let server_url = await get_server_url();
-    const response = await fetch(server_url + `/sentence_measure/${storageKey}/`, {
-        method: 'POST',
-        body: JSON.stringify({ text, text_id: storageKey }),
-    });
+    let response;
+    while (true) {
+        response = await fetch(server_url + `/sentence_measure/${storageKey}/`, {
+            method: 'POST',
+            body: JSON.stringify({ text, text_id: storageKey }),
+        });
+        if (response.status !== 429) {
+            break;
+        }
+        // rate limited, wait as long as the server asks
+        let retry_after = Number(response.headers.get('Retry-After')) || 1;
+        console.warn(`[⏳ THROTTLED] sentence_measure, retry in ${retry_after}s`);
+        await new Promise(resolve => setTimeout(resolve, retry_after * 1000));
+    }
     let metadata = await response.json();
     build_progress_marks(metadata);
     console.info(player_state);
@@ -174,7 +190,11 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     const event_type_audio_chunk = async (message) => {
-        let { audio_id, play_idx, data } = message;
+        let { audio_id, play_idx, data, url } = message;
+        if (url !== undefined) {
+            await fetch_audio_clip(audio_id, play_idx, url);
+            return;
+        }
 
         /*
         🔈🔈🔈🔈🔈
@@ -188,10 +208,109 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    const save_audio_clip = (audio_id, play_idx, parts, codec) => {
+        /*
+        🔈🔈🔈🔈🔈
+        Binary clips are kept as Blob, no base64 round trip
+        */
+        player_state.audio_clips[audio_id] = new Blob(parts, { type: AUDIO_CODECS[codec] || 'audio/mpeg' });
+        if (play_idx !== player_state.play_idx) {
+            set_progress_segment_color(play_idx, COLORS.loaded);
+        }
+    }
+
+    const fetch_audio_clip = async (audio_id, play_idx, url) => {
+        /*
+        🔈🔈🔈🔈🔈
+        The clip over HTTP, from the browser cache when we have read it before
+        */
+        let server_url = await get_server_url();
+        let response = await fetch(server_url + url);
+        if (!response.ok) {
+            console.error(`[🚨 AUDIO] ${audio_id}: ${response.status}`);
+            // let the next buffer check ask again
+            delete player_state.on_transmission[play_idx];
+            return;
+        }
+        save_audio_clip(audio_id, play_idx, [await response.blob()]);
+    }
+
+    const get_audio_clip = async (audio_id) => {
+        /*
+        The clip as a Blob, from the binary frames
+        or from the base64 saved by the JSON protocol
+        */
+        let clip = player_state.audio_clips[audio_id];
+        if (clip !== undefined) {
+            return clip;
+        }
+        let stored = await chrome.storage.local.get(audio_id);
+        if (stored[audio_id] !== undefined) {
+            return base64ToBlob(stored[audio_id], 'audio/wav');
+        }
+        return undefined;
+    }
+
+    const parse_audio_frame = (buffer) => {
+        /*
+        Parse one binary audio frame, see server/audio_frames.py
+        version(u8) flags(u8) codec(u8) play_idx(u32) seq(u32) length(u32) id_len(u16) audio_id payload
+        */
+        const view = new DataView(buffer);
+        const flags = view.getUint8(1);
+        const codec = view.getUint8(2);
+        const play_idx = view.getUint32(3);
+        const seq = view.getUint32(7);
+        const length = view.getUint32(11);
+        const id_len = view.getUint16(15);
+        const header_size = 17;
+        const audio_id = new TextDecoder().decode(new Uint8Array(buffer, header_size, id_len));
+        const payload = new Uint8Array(buffer, header_size + id_len, length);
+        return {
+            audio_id, play_idx, seq, codec, payload,
+            is_end: (flags & FRAME_FLAGS.end) !== 0,
+            is_complete: (flags & FRAME_FLAGS.complete) !== 0,
+        };
+    }
+
+    const event_type_audio_frame = async (buffer) => {
+        /*
+        🔈🔈🔈
+        A whole clip in one frame,
+        or streamed audio, frames arrive while the server is still synthesizing
+        */
+        let { audio_id, play_idx, seq, codec, payload, is_end, is_complete } = parse_audio_frame(buffer);
+        if (is_complete) {
+            save_audio_clip(audio_id, play_idx, [payload], codec);
+            return;
+        }
+        let frames = player_state.streaming_clips[audio_id] || [];
+        player_state.streaming_clips[audio_id] = frames;
+        if (!is_end) {
+            frames[seq] = payload;
+            return;
+        }
+        delete player_state.streaming_clips[audio_id];
+        save_audio_clip(audio_id, play_idx, frames, codec);
+    }
+
     const message_event_handler = async (data) => {
         let { event_type } = data;
         if (event_type === 'audio_chunk') {
             await event_type_audio_chunk(data);
+        } else if (event_type === 'audio_error') {
+            console.error(`[🔌🚨 SOCKET: audio_error] ${data.play_idx}: ${data.error}`);
+            // drop the half streamed clip, and let the next buffer check ask again
+            delete player_state.streaming_clips[get_audio_id(data.text_id, data.play_idx)];
+            delete player_state.on_transmission[data.play_idx];
+        } else if (event_type === 'throttled') {
+            console.warn(`[🔌⏳ SOCKET: throttled] ${data.play_idx}: ${data.reason}, retry in ${data.retry_after_ms}ms`);
+            // back off, the next buffer check asks again once the wait is over
+            player_state.throttled_until = Math.max(
+                player_state.throttled_until, new Date().getTime() + data.retry_after_ms);
+            delete player_state.on_transmission[data.play_idx];
+        } else if (event_type === 'hello') {
+            console.info(`[🔌 SOCKET: protocol] ${data.protocol}`);
         } else if (event_type === 'authentication_error') {
             await login_redirect();
         } else {
@@ -201,6 +320,10 @@ document.addEventListener('DOMContentLoaded', () => {
 
     const set_up_socket_message = (socket) => {
         socket.onmessage = async (event) => {
+            if (event.data instanceof ArrayBuffer) {
+                await event_type_audio_frame(event.data);
+                return;
+            }
             const message = JSON.parse(event.data);
             console.info(`[🔌🎵 SOCKET: MESSAGE]`);
             console.log(message);
@@ -216,11 +339,14 @@ document.addEventListener('DOMContentLoaded', () => {
             WS_SERVER_URL + `/speak?token=${player_state.token}&sub=${player_state.sub}`
         );
 
+        socket.binaryType = 'arraybuffer';
         console.log('[🔌 SOCKET:CONNECTING]');
 
         set_up_socket_message(socket);
         socket.onopen = () => {
             console.log('[🔌✨ SOCKET:OPENED]');
+            // audio as raw binary frames, instead of base64 inside JSON
+            socket.send(JSON.stringify({ event_type: 'hello', protocol: 'binary' }));
             player_state.socket_ready = true;
         }
         socket.onerror = (error) => {
@@ -262,16 +388,44 @@ document.addEventListener('DOMContentLoaded', () => {
             console.debug("[🔌 SOCKET:WAITING] socket ready");
             await new Promise(resolve => setTimeout(resolve, 100));
         }
+        let throttled_for = player_state.throttled_until - new Date().getTime();
+        if (throttled_for > 0) {
+            await new Promise(resolve => setTimeout(resolve, throttled_for));
+        }
+        // the sentence being played streams, the prefetches come as /audio/ URLs the browser can cache
+        let prefetch = play_idx !== player_state.play_idx;
         console.info(`[🔌 SOCKET: speak]${play_idx} ${speed}x`);
         socket.send(JSON.stringify({
             event_type: 'speak',
-            text_data: player_state.metadata,
+            // the server keeps the sentences since /sentence_measure/
+            text_id: player_state.metadata.text_id,
             speed,
             play_idx,
+            // audio comes back as binary frames, while it is being synthesized
+            stream: !prefetch,
+            delivery: prefetch ? 'url' : 'clip',
+            // lets the server rank the sentence being played above the prefetches
+            current_idx: player_state.play_idx,
         }));
         player_state.on_transmission[play_idx] = new Date().getTime();
     }
 
+    const send_seek_event = (play_idx) => {
+        /*
+        Tell the server we jumped to play_idx,
+        so it can drop the prefetches for the old position
+        */
+        player_state.on_transmission = {};
+        if (!player_state.socket_ready) {
+            return;
+        }
+        console.info(`[🔌 SOCKET: seek]${play_idx}`);
+        player_state.socket.send(JSON.stringify({
+            event_type: 'seek',
+            play_idx,
+        }));
+    }
+
     const make_sure_chunk_buffer = async (play_idx) => {
         /*
         Check if the audio chunk buffer is built
@@ -280,9 +434,7 @@ document.addEventListener('DOMContentLoaded', () => {
         let { metadata, speed } = player_state;
         let { text_id } = metadata;
         let audio_id = get_audio_id(text_id, play_idx);
-        let audio_data_loaded = await chrome.storage.local.get(audio_id);
-        let audio_data = audio_data_loaded[audio_id];
-        let audio_data_ready = audio_data !== undefined;
+        let audio_data_ready = (await get_audio_clip(audio_id)) !== undefined;
 
         let last_transmission = player_state.on_transmission[play_idx];
         if (audio_data_ready) {
@@ -317,12 +469,11 @@ document.addEventListener('DOMContentLoaded', () => {
         let { metadata, play_idx, speed } = player_state;
         let { text_id } = metadata;
         let audio_id = get_audio_id(text_id, play_idx);
-        let audio_data = await chrome.storage.local.get(audio_id)[audio_id];
+        let audio_blob = await get_audio_clip(audio_id);
 
-        while (audio_data === undefined) {
+        while (audio_blob === undefined) {
             await new Promise(resolve => setTimeout(resolve, 100));
-            let audio_url_data = await chrome.storage.local.get(audio_id);
-            audio_data = audio_url_data[audio_id];
+            audio_blob = await get_audio_clip(audio_id);
             console.warn(`[⏰ WAITING]${audio_id}`);
         }
 
@@ -330,7 +481,6 @@ document.addEventListener('DOMContentLoaded', () => {
         updateSentenceVisibility(play_idx);
 
         console.info(`[🔊 PLAY] ${audio_id}`);
-        let audio_blob = base64ToBlob(audio_data, 'audio/wav');
         let audio_url = URL.createObjectURL(audio_blob);
 
         audioPlayer.querySelector('source').src = audio_url;
@@ -419,6 +569,7 @@ document.addEventListener('DOMContentLoaded', () => {
             // change the color of the current progress segment back to loaded
             set_progress_segment_color(player_state.play_idx, COLORS.loaded);
             player_state.play_idx -= 1;
+            send_seek_event(player_state.play_idx);
             build_buffer_on_progress();
             play_audio();
         }
@@ -432,6 +583,7 @@ document.addEventListener('DOMContentLoaded', () => {
             // change the color of the current progress segment back to loaded
             set_progress_segment_color(player_state.play_idx, COLORS.loaded);
             player_state.play_idx += 1;
+            send_seek_event(player_state.play_idx);
             build_buffer_on_progress();
             play_audio();
         }
@@ -458,6 +610,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
             // Update play index and play the new sentence
             player_state.play_idx = targetSentence.player_idx;
+            send_seek_event(player_state.play_idx);
             build_buffer_on_progress();
             play_audio();
         }
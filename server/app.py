@@ -1,31 +1,69 @@
 import abc
-from fastapi import FastAPI, Request, HTTPException, Depends, WebSocket
-from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse
+import asyncio
+from fastapi import FastAPI, Request, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse, Response
 from fastapi import Query
 from authlib.integrations.starlette_client import OAuth
 import base64
 from websockets.exceptions import ConnectionClosed
+from prometheus_client import CONTENT_TYPE_LATEST
 from traceback import format_exc
 
-import spacy
-
-from tts import to_speech
-from constants import GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, READLY_SECRET_KEY
+from tts import tts_client
+from audio_cache import audio_key, cached_to_speech, cached_stream_to_speech
+from audio_http import audio_response, audio_url, clip_response, open_file
+from audio_frames import pack_frame, pack_end_frame, pack_clip
+from constants import (
+    GOOGLE_CLIENT_ID,
+    GOOGLE_CLIENT_SECRET,
+    READLY_SECRET_KEY,
+    SESSION_MAX_AGE,
+    DEFAULT_VOICE,
+    STATS_CACHE_TTL,
+    STATS_CACHE_SIZE,
+    STATS_MAX_DAYS,
+    RENDER_MAX_SENTENCES,
+)
 
 from logger import logger
-from session_manage import HTTPSSessionMiddleware, WebSocketAuthManager, require_auth
-from redis_cache import set_auth_user, get_auth_user
-from sql_data import build_engine
-from crud_data import (
+from speak_scheduler import SpeakConnection, SpeakScheduler
+from reading_session import ReadingSession, reading_sessions
+from prewarm import prewarm_queue
+from render import RENDER_DONE, render_path, render_queue
+from segmentation import segmentation_engine
+from chunk_planner import plan_reading
+from session_manage import HTTPSSessionMiddleware, WebSocketAuthManager, require_auth, session_token
+from auth_cache import TTLCache, auth_cache
+from rate_limit import Decision, rate_limiter
+from sql_data import build_engine, build_async_engine
+from telemetry import TTSRequestWriter
+from metrics import (
+    CACHE_REQUESTS,
+    DB_WRITE_TIME,
+    OPEN_SOCKETS,
+    THROTTLED,
+    count_error,
+    observe,
+    render_metrics,
+    route_var,
+)
+from async_crud_data import (
     create_text_entry,
     get_text_entry,
-    get_user_text_entries,
+    text_entry_content,
+    list_user_text_entries,
     user_login,
-    create_tts_request,
     get_tts_requests,
+    get_usage_statistics,
+    get_tts_request_stats,
 )
 
+import binascii
+import math
+import re
 import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
 
 app = FastAPI()
 
@@ -34,6 +72,12 @@ app.add_middleware(HTTPSSessionMiddleware, secret_key=READLY_SECRET_KEY)
 socket_auth_manager = WebSocketAuthManager(secret_key=READLY_SECRET_KEY)
 
 engine, init_db, drop_db = build_engine()
+# the handlers only use the async engine, a slow query never blocks the event loop
+async_engine = build_async_engine()
+# tts_requests rows are written in batches, off the audio path
+tts_request_writer = TTSRequestWriter(async_engine)
+# (user_sub, days) => dashboard stats, a dashboard reload does not re-run the aggregates
+stats_cache = TTLCache(STATS_CACHE_TTL, STATS_CACHE_SIZE)
 
 oauth = OAuth()
 oauth.register(
@@ -44,9 +88,42 @@ oauth.register(
     client_kwargs={"scope": "openid email profile"},
 )
 
-# load only sentence tokenizer
-sentence_tokenizer = spacy.load("en_core_web_sm", disable=["ner", "parser"])
-sentence_tokenizer.add_pipe("sentencizer")
+
+@app.on_event("startup")
+async def startup():
+    await tts_client.start()
+    segmentation_engine.start()
+    tts_request_writer.start()
+    auth_cache.start()
+    prewarm_queue.start(tts_request_writer)
+    render_queue.start(tts_request_writer)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await prewarm_queue.close()
+    await render_queue.close()
+    await tts_client.close()
+    segmentation_engine.close()
+    await tts_request_writer.close()
+    await async_engine.dispose()
+    await auth_cache.close()
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus scrape endpoint, keep it reachable only from inside the network
+    """
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.api_route("/audio/{key}/{signature}", methods=["GET", "HEAD"])
+async def get_audio(request: Request, key: str, signature: str):
+    """
+    A synthesized clip by its content address, cacheable for good, see audio_http.py
+    """
+    return await audio_response(request, key, signature)
 
 
 @app.get("/login")
@@ -84,7 +161,7 @@ async def auth(
     user_sub = userinfo["sub"]
     user_email = userinfo["email"]
     user_name = userinfo.get("name", "")
-    user_login(engine, user_sub, user_email, user_name)
+    await user_login(async_engine, user_sub, user_email, user_name)
 
     base_url = str(request.base_url).rstrip("/")
     if key is None:
@@ -119,6 +196,10 @@ async def get_current_user(request: Request):
 @app.get("/logout")
 async def logout(request: Request, extension_id: str = Query(None)):
     request.session.clear()
+    cookie = request.cookies.get("session")
+    if cookie:
+        # every worker drops the cached websocket auth for this session, and only this one
+        await auth_cache.invalidate(session_token(cookie))
     base_url = str(request.base_url).rstrip("/")
     if extension_id is None:
         return RedirectResponse(url=f"{base_url}/login")
@@ -138,13 +219,23 @@ async def my_profile(request: Request):
     """
     Return the current user's profile
     """
-    user = request.session.get("user")
-    user["token"] = request.cookies.get("session")[:20]
+    # a copy, the session itself is not changed, so nothing is written back
+    user = dict(request.session.get("user"))
+    user["token"] = session_token(request.cookies.get("session"))
+    if await auth_cache.get(user["token"]) is None:
+        # a cookie signed before the tokens were per session, redis has nothing under its token yet
+        await auth_cache.set(user["token"], dict(request.session), ttl=SESSION_MAX_AGE)
     return user
 
 
 class EventType:
     SPEAK = "speak"
+    # protocol negotiation, binary audio frames or base64 in JSON
+    HELLO = "hello"
+    # the reader jumped to another play_idx
+    SEEK = "seek"
+    # drop some (or all) of the speak events sent before
+    CANCEL = "cancel"
 
 
 @app.post("/text_entry/create/")
@@ -162,14 +253,17 @@ async def text_entry_create(
     # Now create the text entry
     full_text = data["text"]
     logger.info(f"💎 {user_sub} - {full_text}")
-    res = create_text_entry(
-        engine,
-        data["text_id"],
-        user_sub,
-        full_text=full_text,
-        url=data.get("url"),
-    )
-    return res
+    with observe(DB_WRITE_TIME, route="/text_entry/create", table="text_entries"):
+        res = await create_text_entry(
+            async_engine,
+            data["text_id"],
+            user_sub,
+            full_text=full_text,
+            url=data.get("url"),
+        )
+    # segment and synthesize the first sentences before read.html asks for them
+    prewarm_queue.submit(data["text_id"], user_sub, full_text)
+    return text_entry_dict(res, full_text)
 
 
 @app.get("/text_entry/get/{text_id}/")
@@ -178,10 +272,58 @@ async def text_entry_get(
     request: Request,
     text_id: str,
 ):
-    text_entry = get_text_entry(engine, text_id)
+    text_entry = await get_text_entry(async_engine, text_id)
     if text_entry is None:
         return JSONResponse(status_code=404, content={"error": "Text entry not found"})
-    return text_entry
+    return text_entry_dict(text_entry, await text_entry_content(text_entry))
+
+
+def text_entry_dict(text_entry, full_text: Optional[str]) -> dict:
+    """The text entry as the extension knows it, the text inline whichever table it is stored in"""
+    return {
+        "text_id": text_entry.text_id,
+        "user_sub": text_entry.user_sub,
+        "url": text_entry.url,
+        "full_text": full_text,
+        "created_at": text_entry.created_at,
+        "updated_at": text_entry.updated_at,
+    }
+
+
+async def save_reading_session(text_id: str, text_entry, content: str) -> Tuple[ReadingSession, list, list]:
+    """
+    Segment and plan the text of the entry (content, from text_entry_content), store the reading session
+    Returns the session, the segments and the units
+    """
+    segments, units = await plan_reading(content)
+    session = await reading_sessions.save(
+        text_id,
+        text_entry.user_sub,
+        [unit.text for unit in units],
+        text_hash=text_entry.text_hash,
+        spans=[(unit.start, unit.end) for unit in units],
+    )
+    return session, segments, units
+
+
+async def get_reading_session(text_id: str, user: dict) -> Optional[ReadingSession]:
+    """
+    Reading session of text_id,
+    re-segmented from the database if the session has expired
+    None if the text does not exist or does not belong to the user
+    """
+    session = await reading_sessions.get(text_id)
+    if session is None:
+        text_entry = await get_text_entry(async_engine, text_id)
+        if text_entry is None:
+            return None
+        content = await text_entry_content(text_entry)
+        if not content:
+            return None
+        session, _, _ = await save_reading_session(text_id, text_entry, content)
+    if session.user_sub != user["sub"]:
+        return None
+    return session
 
 
 @app.post("/sentence_measure/{text_id}/")
@@ -191,25 +333,35 @@ async def sentence_measure(
     text_id: str,
 ):
     """
-    Cut the text into sentences
+    Cut the text into sentences, then into synthesis units
     """
     user = request.session.get("user")
+    route_var.set("/sentence_measure")
+
+    decision = await rate_limiter.admit_measure(user["sub"])
+    if not decision.allowed:
+        THROTTLED.labels(route="/sentence_measure", reason=decision.reason).inc()
+        return JSONResponse(
+            status_code=429,
+            content={"error": "Too many requests", "retry_after_ms": decision.retry_after_ms},
+            headers={"Retry-After": str(max(1, math.ceil(decision.retry_after_ms / 1000)))},
+        )
 
     user_email = user.get("email")
-    text_entry = get_text_entry(engine, text_id)
+    text_entry = await get_text_entry(async_engine, text_id)
     if text_entry is None:
         logger.warning(f"404 - {user_email} - Text entry not found")
         return JSONResponse(status_code=404, content={"error": "Text entry not found"})
-    if not text_entry.full_text:
+    content = await text_entry_content(text_entry)
+    if not content:
         logger.warning(f"400 - {user_email} - No text provided")
         return JSONResponse(status_code=400, content={"error": "No text provided"})
 
-    text = text_entry.full_text
-    sentences = []
-    for sentence in sentence_tokenizer(text).sents:
-        sentence_text = sentence.text
-        if len(sentence_text.strip()) > 0:
-            sentences.append(sentence_text)
+    # "sentences" are the synthesis units, what the reader plays with play_idx
+    # tiny sentences are merged, run-on sentences are split
+    # speak events only carry text_id + play_idx from now on
+    session, segments, units = await save_reading_session(text_id, text_entry, content)
+    sentences = session.sentences
 
     return {
         "text_id": text_id,
@@ -217,56 +369,208 @@ async def sentence_measure(
         "sentence_lengths": [len(sentence) for sentence in sentences],
         "user_email": user_email,
         "num_sentences": len(sentences),
+        # the original sentences, and which of them each unit covers, for highlighting
+        "segments": [segment.text for segment in segments],
+        "unit_segments": [list(unit.sentences) for unit in units],
+        "num_segments": len(segments),
     }
 
 
+async def stream_audio(
+    conn: SpeakConnection,
+    audio_id: str,
+    play_idx: int,
+    sentence_text: str,
+) -> str:
+    """
+    Relay the audio as binary frames while deepgram is still producing it,
+    followed by an end-of-clip frame
+    Returns the cache status of the audio
+    """
+    chunks, cache_status = await cached_stream_to_speech(sentence_text)
+    seq = 0
+    try:
+        async for chunk in chunks:
+            await conn.send_bytes(pack_frame(audio_id, play_idx, seq, chunk))
+            seq += 1
+    finally:
+        # hands the clip over to the requests waiting on the same synthesis
+        await chunks.aclose()
+    await conn.send_bytes(pack_end_frame(audio_id, play_idx, seq))
+    return cache_status
+
+
+async def audio_error_event(
+    conn: SpeakConnection,
+    text_id: str,
+    play_idx: int,
+    error: str,
+):
+    logger.warning(f"🔌 <{conn.user.get('email')}> {text_id}-{play_idx:03d}: {error}")
+    await conn.send_json(
+        {
+            "event_type": "audio_error",
+            "text_id": text_id,
+            "play_idx": play_idx,
+            "error": error,
+        }
+    )
+
+
+async def throttled_event(
+    conn: SpeakConnection,
+    text_id: str,
+    play_idx: int,
+    decision: Decision,
+):
+    """The user is over a rate limit, the client backs off and asks again, the socket stays open"""
+    logger.info(f"🔌 <{conn.user.get('email')}> {text_id}-{play_idx:03d}: throttled ({decision.reason})")
+    THROTTLED.labels(route="/speak", reason=decision.reason).inc()
+    await conn.send_json(
+        {
+            "event_type": "throttled",
+            "text_id": text_id,
+            "play_idx": play_idx,
+            "reason": decision.reason,
+            "retry_after_ms": decision.retry_after_ms,
+        }
+    )
+
+
 async def speak_event(
-    websocket: WebSocket,
+    conn: SpeakConnection,
     data: dict,
-    user: dict,
 ):
     """
     Handle the speak event
     """
-    text_data = data["text_data"]
-    sentences = text_data["sentences"]
-    text_id = text_data["text_id"]
-
+    user = conn.user
+    play_idx = data.get("play_idx", 0)
+    if "text_data" in data:
+        # old clients upload the whole sentence list with every speak event
+        text_data = data["text_data"]
+        text_id = text_data["text_id"]
+        # the request is recorded against text_id, it must be one of the user's texts
+        if await get_reading_session(text_id, user) is None:
+            await audio_error_event(conn, text_id, play_idx, "Text entry not found")
+            return
+        session = ReadingSession(text_id, user["sub"], text_data["sentences"])
+    else:
+        text_id = data["text_id"]
+        session = await get_reading_session(text_id, user)
+        if session is None:
+            await audio_error_event(conn, text_id, play_idx, "Text entry not found")
+            return
+    if not 0 <= play_idx < len(session.sentences):
+        await audio_error_event(conn, text_id, play_idx, "play_idx out of range")
+        return
+    sentence_text = session.sentences[play_idx]
+    # where the sentence sits in the stored text, the request row points there instead of copying it
+    text_ref = None
+    if session.text_hash is not None and session.spans is not None:
+        text_ref = (session.text_hash, *session.spans[play_idx])
+
+    async with rate_limiter.synthesis_slot(user["sub"]) as decision:
+        if decision.allowed:
+            decision = await rate_limiter.admit_speak(user["sub"], len(sentence_text))
+        if not decision.allowed:
+            await throttled_event(conn, text_id, play_idx, decision)
+            return
+        await synthesize_event(
+            conn,
+            text_id,
+            play_idx,
+            sentence_text,
+            stream=data.get("stream", False),
+            url=data.get("delivery") == "url",
+            text_ref=text_ref,
+        )
+
+
+async def synthesize_event(
+    conn: SpeakConnection,
+    text_id: str,
+    play_idx: int,
+    sentence_text: str,
+    stream: bool = False,
+    url: bool = False,
+    text_ref: Optional[Tuple[str, int, int]] = None,
+):
+    """
+    Synthesize one admitted sentence, send it and record the request
+    url: send the /audio/ URL of the clip instead of the audio
+    text_ref: (text_hash, char_start, char_end) of the sentence in its stored text
+    """
+    user = conn.user
     # my decision is not to set the speed here but use the default one
     # on frontend, the speed is controlled by the slider
     # speed: float = data.get("speed", 1.0)
     speed = 1.0
-    play_idx = data.get("play_idx", 0)
-    sentence_text = sentences[play_idx]
 
     audio_id = f"{text_id}-{play_idx:03d}"
     email = user.get("email")
     logger.info(f"⭐️ <{email}> : {audio_id}")
     start_time = time.time()
-    audio_bytes = to_speech(sentence_text)
+    cache_status = None
+    status, error_message = "completed", None
+    try:
+        if url:
+            # the client fetches it over HTTP, its browser cache keeps the clip across reloads
+            _, cache_status = await cached_to_speech(sentence_text)
+            await conn.send_json(
+                {
+                    "event_type": "audio_chunk",
+                    "audio_id": audio_id,
+                    "play_idx": play_idx,
+                    "speed": speed,
+                    "url": audio_url(audio_key(sentence_text)),
+                }
+            )
+        elif stream:
+            # frames are forwarded as deepgram sends them, read.js still waits for the end frame
+            # to build the clip and play it, the gain is the time of the last transfer only
+            cache_status = await stream_audio(conn, audio_id, play_idx, sentence_text)
+        elif conn.binary:
+            audio_bytes, cache_status = await cached_to_speech(sentence_text)
+            await conn.send_bytes(pack_clip(audio_id, play_idx, audio_bytes))
+        else:
+            # old clients, base64 inside JSON
+            audio_bytes, cache_status = await cached_to_speech(sentence_text)
+            await conn.send_json(
+                {
+                    "event_type": "audio_chunk",
+                    "audio_id": audio_id,
+                    "play_idx": play_idx,
+                    "speed": speed,
+                    "data": base64.b64encode(audio_bytes).decode("utf-8"),
+                }
+            )
+    except Exception as e:
+        # a failed sentence is reported to the client, the socket stays open
+        status, error_message = "failed", repr(e)
+        count_error(e, voice=DEFAULT_VOICE)
+        await audio_error_event(conn, text_id, play_idx, "Speech synthesis failed")
     processing_time_ms = int((time.time() - start_time) * 1000)
+    if cache_status is not None:
+        CACHE_REQUESTS.labels(voice=DEFAULT_VOICE, route="/speak", status=cache_status).inc()
 
     # We need to keep track of the TTS requests
     # Like the number of requests, the total characters, and the average processing time
-    create_tts_request(
-        engine,
+    text_hash, char_start, char_end = text_ref if text_ref is not None else (None, None, None)
+    tts_request_writer.record(
         text_entry_id=text_id,
         user_sub=user["sub"],
-        sentence_text=sentence_text,
+        sentence_text=None if text_ref is not None else sentence_text,
+        text_hash=text_hash,
+        char_start=char_start,
+        char_end=char_end,
         sentence_index=play_idx,
         audio_id=audio_id,
         character_count=len(sentence_text),
         processing_time_ms=processing_time_ms,
-    )
-
-    await websocket.send_json(
-        {
-            "event_type": "audio_chunk",
-            "audio_id": audio_id,
-            "play_idx": play_idx,
-            "speed": speed,
-            "data": base64.b64encode(audio_bytes).decode("utf-8"),
-        }
+        status=status,
+        error_message=error_message,
+        cache_status=cache_status,
     )
 
 
@@ -285,6 +589,14 @@ async def text_to_speech_socket(websocket: WebSocket):
         return
     # logger.info(f"💎 Connected user: {user.get('email')}")
 
+    # the speak tasks inherit the route from this one
+    route_var.set("/speak")
+    conn = SpeakConnection(websocket, user)
+    OPEN_SOCKETS.labels(route="/speak").inc()
+    # speak events are synthesized concurrently, nearest to play_idx first,
+    # replies go out as each one finishes
+    scheduler = SpeakScheduler(lambda data: speak_event(conn, data))
+
     try:
         while True:
             # Receive text from client
@@ -292,33 +604,210 @@ async def text_to_speech_socket(websocket: WebSocket):
             # logger.info(f"💎 Received data: {data}")
             event_type = data["event_type"]
             if event_type == EventType.SPEAK:
-                await speak_event(websocket, data, user)
+                scheduler.submit(data)
+            elif event_type == EventType.HELLO:
+                conn.binary = data.get("protocol") == "binary"
+                await conn.send_json(
+                    {
+                        "event_type": EventType.HELLO,
+                        "protocol": "binary" if conn.binary else "json",
+                    }
+                )
+            elif event_type == EventType.SEEK:
+                scheduler.seek(data.get("play_idx", 0))
+            elif event_type == EventType.CANCEL:
+                scheduler.cancel(data.get("play_idxs"))
             else:
                 logger.warning(f"Unknown event type: {event_type}")
 
-    except ConnectionClosed:  # Changed from WebSocketDisconnect
+    except (ConnectionClosed, WebSocketDisconnect):
         logger.info(f"Client disconnected: {user.get('email')}")
     except Exception as e:
+        count_error(e)
         logger.error(f"Error for user {user.get('email')}: {str(e)}")
         logger.error(f"🔌 Traceback: {format_exc()}")
         await websocket.close()
+    finally:
+        await scheduler.close()
+        OPEN_SOCKETS.labels(route="/speak").dec()
 
 
 # ============== for dashboard =================
+def encode_cursor(created_at: datetime, text_id: str) -> str:
+    """Opaque position in a listing, the sort key of the last entry seen"""
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{text_id}".encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        created_at, text_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+    except (UnicodeError, binascii.Error) as e:
+        raise ValueError(str(e))
+    return datetime.fromisoformat(created_at), text_id
+
+
 @app.get("/text_entries/")
 @require_auth
-async def get_text_entries(request: Request):
+async def get_text_entries(
+    request: Request,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
+):
     """
-    Get all text entries for the current user
+    The current user's text entries, newest first, a page at a time
+    pass the returned next_cursor to get the following page, it is None on the last one
     """
     user = request.session.get("user")
-    entries = get_user_text_entries(engine, user["sub"])
-    return entries
+    before = None
+    if cursor:
+        try:
+            before = decode_cursor(cursor)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"error": "Invalid cursor"})
+    entries = await list_user_text_entries(async_engine, user["sub"], limit=limit, before=before)
+    next_cursor = None
+    if len(entries) == limit:
+        next_cursor = encode_cursor(entries[-1].created_at, entries[-1].text_id)
+    return {
+        "entries": [
+            {
+                "text_id": entry.text_id,
+                "url": entry.url,
+                "created_at": entry.created_at,
+                "preview": entry.preview,
+            }
+            for entry in entries
+        ],
+        "next_cursor": next_cursor,
+    }
 
 
 @app.get("/tts_requests/")
 @require_auth
 async def get_tts_requests_api(request: Request):
     user = request.session.get("user")
-    requests = get_tts_requests(engine, user["sub"])
+    requests = await get_tts_requests(async_engine, user["sub"])
     return requests
+
+
+@app.get("/usage/")
+@require_auth
+async def get_usage_api(request: Request, months: int = Query(12, ge=1, le=120)):
+    """
+    Monthly usage of the current user, from the rollups, latest month first
+    """
+    user = request.session.get("user")
+    rollups = await get_usage_statistics(async_engine, user["sub"], limit=months)
+    return [
+        {
+            "year": rollup.year,
+            "month": rollup.month,
+            "total_requests": rollup.total_requests,
+            "total_characters": rollup.total_characters,
+            "total_processing_time_ms": rollup.total_processing_time_ms,
+            "avg_processing_time_ms": (
+                rollup.total_processing_time_ms / rollup.total_requests if rollup.total_requests else 0
+            ),
+        }
+        for rollup in rollups
+    ]
+
+
+@app.get("/stats/")
+@require_auth
+async def get_stats_api(request: Request, days: int = Query(30, ge=1, le=STATS_MAX_DAYS)):
+    """
+    Request count, characters, latency (avg, p50, p95) and cache hits of the current user
+    over the last `days` days, in total and per UTC day
+    """
+    user = request.session.get("user")
+    key = f"{user['sub']}:{days}"
+    stats = stats_cache.get(key)
+    if stats is None:
+        # whole UTC days, today included
+        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        since = today - timedelta(days=days - 1)
+        stats = await get_tts_request_stats(async_engine, user["sub"], since)
+        stats_cache.set(key, stats)
+    return stats
+
+
+# ============== whole-document renders =================
+_render_file = re.compile(r"^([0-9a-f]{16})\.(mp3|json)$")
+RENDER_MEDIA_TYPES = {"mp3": "audio/mpeg", "json": "application/json"}
+
+
+def render_state_dict(text_id: str, state: dict) -> dict:
+    res = {
+        "text_id": text_id,
+        "status": state["status"],
+        "total": state["total"],
+        "done": state["done"],
+        "error": state["error"],
+    }
+    if state["status"] == RENDER_DONE:
+        res["audio_url"] = f"/render/{text_id}/{state['fingerprint']}.mp3"
+        res["index_url"] = f"/render/{text_id}/{state['fingerprint']}.json"
+    return res
+
+
+@app.post("/render/{text_id}/")
+@require_auth
+async def render_create(request: Request, text_id: str):
+    """
+    Render the whole text into one mp3, in the background
+    Poll GET /render/{text_id}/ for the progress, post again to resume an interrupted or failed render
+    """
+    user = request.session.get("user")
+    session = await get_reading_session(text_id, user)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Text entry not found"})
+    if len(session.sentences) > RENDER_MAX_SENTENCES:
+        return JSONResponse(
+            status_code=413,
+            content={"error": f"Too long to render, {RENDER_MAX_SENTENCES} sentences at most"},
+        )
+    state = await render_queue.submit(session)
+    if state is None:
+        return JSONResponse(
+            status_code=429,
+            content={"error": "Too many renders, try again later"},
+            headers={"Retry-After": "60"},
+        )
+    return JSONResponse(status_code=202, content=render_state_dict(text_id, state))
+
+
+@app.get("/render/{text_id}/")
+@require_auth
+async def render_status(request: Request, text_id: str):
+    user = request.session.get("user")
+    state = await render_queue.get_state(text_id)
+    if state is None or state["user_sub"] != user["sub"]:
+        return JSONResponse(status_code=404, content={"error": "Render not found"})
+    return render_state_dict(text_id, state)
+
+
+@app.api_route("/render/{text_id}/{name}", methods=["GET", "HEAD"])
+@require_auth
+async def render_file(request: Request, text_id: str, name: str):
+    """
+    The rendered audio, or its sentence index
+    a fingerprint names one render for good, so both are cacheable, in the user's browser only
+    """
+    match = _render_file.match(name)
+    if match is None:
+        return JSONResponse(status_code=404, content={"error": "Render not found"})
+    fingerprint, suffix = match.groups()
+    user = request.session.get("user")
+    state = await render_queue.get_state(text_id)
+    if state is None or state["user_sub"] != user["sub"]:
+        return JSONResponse(status_code=404, content={"error": "Render not found"})
+    clip = await asyncio.to_thread(open_file, render_path(text_id, fingerprint, f".{suffix}"), fingerprint)
+    if clip is None:
+        return JSONResponse(status_code=404, content={"error": "Render not found"})
+    return clip_response(
+        request,
+        clip,
+        cache_control="private, max-age=31536000, immutable",
+        media_type=RENDER_MEDIA_TYPES[suffix],
+    )
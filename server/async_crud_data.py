@@ -0,0 +1,245 @@
+"""
+Async variant of crud_data, for the FastAPI handlers
+
+Same functions and signatures as crud_data, on SQLAlchemy's asyncio extension,
+the sync crud_data stays for scripts and the shell.
+"""
+
+import asyncio
+import functools
+from datetime import datetime
+from typing import Any, Dict, List, Union, Optional, Tuple
+
+from sqlalchemy import func, select, insert, tuple_
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import joinedload
+
+from sql_data import TextBlob, TextEntry, User, TTSRequest, UsageStatistic, blob_text, text_blob_insert
+from text_store import blob_values
+from usage import usage_deltas, usage_upsert
+
+
+def async_engine_to_session(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        args = list(args)
+        engine = args[0]
+
+        if isinstance(engine, AsyncEngine):
+            # handlers return the ORM objects after the session is gone
+            async with AsyncSession(engine, expire_on_commit=False) as db:
+                return await func(db, *args[1:], **kwargs)
+        elif isinstance(engine, AsyncSession):
+            return await func(engine, *args[1:], **kwargs)
+        else:
+            raise ValueError("Invalid engine type")
+
+    return wrapper
+
+
+@async_engine_to_session
+async def create_text_entry(
+    db: Union[AsyncSession, AsyncEngine],
+    text_id: str,
+    user_sub: str,
+    full_text: str,
+    url: str,
+) -> TextEntry:
+    """
+    Create a new text entry in the database
+    the text goes to text_blobs, stored once however many entries share it
+    """
+    # compressing a long article is real CPU work, keep it off the event loop
+    values = await asyncio.to_thread(blob_values, full_text)
+    await db.execute(text_blob_insert(values))
+    text_entry = TextEntry(
+        text_id=text_id,
+        user_sub=user_sub,
+        text_hash=values["hash"],
+        url=url,
+    )
+    db.add(text_entry)
+    await db.commit()
+    await db.refresh(text_entry)
+    return text_entry
+
+
+@async_engine_to_session
+async def get_text_entry(db: Union[AsyncSession, AsyncEngine], text_id: str) -> Optional[TextEntry]:
+    """
+    Get a text entry by its ID
+    """
+    result = await db.execute(
+        select(TextEntry).options(joinedload(TextEntry.blob)).where(TextEntry.text_id == text_id).limit(1)
+    )
+    return result.scalars().first()
+
+
+async def text_entry_content(text_entry: TextEntry) -> Optional[str]:
+    """
+    The text of an entry from get_text_entry
+    decompressed in a thread, call it once per request and pass the text on
+    """
+    blob = text_entry.blob
+    if blob is None:
+        return text_entry.full_text
+    return await asyncio.to_thread(blob_text, blob)
+
+
+@async_engine_to_session
+async def list_user_text_entries(
+    db: Union[AsyncSession, AsyncEngine],
+    sub: str,
+    limit: int = 50,
+    before: Optional[Tuple[datetime, str]] = None,
+    preview_chars: int = 200,
+):
+    """
+    One page of a user's text entries, newest first, for the list views
+    only the light columns plus the start of the text, never the full text
+    before: (created_at, text_id) of the last entry of the previous page
+    """
+    query = (
+        select(
+            TextEntry.text_id,
+            TextEntry.url,
+            TextEntry.created_at,
+            # entries not migrated to text_blobs yet still have their full_text
+            func.substr(func.coalesce(TextBlob.preview, TextEntry.full_text), 1, preview_chars).label("preview"),
+        )
+        .outerjoin(TextBlob, TextEntry.text_hash == TextBlob.hash)
+        .where(TextEntry.user_sub == sub)
+        .order_by(TextEntry.created_at.desc(), TextEntry.text_id.desc())
+        .limit(limit)
+    )
+    if before is not None:
+        # keyset pagination, an index range scan however deep the page
+        query = query.where(tuple_(TextEntry.created_at, TextEntry.text_id) < tuple_(*before))
+    result = await db.execute(query)
+    return result.all()
+
+
+@async_engine_to_session
+async def get_user(db: Union[AsyncSession, AsyncEngine], sub: str) -> Optional[User]:
+    """
+    Get a user by their ID
+    """
+    result = await db.execute(select(User).where(User.sub == sub).limit(1))
+    return result.scalars().first()
+
+
+@async_engine_to_session
+async def user_login(db: Union[AsyncSession, AsyncEngine], sub: str, email: str, name: str) -> User:
+    """
+    Update user last login time, create the user on the first login
+    """
+    user = await get_user(db, sub)
+    if not user:
+        user = User(sub=sub, email=email, name=name)
+        db.add(user)
+    user.last_login_at = datetime.now()
+    await db.commit()
+    await db.refresh(user)
+    return user
+
+
+@async_engine_to_session
+async def create_tts_requests(db: Union[AsyncSession, AsyncEngine], rows: List[Dict[str, Any]]) -> int:
+    """
+    Bulk insert TTS request records, one multi-row INSERT, no refresh
+    Each row has the column values of TTSRequest
+    the monthly usage rollups are updated in the same transaction
+    """
+    if not rows:
+        return 0
+    await db.execute(insert(TTSRequest), rows)
+    await db.execute(usage_upsert(usage_deltas(rows)))
+    await db.commit()
+    return len(rows)
+
+
+@async_engine_to_session
+async def get_tts_requests(
+    db: Union[AsyncSession, AsyncEngine],
+    user_sub: str,
+    limit: int = 10,
+):
+    """
+    Get recent TTS requests for a user
+    rows pointing into a stored text get their sentence_text back from the blob
+    """
+    result = await db.execute(
+        select(TTSRequest)
+        .where(TTSRequest.user_sub == user_sub)
+        .order_by(TTSRequest.created_at.desc())
+        .limit(limit)
+    )
+    requests = result.scalars().all()
+    hashes = {request.text_hash for request in requests if request.sentence_text is None and request.text_hash}
+    if not hashes:
+        return requests
+    blobs = (await db.execute(select(TextBlob).where(TextBlob.hash.in_(hashes)))).scalars().all()
+    texts = await asyncio.to_thread(lambda: {blob.hash: blob_text(blob) for blob in blobs})
+    # filled in for the response only, never written back
+    db.expunge_all()
+    for request in requests:
+        if request.sentence_text is None and request.text_hash in texts:
+            request.sentence_text = texts[request.text_hash][request.char_start:request.char_end]
+    return requests
+
+
+@async_engine_to_session
+async def get_usage_statistics(
+    db: Union[AsyncSession, AsyncEngine],
+    user_sub: str,
+    limit: int = 12,
+) -> List[UsageStatistic]:
+    """Monthly usage rollups of a user, latest month first"""
+    result = await db.execute(
+        select(UsageStatistic)
+        .where(UsageStatistic.user_sub == user_sub)
+        .order_by(UsageStatistic.year.desc(), UsageStatistic.month.desc())
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+
+@async_engine_to_session
+async def get_tts_request_stats(
+    db: Union[AsyncSession, AsyncEngine],
+    user_sub: str,
+    since: datetime,
+) -> Dict[str, Any]:
+    """
+    Aggregates of a user's TTS requests since a time, computed in postgres
+    totals plus latency percentiles, and the same per UTC day
+    """
+    latency = TTSRequest.processing_time_ms
+    saved = TTSRequest.cache_status.in_(["hit", "coalesced"])
+    aggregates = [
+        func.count().label("total_requests"),
+        func.coalesce(func.sum(TTSRequest.character_count), 0).label("total_characters"),
+        func.avg(latency).label("avg_processing_time_ms"),
+        func.percentile_cont(0.5).within_group(latency).label("p50_processing_time_ms"),
+        func.percentile_cont(0.95).within_group(latency).label("p95_processing_time_ms"),
+        func.count().filter(saved).label("cache_hits"),
+        func.count().filter(TTSRequest.status == "failed").label("failed"),
+    ]
+    in_range = (TTSRequest.user_sub == user_sub, TTSRequest.created_at >= since)
+
+    totals = (await db.execute(select(*aggregates).where(*in_range))).one()
+
+    day = func.date_trunc("day", func.timezone("UTC", TTSRequest.created_at)).label("day")
+    days = await db.execute(select(day, *aggregates).where(*in_range).group_by(day).order_by(day))
+
+    def as_dict(row) -> Dict[str, Any]:
+        stats = dict(row._mapping)
+        for key in ("avg_processing_time_ms", "p50_processing_time_ms", "p95_processing_time_ms"):
+            if stats[key] is not None:
+                stats[key] = float(stats[key])
+        return stats
+
+    return {
+        **as_dict(totals),
+        "days": [as_dict(row) | {"day": row.day.date().isoformat()} for row in days],
+    }
@@ -0,0 +1,274 @@
+"""
+Content addressed cache for synthesized audio
+
+Audio is keyed by a hash of (voice, normalized sentence text),
+so the same sentence read with the same voice is synthesized only once,
+no matter which user, article or worker asks for it.
+
+Two tiers:
+* an in-process LRU, bounded by total bytes
+* a shared on-disk tier, bounded by total bytes, evicting the least recently used clips
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import AsyncIterator, Optional, Tuple
+
+from logger import logger
+from tts_provider import to_speech, stream_speech
+from singleflight import Flight, single_flight
+from constants import (
+    DEFAULT_VOICE,
+    AUDIO_CACHE_DIR,
+    AUDIO_CACHE_MEMORY_BYTES,
+    AUDIO_CACHE_DISK_BYTES,
+)
+
+AUDIO_SUFFIX = ".mp3"
+
+# where the audio of a request came from, recorded in tts_requests.cache_status
+CACHE_HIT = "hit"
+CACHE_MISS = "miss"
+# shared the synthesis of a concurrent identical request
+CACHE_COALESCED = "coalesced"
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize the sentence text before hashing
+    unicode form and whitespace should not make a different clip
+    """
+    text = unicodedata.normalize("NFC", text)
+    return _whitespace.sub(" ", text).strip()
+
+
+def audio_key(text: str, voice: str = DEFAULT_VOICE) -> str:
+    """Content address of a clip: sha256 of the voice and the normalized text"""
+    payload = f"{voice}\x00{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+class MemoryLRU:
+    """
+    In-process LRU cache bounded by the total bytes of the values
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._data[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.size -= len(evicted)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DiskCache:
+    """
+    On-disk cache shared by every worker on the host
+
+    Clips are written atomically (tmp file + rename),
+    file mtime is bumped on read so eviction drops the least recently used clips
+    once the directory grows over max_bytes.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        # approximate, other workers write to the same directory
+        self.size: Optional[int] = None
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}{AUDIO_SUFFIX}")
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key: str, value: bytes) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+        if self.size is None:
+            self.size = self._scan_size()
+        else:
+            self.size += len(value)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def _files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(AUDIO_SUFFIX):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._files())
+
+    def evict(self) -> None:
+        """Drop the least recently used clips until we are at 90% of max_bytes"""
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        target = int(self.max_bytes * 0.9)
+        removed = 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self.size = total
+        logger.info(f"[AUDIO CACHE] evicted {removed} clips, disk tier at {total} bytes")
+
+
+class AudioCache:
+    """
+    Memory LRU in front of the shared disk tier
+    disk access runs in a thread, so the event loop never waits on the file system
+    """
+
+    def __init__(
+        self,
+        root: str = AUDIO_CACHE_DIR,
+        memory_bytes: int = AUDIO_CACHE_MEMORY_BYTES,
+        disk_bytes: int = AUDIO_CACHE_DISK_BYTES,
+    ):
+        self.memory = MemoryLRU(memory_bytes)
+        self.disk = DiskCache(root, disk_bytes)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        value = await asyncio.to_thread(self.disk.get, key)
+        if value is not None:
+            self.memory.put(key, value)
+        return value
+
+    async def put(self, key: str, value: bytes) -> None:
+        self.memory.put(key, value)
+        try:
+            await asyncio.to_thread(self.disk.put, key, value)
+        except OSError as e:
+            # the memory tier still has it, a full disk should not break the audio
+            logger.warning(f"[AUDIO CACHE] disk write failed for {key}: {e}")
+
+
+audio_cache = AudioCache()
+
+
+async def cached_to_speech(
+    text: str,
+    voice: str = DEFAULT_VOICE,
+) -> Tuple[bytes, str]:
+    """
+    Synthesize the text, unless the clip is already cached
+    or the same clip is being synthesized right now (then we share that synthesis)
+    Returns the audio bytes and the cache status: CACHE_HIT, CACHE_MISS or CACHE_COALESCED
+    """
+    key = audio_key(text, voice)
+    audio_bytes = await audio_cache.get(key)
+    if audio_bytes is not None:
+        return audio_bytes, CACHE_HIT
+
+    async def synthesize() -> bytes:
+        audio_bytes = await to_speech(text, voice=voice)
+        await audio_cache.put(key, audio_bytes)
+        return audio_bytes
+
+    audio_bytes, shared = await single_flight.run(key, synthesize)
+    return audio_bytes, CACHE_COALESCED if shared else CACHE_MISS
+
+
+async def _replay(audio_bytes: bytes) -> AsyncIterator[bytes]:
+    yield audio_bytes
+
+
+async def _stream_and_store(
+    key: str,
+    text: str,
+    voice: str,
+    flight: Optional[Flight],
+) -> AsyncIterator[bytes]:
+    chunks = []
+    audio_bytes, error = None, None
+    try:
+        async for chunk in stream_speech(text, voice=voice):
+            chunks.append(chunk)
+            yield chunk
+        audio_bytes = b"".join(chunks)
+        # only a complete clip goes into the cache
+        await audio_cache.put(key, audio_bytes)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        if flight is not None:
+            await single_flight.finish(flight, audio_bytes, error)
+
+
+async def cached_stream_to_speech(
+    text: str,
+    voice: str = DEFAULT_VOICE,
+) -> Tuple[AsyncIterator[bytes], str]:
+    """
+    Streaming version of cached_to_speech
+    Returns an iterator over the audio chunks and the cache status
+    """
+    key = audio_key(text, voice)
+    audio_bytes = await audio_cache.get(key)
+    if audio_bytes is not None:
+        return _replay(audio_bytes), CACHE_HIT
+
+    flight = await single_flight.try_lead(key)
+    if flight is None:
+        # somebody else is synthesizing it, replay their bytes once done
+        audio_bytes = await single_flight.wait(key)
+        if audio_bytes is not None:
+            return _replay(audio_bytes), CACHE_COALESCED
+    return _stream_and_store(key, text, voice, flight), CACHE_MISS
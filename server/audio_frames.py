@@ -0,0 +1,85 @@
+"""
+Binary frames for audio on the `/speak` socket
+
+Each frame is a fixed header, the audio_id, then the raw audio payload
+
+    version   uint8
+    flags     uint8    FLAG_END / FLAG_COMPLETE, see below
+    codec     uint8    CODEC_* of the payload
+    play_idx  uint32
+    seq       uint32   0, 1, 2 ... within one clip
+    length    uint32   byte length of the payload
+    id_len    uint16   byte length of the utf-8 audio_id that follows
+
+A whole clip goes out as a single FLAG_COMPLETE frame.
+A streamed clip goes out as payload frames, then an empty FLAG_END frame.
+
+All integers are big-endian (network order), `read.js` parses them with a DataView.
+Clients that never negotiate the binary protocol keep getting base64 inside JSON.
+"""
+
+import struct
+from typing import NamedTuple
+
+FRAME_VERSION = 2
+
+# last frame of a streamed clip, no payload
+FLAG_END = 0x01
+# the payload is the whole clip, nothing follows
+FLAG_COMPLETE = 0x02
+
+CODEC_MP3 = 1
+
+CODEC_MIME_TYPES = {
+    CODEC_MP3: "audio/mpeg",
+}
+
+HEADER = struct.Struct("!BBBIIIH")
+
+
+class AudioFrame(NamedTuple):
+    audio_id: str
+    play_idx: int
+    seq: int
+    flags: int
+    codec: int
+    payload: bytes
+
+    @property
+    def is_end(self) -> bool:
+        return bool(self.flags & (FLAG_END | FLAG_COMPLETE))
+
+
+def pack_frame(
+    audio_id: str,
+    play_idx: int,
+    seq: int,
+    payload: bytes = b"",
+    flags: int = 0,
+    codec: int = CODEC_MP3,
+) -> bytes:
+    audio_id_bytes = audio_id.encode("utf-8")
+    header = HEADER.pack(FRAME_VERSION, flags, codec, play_idx, seq, len(payload), len(audio_id_bytes))
+    return b"".join([header, audio_id_bytes, payload])
+
+
+def pack_end_frame(audio_id: str, play_idx: int, seq: int, codec: int = CODEC_MP3) -> bytes:
+    """End-of-clip marker, seq is the number of payload frames sent before it"""
+    return pack_frame(audio_id, play_idx, seq, flags=FLAG_END, codec=codec)
+
+
+def pack_clip(audio_id: str, play_idx: int, payload: bytes, codec: int = CODEC_MP3) -> bytes:
+    """A whole clip in one frame"""
+    return pack_frame(audio_id, play_idx, 0, payload, flags=FLAG_COMPLETE, codec=codec)
+
+
+def unpack_frame(frame: bytes) -> AudioFrame:
+    version, flags, codec, play_idx, seq, length, id_len = HEADER.unpack_from(frame)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unknown audio frame version: {version}")
+    id_end = HEADER.size + id_len
+    audio_id = frame[HEADER.size : id_end].decode("utf-8")
+    payload = frame[id_end : id_end + length]
+    if len(payload) != length:
+        raise ValueError(f"Truncated audio frame: {len(payload)} / {length} bytes")
+    return AudioFrame(audio_id, play_idx, seq, flags, codec, payload)
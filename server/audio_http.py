@@ -0,0 +1,207 @@
+"""
+Synthesized clips over plain HTTP, `GET /audio/{audio_key}/{signature}`
+
+The key is the content address of the clip (see audio_cache.audio_key),
+a URL always names the same sentence in the same voice, so browsers, proxies and CDNs
+may keep the response for good: strong ETag, `Cache-Control: immutable`,
+conditional GET and single byte ranges, the file streamed from the disk tier in chunks.
+
+Only clips already in the cache are served, nothing is synthesized here,
+the speak socket hands out the URL once the clip is stored.
+The key alone is not enough: anybody can hash a sentence they guess,
+so the URL carries an HMAC of the key under `READLY_SECRET_KEY`, only the server hands those out.
+A wrong signature gets the same 404 as a missing clip, the endpoint tells nothing about the cache.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import os
+import re
+from typing import BinaryIO, Iterator, NamedTuple, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from audio_cache import audio_cache
+from constants import READLY_SECRET_KEY
+
+AUDIO_MEDIA_TYPE = "audio/mpeg"
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# read size when streaming a clip from disk
+STREAM_CHUNK_BYTES = 64 * 1024
+
+_audio_key = re.compile(r"^[0-9a-f]{64}$")
+_byte_range = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class Clip(NamedTuple):
+    etag: str
+    size: int
+    # an open file positioned nowhere in particular, or the bytes of a memory-only clip
+    file: Optional[BinaryIO] = None
+    data: Optional[bytes] = None
+
+
+def is_audio_key(key: str) -> bool:
+    return _audio_key.match(key) is not None
+
+
+def audio_signature(key: str) -> str:
+    mac = hmac.new(READLY_SECRET_KEY.encode("utf-8"), f"audio:{key}".encode("utf-8"), hashlib.sha256)
+    return mac.hexdigest()[:32]
+
+
+def audio_url(key: str) -> str:
+    return f"/audio/{key}/{audio_signature(key)}"
+
+
+def open_file(path: str, tag: str) -> Optional[Clip]:
+    """
+    Open a file to serve, None when it is not there
+    The ETag comes from the opened file: a file replaced by another one
+    (a clip evicted and synthesized again, other bytes) gets another tag.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    stat = os.fstat(f.fileno())
+    return Clip(f'"{tag}-{stat.st_ino:x}-{stat.st_size:x}"', stat.st_size, file=f)
+
+
+def _open_clip(key: str) -> Optional[Clip]:
+    """The clip in the disk tier, its mtime bumped like DiskCache.get does"""
+    path = audio_cache.disk.path(key)
+    clip = open_file(path, key[:32])
+    if clip is not None:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+    return clip
+
+
+async def find_clip(key: str) -> Optional[Clip]:
+    clip = await asyncio.to_thread(_open_clip, key)
+    if clip is not None:
+        return clip
+    # the disk write failed, the memory tier of this worker may still have it
+    data = audio_cache.memory.get(key)
+    if data is None:
+        return None
+    return Clip(f'"{key[:32]}-{hashlib.sha256(data).hexdigest()[:16]}"', len(data), data=data)
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    (first, last) byte of a single `bytes=` range, last included
+    None for anything else (several ranges, other units, bad syntax), the whole clip is sent then
+    raises RangeNotSatisfiable when the range starts past the end
+    """
+    match = _byte_range.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first == "":
+        if last == "":
+            return None
+        # the last n bytes
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - suffix), size - 1
+    first = int(first)
+    if last != "" and int(last) < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    last = size - 1 if last == "" else min(int(last), size - 1)
+    return first, last
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match, weak comparison"""
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in header.split(",")]
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def _read_file(f: BinaryIO, first: int, length: int) -> Iterator[bytes]:
+    # a sync generator, starlette runs it in its thread pool
+    try:
+        f.seek(first)
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK_BYTES, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _close(clip: Clip) -> None:
+    if clip.file is not None:
+        clip.file.close()
+
+
+async def audio_response(request: Request, key: str, signature: str) -> Response:
+    if not is_audio_key(key) or not hmac.compare_digest(signature.encode("utf-8"), audio_signature(key).encode("utf-8")):
+        return Response(status_code=404)
+    clip = await find_clip(key)
+    if clip is None:
+        return Response(status_code=404)
+    return clip_response(request, clip)
+
+
+def clip_response(
+    request: Request,
+    clip: Clip,
+    cache_control: str = CACHE_CONTROL,
+    media_type: str = AUDIO_MEDIA_TYPE,
+) -> Response:
+    """The clip, or the part of it the conditional and range headers ask for"""
+    headers = {
+        "ETag": clip.etag,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, clip.etag):
+        _close(clip)
+        return Response(status_code=304, headers=headers)
+
+    status, first, last = 200, 0, clip.size - 1
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # a stale If-Range (or a date) gets the whole current clip
+    if range_header is not None and (if_range is None or if_range.strip() == clip.etag):
+        try:
+            byte_range = parse_range(range_header, clip.size)
+        except RangeNotSatisfiable:
+            _close(clip)
+            headers["Content-Range"] = f"bytes */{clip.size}"
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            status, (first, last) = 206, byte_range
+            headers["Content-Range"] = f"bytes {first}-{last}/{clip.size}"
+
+    length = last - first + 1
+    headers["Content-Length"] = str(length)
+    if request.method == "HEAD":
+        _close(clip)
+        return Response(status_code=status, headers=headers, media_type=media_type)
+    if clip.data is not None:
+        return Response(clip.data[first:last + 1], status_code=status, headers=headers, media_type=media_type)
+    return StreamingResponse(
+        _read_file(clip.file, first, length),
+        status_code=status,
+        headers=headers,
+        media_type=media_type,
+    )
@@ -0,0 +1,134 @@
+"""
+Two tier cache of the authenticated users, for the websocket handshake
+
+A small in-process TTL cache sits in front of redis,
+reconnect storms from `read.js` (after a deploy or a network blip)
+verify their tokens from memory instead of hammering redis.
+A token is a hash of the session cookie (session_manage.session_token), one per session.
+
+On logout the token is dropped from redis and from this worker,
+and, with pub/sub on, from every other worker too.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from logger import logger
+from redis_cache import (
+    async_redis_client,
+    auth_user_key,
+    get_auth_user,
+    set_auth_user,
+    delete_auth_user,
+)
+from constants import (
+    AUTH_CACHE_TTL,
+    AUTH_CACHE_SIZE,
+    AUTH_INVALIDATION_CHANNEL,
+    AUTH_INVALIDATION_PUBSUB,
+)
+
+
+class TTLCache:
+    """
+    Bounded in-process cache, entries expire ttl seconds after they are set
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+
+class AuthCache:
+    def __init__(
+        self,
+        ttl: float = AUTH_CACHE_TTL,
+        max_size: int = AUTH_CACHE_SIZE,
+        channel: str = AUTH_INVALIDATION_CHANNEL,
+        pubsub: bool = AUTH_INVALIDATION_PUBSUB,
+    ):
+        self.local = TTLCache(ttl, max_size)
+        self.channel = channel
+        self.pubsub = pubsub
+        self._listener: Optional[asyncio.Task] = None
+
+    async def get(self, token: str) -> Optional[Dict]:
+        key = auth_user_key(token)
+        user_data = self.local.get(key)
+        if user_data is not None:
+            return user_data
+        user_data = await get_auth_user(token)
+        if user_data is not None:
+            self.local.set(key, user_data)
+        return user_data
+
+    async def set(self, token: str, user_data: Dict, ttl: Optional[int] = None) -> None:
+        await set_auth_user(token, user_data, ttl=ttl)
+        await self._broadcast(auth_user_key(token))
+
+    async def invalidate(self, token: str) -> None:
+        """Logout, forget the token here, in redis and in every worker"""
+        await delete_auth_user(token)
+        await self._broadcast(auth_user_key(token))
+
+    async def _broadcast(self, key: str) -> None:
+        self.local.delete(key)
+        if self.pubsub:
+            await async_redis_client.publish(self.channel, key)
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = async_redis_client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    key = message["data"]
+                    if isinstance(key, bytes):
+                        key = key.decode("utf-8")
+                    self.local.delete(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # lost redis, everything cached may be stale by now
+                logger.warning(f"[AUTH CACHE] invalidation listener failed: {e}")
+                self.local = TTLCache(self.local.ttl, self.local.max_size)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def start(self) -> None:
+        if self.pubsub and self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            listener.cancel()
+            await asyncio.gather(listener, return_exceptions=True)
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,10 @@
+"""
+Offline benchmark harness
+
+* `fake_deepgram`: a local stand-in for deepgram's `/v1/speak`, with tunable latency and payload size
+* `fixtures`: signed session tokens and reading sessions, no google login needed
+* `load`: opens many `/speak` sockets and replays the prefetch pattern of `read.js`,
+  then reports time-to-audio percentiles, events/sec and memory per connection
+
+Run everything from the `server` folder, see `python -m bench.load --help`.
+"""
@@ -0,0 +1,91 @@
+"""
+Local stand-in for deepgram's speak API
+
+    python -m bench.fake_deepgram --port 8100 --latency-ms 300 --jitter-ms 100
+
+then start the server with
+    READLY_SPEAK_URL=http://localhost:8100/v1/speak READLY_TTS_HTTP2=0
+
+The response is streamed like deepgram's: the first chunk after `ttfb` of the latency,
+the rest spread over the remaining time.
+"""
+
+import argparse
+import asyncio
+import random
+from typing import AsyncIterator, NamedTuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# an mpeg audio frame sync word, so the bytes at least look like mp3
+_MP3_HEADER = b"\xff\xfb\x90\x00"
+
+
+class FakeSpeakConfig(NamedTuple):
+    # total time to the last byte: latency_ms + per_char_ms * len(text) +- jitter_ms
+    latency_ms: float = 300.0
+    per_char_ms: float = 1.0
+    jitter_ms: float = 100.0
+    # share of the latency before the first byte
+    ttfb: float = 0.4
+    # payload size: base_bytes + bytes_per_char * len(text)
+    base_bytes: int = 4096
+    bytes_per_char: int = 400
+    chunk_bytes: int = 8192
+    # share of the requests answered with a 503
+    error_rate: float = 0.0
+
+
+def build_app(config: FakeSpeakConfig) -> FastAPI:
+    app = FastAPI()
+    stats = {"requests": 0, "errors": 0, "bytes": 0}
+
+    async def body(total_seconds: float, size: int) -> AsyncIterator[bytes]:
+        payload = _MP3_HEADER + bytes(max(0, size - len(_MP3_HEADER)))
+        chunks = [payload[i : i + config.chunk_bytes] for i in range(0, len(payload), config.chunk_bytes)]
+        await asyncio.sleep(total_seconds * config.ttfb)
+        rest = total_seconds * (1 - config.ttfb) / max(1, len(chunks) - 1)
+        for idx, chunk in enumerate(chunks):
+            if idx > 0:
+                await asyncio.sleep(rest)
+            yield chunk
+
+    @app.post("/v1/speak")
+    async def speak(request: Request, model: str = "aura-asteria-en"):
+        data = await request.json()
+        text = data.get("text", "")
+        stats["requests"] += 1
+        if random.random() < config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(status_code=503, content={"err_msg": "fake overload"})
+
+        total_ms = config.latency_ms + config.per_char_ms * len(text)
+        total_ms += random.uniform(-config.jitter_ms, config.jitter_ms)
+        size = config.base_bytes + config.bytes_per_char * len(text)
+        stats["bytes"] += size
+        return StreamingResponse(body(max(0.0, total_ms) / 1000, size), media_type="audio/mpeg")
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main() -> None:
+    defaults = FakeSpeakConfig()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    for field, default in defaults._asdict().items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    config = FakeSpeakConfig(**{field: getattr(args, field) for field in defaults._fields})
+    uvicorn.run(build_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark users and texts, without google login
+
+A session is signed with `READLY_SECRET_KEY` and registered in redis by the session middleware itself,
+the same payload as the one the login sets, so the server under test accepts it.
+The users and text entries are written to the database too, the tts_requests rows
+the server records point at them, and the reading session goes to redis,
+speak events find their sentences there.
+The server must share the secret key, the redis and the database of the harness.
+"""
+
+import random
+import uuid
+from http.cookies import SimpleCookie
+from typing import List, NamedTuple, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.responses import Response
+
+from async_crud_data import create_text_entry, user_login
+from reading_session import reading_sessions
+from session_manage import HTTPSSessionMiddleware, TrackedSession, session_token
+from text_store import text_hash
+from constants import READLY_SECRET_KEY
+
+# long enough for any benchmark run, short enough to clean up after itself
+SESSION_TTL = 6 * 60 * 60
+
+_WORDS = (
+    "the reader turns each page of the article into speech while the next sentences "
+    "are prefetched in the background so playback never waits for the network and "
+    "long paragraphs with several clauses test the chunk planner as much as short ones"
+).split()
+
+
+class BenchUser(NamedTuple):
+    sub: str
+    email: str
+    # the session cookie, for the HTTP endpoints
+    cookie: str
+    # what read.js puts in the socket url
+    token: str
+
+
+async def mint_session(sub: str, email: str, secret_key: str = READLY_SECRET_KEY) -> BenchUser:
+    """The cookie /auth sets after a google login, and the token /my_profile hands to read.js"""
+    middleware = HTTPSSessionMiddleware(None, secret_key=secret_key, max_age=SESSION_TTL)
+    response = Response()
+    await middleware.save_session(TrackedSession({"user": {"sub": sub, "email": email, "name": sub}}), response)
+    cookie = SimpleCookie(response.headers["set-cookie"])["session"].value
+    return BenchUser(sub, email, cookie, session_token(cookie))
+
+
+async def register_user(db: AsyncEngine, idx: int, run_id: str) -> BenchUser:
+    sub = f"bench-{run_id}-{idx}"
+    user = await mint_session(sub, f"{sub}@bench.readly")
+    await user_login(db, sub, user.email, sub)
+    return user
+
+
+def bench_sentences(num: int, nonce: str, rng: random.Random) -> List[str]:
+    """
+    Sentences of article-like length, 40 to 250 characters
+    the nonce keeps them apart from the audio cache of earlier runs
+    """
+    sentences = []
+    for idx in range(num):
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(8, 40))]
+        sentences.append(f"{' '.join(words).capitalize()} {nonce}-{idx}.")
+    return sentences
+
+
+async def register_text(
+    db: AsyncEngine,
+    user: BenchUser,
+    num_sentences: int,
+    nonce: str,
+    rng: random.Random,
+) -> Tuple[str, List[str]]:
+    text_id = f"bench-{uuid.uuid4().hex[:12]}"
+    sentences = bench_sentences(num_sentences, nonce, rng)
+    full_text = " ".join(sentences)
+    spans, start = [], 0
+    for sentence in sentences:
+        spans.append((start, start + len(sentence)))
+        start += len(sentence) + 1
+    await create_text_entry(db, text_id, user.sub, full_text, "https://bench.readly/")
+    await reading_sessions.save(text_id, user.sub, sentences, text_hash=text_hash(full_text), spans=spans)
+    return text_id, sentences
@@ -0,0 +1,334 @@
+"""
+Load generator for the `/speak` socket
+
+Every simulated reader behaves like `read.js`:
+hello (binary frames), then for each sentence it plays, speak events for the sentence
+and the next `--buffer` ones it does not have yet, a retry after `--retry-ms`,
+"playing" the clip for as long as it would take to read it out, and now and then a seek.
+
+    python -m bench.fake_deepgram &
+    READLY_SPEAK_URL=http://localhost:8100/v1/speak READLY_TTS_HTTP2=0 uvicorn app:app --port 8000 &
+    python -m bench.load --connections 200 --server-pid $(pgrep -f "uvicorn app:app") --save run.json
+
+Reported
+* time to first audio frame / to the whole clip, from the speak event
+* stall, how long the reader waited on the sentence it wanted to play
+* answered speak events per second
+* server memory per open connection, from /proc (linux), with --server-pid
+
+`--baseline old.json` compares against an earlier `--save`, and exits 1 on a regression.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import websockets
+
+from audio_frames import unpack_frame
+from bench.fixtures import register_text, register_user
+from sql_data import build_async_engine
+
+# mirrors readly-chrome/js/constants.js
+BUFFER_SENTENCES = 2
+TRANSMISSION_RETRY_TIME = 3000
+
+# (report key, higher is worse) the numbers compared against a baseline
+WATCHED = (
+    ("first_audio_ms.p95", True),
+    ("first_audio_ms.p99", True),
+    ("stall_ms.p95", True),
+    ("events_per_sec", False),
+)
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class Stats:
+    def __init__(self):
+        self.first_audio_ms: List[float] = []
+        self.complete_ms: List[float] = []
+        self.stall_ms: List[float] = []
+        self.answered = 0
+        self.sent = 0
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.open_sockets = 0
+
+
+class Reader:
+    """One simulated read.js tab"""
+
+    def __init__(self, args: argparse.Namespace, stats: Stats, rng: random.Random):
+        self.args = args
+        self.stats = stats
+        self.rng = rng
+        # play_idx => time of the last speak event, first frame, whole clip
+        self.sent_at: Dict[int, float] = {}
+        self.first_at: Dict[int, float] = {}
+        self.ready: Dict[int, asyncio.Event] = defaultdict(asyncio.Event)
+
+    async def receive(self, ws) -> None:
+        async for message in ws:
+            now = time.perf_counter()
+            if isinstance(message, bytes):
+                frame = unpack_frame(message)
+                idx = frame.play_idx
+                if idx not in self.first_at and idx in self.sent_at:
+                    self.first_at[idx] = now
+                    self.stats.first_audio_ms.append((now - self.sent_at[idx]) * 1000)
+                if frame.is_end and not self.ready[idx].is_set():
+                    self.stats.complete_ms.append((now - self.sent_at[idx]) * 1000)
+                    self.stats.answered += 1
+                    self.ready[idx].set()
+                continue
+            data = json.loads(message)
+            if data.get("event_type") == "audio_error":
+                self.stats.errors[data.get("error", "audio_error")] += 1
+                # read.js forgets the transmission, the next pass asks again
+                self.sent_at.pop(data["play_idx"], None)
+            elif data.get("event_type") == "throttled":
+                self.stats.errors[f"throttled_{data.get('reason')}"] += 1
+                self.sent_at.pop(data["play_idx"], None)
+            elif data.get("event_type") == "authentication_error":
+                self.stats.errors["authentication_error"] += 1
+
+    async def speak(self, ws, text_id: str, play_idx: int, current_idx: int) -> None:
+        last = self.sent_at.get(play_idx)
+        now = time.perf_counter()
+        if self.ready[play_idx].is_set():
+            return
+        if last is not None and (now - last) * 1000 < self.args.retry_ms:
+            return
+        self.sent_at[play_idx] = now
+        self.first_at.pop(play_idx, None)
+        self.stats.sent += 1
+        await ws.send(
+            json.dumps(
+                {
+                    "event_type": "speak",
+                    "text_id": text_id,
+                    "speed": 1.0,
+                    "play_idx": play_idx,
+                    "stream": not self.args.no_stream,
+                    "current_idx": current_idx,
+                }
+            )
+        )
+
+    async def run(self, url: str, text_id: str, sentence_lengths: List[int]) -> None:
+        args = self.args
+        num_sentences = len(sentence_lengths)
+        async with websockets.connect(url, max_size=None) as ws:
+            self.stats.open_sockets += 1
+            receiver = asyncio.create_task(self.receive(ws))
+            try:
+                await ws.send(json.dumps({"event_type": "hello", "protocol": "binary"}))
+                play_idx = 0
+                while play_idx < num_sentences:
+                    waiting_since = time.perf_counter()
+                    while not self.ready[play_idx].is_set():
+                        for idx in range(play_idx, min(num_sentences, play_idx + args.buffer)):
+                            await self.speak(ws, text_id, idx, play_idx)
+                        try:
+                            await asyncio.wait_for(self.ready[play_idx].wait(), timeout=args.retry_ms / 1000)
+                        except asyncio.TimeoutError:
+                            pass
+                    self.stats.stall_ms.append((time.perf_counter() - waiting_since) * 1000)
+                    # prefetch while "playing", like build_buffer_on_progress
+                    for idx in range(play_idx + 1, min(num_sentences, play_idx + args.buffer)):
+                        await self.speak(ws, text_id, idx, play_idx)
+                    await asyncio.sleep(sentence_lengths[play_idx] * args.ms_per_char / 1000 / args.speedup)
+
+                    if self.rng.random() < args.seek_rate:
+                        play_idx = self.rng.randrange(num_sentences)
+                        await ws.send(json.dumps({"event_type": "seek", "play_idx": play_idx}))
+                    else:
+                        play_idx += 1
+            finally:
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
+                self.stats.open_sockets -= 1
+
+
+async def sample_memory(pid: int, stats: Stats, samples: List[tuple]) -> None:
+    while True:
+        kb = rss_kb(pid)
+        if kb is not None:
+            samples.append((stats.open_sockets, kb))
+        await asyncio.sleep(0.5)
+
+
+async def run_load(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    run_id = uuid.uuid4().hex[:8]
+    # the same nonce every run with --warm-cache, so the clips come from the audio cache
+    nonce = "warm" if args.warm_cache else run_id
+    stats = Stats()
+
+    readers = []
+    tokens = set()
+    db = build_async_engine()
+    try:
+        for idx in range(args.connections):
+            user = await register_user(db, idx, run_id)
+            if user.token in tokens:
+                raise RuntimeError(f"two bench users share the token {user.token}, see session_manage.session_token")
+            tokens.add(user.token)
+            text_id, sentences = await register_text(
+                db, user, args.sentences, nonce, random.Random(f"{nonce}-{idx}")
+            )
+            url = f"{args.url}/speak?token={user.token}&sub={user.sub}"
+            lengths = [len(sentence) for sentence in sentences]
+            readers.append((Reader(args, stats, random.Random(rng.random())), url, text_id, lengths))
+    finally:
+        await db.dispose()
+
+    baseline_kb = rss_kb(args.server_pid) if args.server_pid else None
+    samples: List[tuple] = []
+    sampler = asyncio.create_task(sample_memory(args.server_pid, stats, samples)) if args.server_pid else None
+
+    async def start(delay: float, reader: Reader, url: str, text_id: str, lengths: List[int]) -> None:
+        await asyncio.sleep(delay)
+        try:
+            await reader.run(url, text_id, lengths)
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            stats.errors[type(e).__name__] += 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(
+        *(
+            start(args.ramp_s * idx / max(1, args.connections), reader, url, text_id, lengths)
+            for idx, (reader, url, text_id, lengths) in enumerate(readers)
+        )
+    )
+    elapsed = time.perf_counter() - start_time
+    if sampler is not None:
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+
+    report = {
+        "connections": args.connections,
+        "sentences": args.sentences,
+        "stream": not args.no_stream,
+        "warm_cache": args.warm_cache,
+        "elapsed_s": elapsed,
+        "speak_sent": stats.sent,
+        "speak_answered": stats.answered,
+        "events_per_sec": stats.answered / elapsed if elapsed else 0.0,
+        "errors": dict(stats.errors),
+        "first_audio_ms": summarize(stats.first_audio_ms),
+        "complete_ms": summarize(stats.complete_ms),
+        "stall_ms": summarize(stats.stall_ms),
+    }
+    if baseline_kb is not None and samples:
+        open_sockets, peak_kb = max(samples, key=lambda sample: sample[1])
+        report["server_rss_kb"] = {"baseline": baseline_kb, "peak": peak_kb}
+        report["kb_per_connection"] = (peak_kb - baseline_kb) / max(1, open_sockets)
+    return report
+
+
+def lookup(report: dict, key: str) -> Optional[float]:
+    value = report
+    for part in key.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def regressions(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    found = []
+    for key, higher_is_worse in WATCHED:
+        new, old = lookup(report, key), lookup(baseline, key)
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        if (change > tolerance) if higher_is_worse else (change < -tolerance):
+            found.append(f"{key}: {old:.1f} -> {new:.1f} ({change:+.0%})")
+    return found
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['connections']} connections x {report['sentences']} sentences in {report['elapsed_s']:.1f}s")
+    print(f"speak events: {report['speak_answered']} / {report['speak_sent']}, {report['events_per_sec']:.1f}/s")
+    for key in ("first_audio_ms", "complete_ms", "stall_ms"):
+        summary = report[key]
+        if summary["count"]:
+            print(
+                f"{key:>15}: p50 {summary['p50']:.0f}  p95 {summary['p95']:.0f}  "
+                f"p99 {summary['p99']:.0f}  max {summary['max']:.0f}"
+            )
+    if "kb_per_connection" in report:
+        print(f"server memory: {report['kb_per_connection']:.0f} KB per connection")
+    if report["errors"]:
+        print(f"errors: {report['errors']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="ws://localhost:8000")
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--sentences", type=int, default=20, help="sentences read per connection")
+    parser.add_argument("--ramp-s", type=float, default=5.0, help="spread the connects over this many seconds")
+    parser.add_argument("--buffer", type=int, default=BUFFER_SENTENCES)
+    parser.add_argument("--retry-ms", type=float, default=TRANSMISSION_RETRY_TIME)
+    parser.add_argument("--ms-per-char", type=float, default=65.0, help="reading speed of the playback")
+    parser.add_argument("--speedup", type=float, default=10.0, help="play the clips this much faster")
+    parser.add_argument("--seek-rate", type=float, default=0.05)
+    parser.add_argument("--no-stream", action="store_true", help="whole clips, not streamed frames")
+    parser.add_argument("--warm-cache", action="store_true", help="reuse the texts of earlier runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--server-pid", type=int, default=None)
+    parser.add_argument("--save", default=None, help="write the report as json")
+    parser.add_argument("--baseline", default=None, help="an earlier --save to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load(args))
+    print_report(report)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
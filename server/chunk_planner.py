@@ -0,0 +1,108 @@
+"""
+Adaptive chunking of the segmented text into synthesis units
+
+Every unit is one deepgram call, so
+* fragments like "Yes." or headings are merged with their neighbours,
+* run-on sentences are split at a clause / word boundary,
+keeping the units within a target character range.
+
+Each unit remembers the sentences it covers, for the highlighting in the reader.
+"""
+
+import re
+from typing import List, NamedTuple, Tuple
+
+from segmentation import Sentence, segmentation_engine
+from metrics import SEGMENTATION_TIME, observe, route_var
+from constants import CHUNK_MIN_CHARS, CHUNK_MAX_CHARS
+
+# preferred places to split a long sentence, after a clause, then between words
+_clause_break = re.compile(r"[,;:—)]\s+")
+_word_break = re.compile(r"\s+")
+
+
+class Unit(NamedTuple):
+    text: str
+    # character offsets into the full text
+    start: int
+    end: int
+    # indices of the sentences this unit covers
+    sentences: Tuple[int, ...]
+
+
+def _best_break(text: str, start: int, end: int, min_chars: int, max_chars: int) -> int:
+    """Offset to cut text[start:end] at, the last clause break, else the last word break"""
+    window_start = start + min_chars
+    window_end = min(end, start + max_chars)
+    for pattern in (_clause_break, _word_break):
+        cut = None
+        for match in pattern.finditer(text, window_start, window_end):
+            cut = match.end()
+        if cut is not None:
+            return cut
+    return window_end
+
+
+def split_long(
+    text: str,
+    sentence: Sentence,
+    min_chars: int = CHUNK_MIN_CHARS,
+    max_chars: int = CHUNK_MAX_CHARS,
+) -> List[Tuple[int, int]]:
+    """Spans of a sentence, none longer than max_chars"""
+    spans = []
+    start, end = sentence.start, sentence.end
+    while end - start > max_chars:
+        cut = _best_break(text, start, end, min_chars, max_chars)
+        spans.append((start, cut))
+        start = cut
+    spans.append((start, end))
+    return spans
+
+
+def plan_units(
+    text: str,
+    sentences: List[Sentence],
+    min_chars: int = CHUNK_MIN_CHARS,
+    max_chars: int = CHUNK_MAX_CHARS,
+) -> List[Unit]:
+    """
+    Group / split the sentences of text into synthesis units
+    """
+    pieces: List[Tuple[int, int, int]] = []
+    for idx, sentence in enumerate(sentences):
+        for start, end in split_long(text, sentence, min_chars, max_chars):
+            pieces.append((start, end, idx))
+
+    units: List[Unit] = []
+    for start, end, idx in pieces:
+        if units:
+            last = units[-1]
+            too_short = (last.end - last.start) < min_chars or (end - start) < min_chars
+            if too_short and end - last.start <= max_chars:
+                covered = last.sentences if last.sentences[-1] == idx else last.sentences + (idx,)
+                units[-1] = Unit(text[last.start : end], last.start, end, covered)
+                continue
+        units.append(Unit(text[start:end], start, end, (idx,)))
+
+    return [_strip(unit) for unit in units if unit.text.strip()]
+
+
+def _strip(unit: Unit) -> Unit:
+    """Trim the whitespace around a unit, its offsets follow"""
+    leading = len(unit.text) - len(unit.text.lstrip())
+    trailing = len(unit.text) - len(unit.text.rstrip())
+    return unit._replace(
+        text=unit.text.strip(),
+        start=unit.start + leading,
+        end=unit.end - trailing,
+    )
+
+
+async def plan_reading(text: str) -> Tuple[List[Sentence], List[Unit]]:
+    """
+    Segment the text, then plan its synthesis units
+    """
+    with observe(SEGMENTATION_TIME, route=route_var.get()):
+        sentences = await segmentation_engine.segment(text)
+        return sentences, plan_units(text, sentences)
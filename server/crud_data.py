@@ -1,9 +1,11 @@
 from datetime import datetime
-from typing import Union, Optional
+from typing import Any, Dict, List, Union, Optional
 from sqlalchemy.orm import Session
 from sqlalchemy.engine import Engine
-from sqlalchemy import func
-from sql_data import TextEntry, User, TTSRequest, UsageStatistic
+from sqlalchemy import func, insert
+from sql_data import TextEntry, User, TTSRequest, UsageStatistic, text_blob_insert
+from text_store import blob_values
+from usage import usage_deltas, usage_upsert
 
 
 def engine_to_session(func):
@@ -32,11 +34,14 @@ def create_text_entry(
 ) -> TextEntry:
     """
     Create a new text entry in the database
+    the text goes to text_blobs, stored once however many entries share it
     """
+    values = blob_values(full_text)
+    db.execute(text_blob_insert(values))
     text_entry = TextEntry(
         text_id=text_id,
         user_sub=user_sub,
-        full_text=full_text,
+        text_hash=values["hash"],
         url=url,
     )
     db.add(text_entry)
@@ -138,7 +143,7 @@ def create_tts_request(
     db: Union[Session, Engine],
     text_entry_id: str,
     user_sub: str,
-    sentence_text: str,
+    sentence_text: Optional[str],
     sentence_index: int,
     audio_id: str,
     character_count: int,
@@ -146,6 +151,10 @@ def create_tts_request(
     voice_model: str = "aura-asteria-en",
     status: str = "completed",
     error_message: Optional[str] = None,
+    cache_status: Optional[str] = None,
+    text_hash: Optional[str] = None,
+    char_start: Optional[int] = None,
+    char_end: Optional[int] = None,
 ) -> TTSRequest:
     """Create a new TTS request record"""
     tts_request = TTSRequest(
@@ -159,15 +168,36 @@ def create_tts_request(
         voice_model=voice_model,
         status=status,
         error_message=error_message,
+        cache_status=cache_status,
+        text_hash=text_hash,
+        char_start=char_start,
+        char_end=char_end,
         created_by=user_sub,
         updated_by=user_sub,
     )
     db.add(tts_request)
+    db.flush()
+    usage = dict(user_sub=user_sub, character_count=character_count, processing_time_ms=processing_time_ms)
+    db.execute(usage_upsert(usage_deltas([usage])))
     db.commit()
     db.refresh(tts_request)
     return tts_request
 
 
+@engine_to_session
+def create_tts_requests(db: Union[Session, Engine], rows: List[Dict[str, Any]]) -> int:
+    """
+    Bulk insert TTS request records, one multi-row INSERT, no refresh
+    Each row has the column values of TTSRequest
+    """
+    if not rows:
+        return 0
+    db.execute(insert(TTSRequest), rows)
+    db.execute(usage_upsert(usage_deltas(rows)))
+    db.commit()
+    return len(rows)
+
+
 @engine_to_session
 def get_tts_request(db: Union[Session, Engine], audio_id: str) -> Optional[TTSRequest]:
     """Get a TTS request by its audio ID"""
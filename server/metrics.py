@@ -0,0 +1,142 @@
+"""
+Prometheus metrics, served at `/metrics`
+
+The hot paths are labelled by `route`, where the work came from
+(`/speak`, `/sentence_measure`, `prewarm` ...), and by `voice` where there is one.
+The route travels in a context variable, so deep code like the deepgram provider
+does not need it threaded through every call.
+
+With several uvicorn workers, point `PROMETHEUS_MULTIPROC_DIR` at an empty directory,
+`/metrics` then aggregates the numbers of all the workers.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# where the work on this task came from
+route_var: ContextVar[str] = ContextVar("route", default="other")
+
+# deepgram answers in a few hundred ms, a long sentence can take seconds
+_TTS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0)
+# in process work, segmentation / db writes / socket sends
+_FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+TTS_LATENCY = Histogram(
+    "readly_tts_latency_seconds",
+    "Deepgram synthesis latency per attempt, to the last byte",
+    ["voice", "route", "mode"],
+    buckets=_TTS_BUCKETS,
+)
+TTS_FIRST_BYTE = Histogram(
+    "readly_tts_first_byte_seconds",
+    "Deepgram streaming latency to the first audio chunk",
+    ["voice", "route"],
+    buckets=_TTS_BUCKETS,
+)
+SEGMENTATION_TIME = Histogram(
+    "readly_segmentation_seconds",
+    "Segmentation and chunk planning time of a text",
+    ["route"],
+    buckets=_FAST_BUCKETS,
+)
+DB_WRITE_TIME = Histogram(
+    "readly_db_write_seconds",
+    "Time of one database write (a telemetry batch is one write)",
+    ["route", "table"],
+    buckets=_FAST_BUCKETS,
+)
+TELEMETRY_FLUSH_TIME = Histogram(
+    "readly_telemetry_flush_seconds",
+    "Time to flush the buffered tts requests, the split retries of a failed batch included",
+    buckets=_FAST_BUCKETS,
+)
+WS_SEND_TIME = Histogram(
+    "readly_ws_send_seconds",
+    "Time to send one websocket message, including the wait for the send lock",
+    ["route", "kind"],
+    buckets=_FAST_BUCKETS,
+)
+
+CACHE_REQUESTS = Counter(
+    "readly_audio_cache_requests_total",
+    "Speak requests by where their audio came from: hit, miss or coalesced",
+    ["voice", "route", "status"],
+)
+THROTTLED = Counter(
+    "readly_throttled_total",
+    "Requests refused by the per-user rate limits",
+    ["route", "reason"],
+)
+TELEMETRY_DROPPED = Counter(
+    "readly_telemetry_dropped_total",
+    "Buffered tts requests dropped unwritten, the buffer was full",
+)
+ERRORS = Counter(
+    "readly_errors_total",
+    "Failures on the hot paths, by exception type",
+    ["voice", "route", "error"],
+)
+
+OPEN_SOCKETS = Gauge(
+    "readly_open_sockets",
+    "Open websocket connections",
+    ["route"],
+    multiprocess_mode="livesum",
+)
+INFLIGHT_SYNTHESES = Gauge(
+    "readly_inflight_syntheses",
+    "Deepgram calls in progress",
+    ["voice", "route"],
+    multiprocess_mode="livesum",
+)
+
+TELEMETRY_QUEUE_DEPTH = Gauge(
+    "readly_telemetry_queue_depth",
+    "Tts requests buffered, waiting for the next flush",
+    multiprocess_mode="livesum",
+)
+
+
+@contextmanager
+def observe(histogram: Histogram, **labels: str) -> Iterator[None]:
+    """Time the block into histogram, failed blocks included"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(time.perf_counter() - start_time)
+
+
+@contextmanager
+def inflight(voice: str) -> Iterator[None]:
+    gauge = INFLIGHT_SYNTHESES.labels(voice=voice, route=route_var.get())
+    gauge.inc()
+    try:
+        yield
+    finally:
+        gauge.dec()
+
+
+def count_error(error: BaseException, voice: str = "") -> None:
+    ERRORS.labels(voice=voice, route=route_var.get(), error=type(error).__name__).inc()
+
+
+def render_metrics() -> bytes:
+    """The exposition text, across all the workers in multiprocess mode"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
@@ -0,0 +1,136 @@
+"""
+Move the stored texts to text_blobs
+
+    python migrate_text_blobs.py [--batch-size 200] [--dry-run]
+
+1. every text_entries.full_text goes to text_blobs (once per distinct text),
+   the entry keeps its text_hash, full_text is cleared
+2. every tts_requests.sentence_text found in its entry's text is replaced by
+   (text_hash, char_start, char_end), sentences that cannot be located stay verbatim
+
+Each batch is its own transaction, the script can be stopped and run again,
+it only picks up the rows not moved yet.
+Run `VACUUM FULL text_entries, tts_requests` afterwards to give the space back to the OS.
+"""
+
+import argparse
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from sql_data import TextBlob, TextEntry, TTSRequest, blob_text, build_engine, text_blob_insert
+from text_store import blob_values
+
+
+def migrate_entries(db: Session, batch_size: int, dry_run: bool) -> int:
+    entries = db.execute(
+        select(TextEntry.text_id, TextEntry.full_text)
+        .where(TextEntry.text_hash.is_(None), TextEntry.full_text.is_not(None))
+        .order_by(TextEntry.text_id)
+        .limit(batch_size)
+    ).all()
+    for text_id, full_text in entries:
+        values = blob_values(full_text)
+        db.execute(text_blob_insert(values))
+        db.execute(
+            update(TextEntry)
+            .where(TextEntry.text_id == text_id)
+            .values(text_hash=values["hash"], full_text=None)
+        )
+    if dry_run:
+        db.rollback()
+    else:
+        db.commit()
+    return len(entries)
+
+
+def locate(text: str, sentence: str, hint: int) -> Optional[Tuple[int, int]]:
+    """Offsets of sentence in text, the first occurrence from hint on, else from the start"""
+    start = text.find(sentence, hint)
+    if start < 0:
+        start = text.find(sentence)
+    if start < 0:
+        return None
+    return start, start + len(sentence)
+
+
+def migrate_requests(db: Session, batch_size: int, dry_run: bool, after_id: int) -> Tuple[int, int, int]:
+    """
+    One batch of tts_requests after after_id
+    Returns the rows looked at, the rows moved, the last id
+    """
+    rows = db.execute(
+        select(TTSRequest.id, TTSRequest.sentence_text, TTSRequest.sentence_index, TextEntry.text_hash)
+        .join(TextEntry, TTSRequest.text_entry_id == TextEntry.text_id)
+        .where(
+            TTSRequest.id > after_id,
+            TTSRequest.text_hash.is_(None),
+            TTSRequest.sentence_text.is_not(None),
+            TextEntry.text_hash.is_not(None),
+        )
+        .order_by(TTSRequest.id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return 0, 0, after_id
+
+    texts: Dict[str, str] = {}
+    for text_hash in {row.text_hash for row in rows}:
+        texts[text_hash] = blob_text(db.get(TextBlob, text_hash))
+
+    moved = 0
+    # a sentence that appears twice in a text is looked for after the previous sentence
+    previous: Optional[Tuple[str, int, Tuple[int, int]]] = None
+    for row in sorted(rows, key=lambda row: (row.text_hash, row.sentence_index)):
+        hint = 0
+        if previous is not None and previous[0] == row.text_hash:
+            hint = previous[2][0] if previous[1] == row.sentence_index else previous[2][1]
+        span = locate(texts[row.text_hash], row.sentence_text, hint)
+        if span is None:
+            continue
+        previous = (row.text_hash, row.sentence_index, span)
+        db.execute(
+            update(TTSRequest)
+            .where(TTSRequest.id == row.id)
+            .values(text_hash=row.text_hash, char_start=span[0], char_end=span[1], sentence_text=None)
+        )
+        moved += 1
+    if dry_run:
+        db.rollback()
+    else:
+        db.commit()
+    return len(rows), moved, rows[-1].id
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--dry-run", action="store_true", help="roll every batch back")
+    args = parser.parse_args()
+
+    engine, init_db, _ = build_engine()
+    # text_blobs and the new columns
+    init_db()
+
+    with Session(engine) as db:
+        entries = 0
+        while True:
+            count = migrate_entries(db, args.batch_size, args.dry_run)
+            entries += count
+            if count < args.batch_size or args.dry_run:
+                break
+        print(f"text entries moved to text_blobs: {entries}")
+
+        seen, moved, after_id = 0, 0, 0
+        while True:
+            count, batch_moved, after_id = migrate_requests(db, args.batch_size, args.dry_run, after_id)
+            seen += count
+            moved += batch_moved
+            if count < args.batch_size:
+                break
+        print(f"tts requests pointed into text_blobs: {moved} / {seen}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Precompute on ingest
+
+When a text entry is created, a background job segments it,
+stores the reading session and synthesizes the first few sentences into the audio cache,
+so by the time `read.html` opens the socket, the first clips are already there.
+
+Jobs run on a bounded pool of worker tasks, with a cap on the pending jobs per user,
+one user saving many pages cannot starve everybody else's prewarm.
+Each sentence is charged to the user's rate limits and recorded in tts_requests like a speak event,
+a prewarm the limits refuse stops there, the reader synthesizes the rest on demand.
+"""
+
+import asyncio
+import time
+from collections import defaultdict
+from traceback import format_exc
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from logger import logger
+from audio_cache import cached_to_speech
+from reading_session import reading_sessions
+from chunk_planner import plan_reading
+from text_store import text_hash
+from rate_limit import rate_limiter
+from telemetry import TTSRequestWriter
+from metrics import THROTTLED, count_error, route_var
+from constants import (
+    PREWARM_WORKERS,
+    PREWARM_QUEUE_SIZE,
+    PREWARM_SENTENCES,
+    PREWARM_PER_USER,
+)
+
+# tts_requests.status of a sentence synthesized ahead of the reader, "completed" is a speak event
+PREWARM_REQUEST_STATUS = "prewarmed"
+
+
+class PrewarmJob(NamedTuple):
+    text_id: str
+    user_sub: str
+    full_text: str
+
+
+class PrewarmQueue:
+    def __init__(
+        self,
+        workers: int = PREWARM_WORKERS,
+        queue_size: int = PREWARM_QUEUE_SIZE,
+        num_sentences: int = PREWARM_SENTENCES,
+        per_user: int = PREWARM_PER_USER,
+    ):
+        self.num_workers = workers
+        self.num_sentences = num_sentences
+        self.per_user = per_user
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # user_sub => queued or running jobs
+        self.user_jobs: Dict[str, int] = defaultdict(int)
+        self.workers: List[asyncio.Task] = []
+        # the syntheses are recorded in tts_requests like the speak events, set by start()
+        self.writer: Optional[TTSRequestWriter] = None
+
+    def submit(self, text_id: str, user_sub: str, full_text: str) -> bool:
+        """
+        Queue the prewarm job, never waits
+        Returns False when the job is skipped (queue full, or the user has too many pending)
+        the reader still works then, just without the head start
+        """
+        if self.user_jobs.get(user_sub, 0) >= self.per_user:
+            logger.info(f"[PREWARM] skip {text_id}, {user_sub} has {self.per_user} jobs pending")
+            return False
+        try:
+            self.queue.put_nowait(PrewarmJob(text_id, user_sub, full_text))
+        except asyncio.QueueFull:
+            logger.info(f"[PREWARM] skip {text_id}, queue is full")
+            return False
+        self.user_jobs[user_sub] += 1
+        return True
+
+    async def run_job(self, job: PrewarmJob) -> None:
+        route_var.set("prewarm")
+        _, units = await plan_reading(job.full_text)
+        sentences = [unit.text for unit in units]
+        session = await reading_sessions.save(
+            job.text_id,
+            job.user_sub,
+            sentences,
+            text_hash=text_hash(job.full_text),
+            spans=[(unit.start, unit.end) for unit in units],
+        )
+        num_sentences = min(len(sentences), self.num_sentences)
+        for idx in range(num_sentences):
+            # where the sentence sits in the stored text, the request row points there
+            text_ref = (session.text_hash, *session.spans[idx])
+            if not await self.synthesize(job, idx, sentences[idx], text_ref):
+                logger.info(f"[PREWARM] {job.text_id}: rate limited after {idx} sentences")
+                return
+        logger.info(f"[PREWARM] {job.text_id}: {num_sentences} sentences ready")
+
+    def record(
+        self,
+        job: PrewarmJob,
+        idx: int,
+        text_ref: Tuple[str, int, int],
+        start_time: float,
+        status: str,
+        error_message: Optional[str] = None,
+        cache_status: Optional[str] = None,
+    ) -> None:
+        if self.writer is None:
+            return
+        stored_hash, char_start, char_end = text_ref
+        self.writer.record(
+            text_entry_id=job.text_id,
+            user_sub=job.user_sub,
+            sentence_text=None,
+            text_hash=stored_hash,
+            char_start=char_start,
+            char_end=char_end,
+            sentence_index=idx,
+            audio_id=f"{job.text_id}-{idx:03d}",
+            character_count=char_end - char_start,
+            processing_time_ms=int((time.time() - start_time) * 1000),
+            status=status,
+            error_message=error_message,
+            cache_status=cache_status,
+        )
+
+    async def synthesize(self, job: PrewarmJob, idx: int, sentence_text: str, text_ref: Tuple[str, int, int]) -> bool:
+        """
+        One sentence into the audio cache, charged to the user exactly like a speak event
+        False when the limits refuse it, a prewarm never waits for them
+        """
+        async with rate_limiter.synthesis_slot(job.user_sub) as decision:
+            if decision.allowed:
+                decision = await rate_limiter.admit_speak(job.user_sub, len(sentence_text))
+            if not decision.allowed:
+                THROTTLED.labels(route="prewarm", reason=decision.reason).inc()
+                return False
+            start_time = time.time()
+            try:
+                _, cache_status = await cached_to_speech(sentence_text)
+            except Exception as e:
+                self.record(job, idx, text_ref, start_time, "failed", error_message=repr(e))
+                raise
+            logger.debug(f"[PREWARM] {job.text_id}: {cache_status}")
+            self.record(job, idx, text_ref, start_time, PREWARM_REQUEST_STATUS, cache_status=cache_status)
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                count_error(e)
+                logger.error(f"[PREWARM] {job.text_id} failed: {str(e)}")
+                logger.debug(f"[PREWARM] Traceback: {format_exc()}")
+            finally:
+                self.user_jobs[job.user_sub] -= 1
+                if self.user_jobs[job.user_sub] <= 0:
+                    del self.user_jobs[job.user_sub]
+                self.queue.task_done()
+
+    def start(self, writer: TTSRequestWriter) -> None:
+        self.writer = writer
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._work()) for _ in range(self.num_workers)]
+
+    async def close(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+
+prewarm_queue = PrewarmQueue()
@@ -0,0 +1,216 @@
+"""
+Per-user admission control
+
+* token buckets, in requests and in characters, keyed by the user's `sub`
+* a cap on the syntheses a user has in flight, across tabs and workers
+
+The state lives in redis, updated by lua scripts so check-and-take is atomic,
+and the clock is redis' own, the workers never disagree about the refill.
+When redis is unreachable, requests are let through, a limiter outage must not stop the reader.
+"""
+
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, NamedTuple, Tuple
+
+from redis.exceptions import RedisError
+
+from logger import logger
+from redis_cache import async_redis_client
+from constants import (
+    SPEAK_RATE_CAPACITY,
+    SPEAK_RATE_PER_SEC,
+    SPEAK_CHARS_CAPACITY,
+    SPEAK_CHARS_PER_SEC,
+    MEASURE_RATE_CAPACITY,
+    MEASURE_RATE_PER_SEC,
+    USER_SYNTHESIS_CONCURRENCY,
+    USER_SYNTHESIS_LEASE_MS,
+)
+
+# KEYS: one per bucket, ARGV: capacity, refill per ms, cost, for each bucket
+# takes from every bucket, or from none
+# returns {1, 0, 0} or {0, ms to wait, index of the bucket that ran out}
+_TAKE_TOKENS = """
+local now_t = redis.call("TIME")
+local now = tonumber(now_t[1]) * 1000 + math.floor(tonumber(now_t[2]) / 1000)
+local levels = {}
+local wait, blocked = 0, 0
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[3 * i - 2])
+    local rate = tonumber(ARGV[3 * i - 1])
+    local cost = tonumber(ARGV[3 * i])
+    local state = redis.call("HMGET", KEYS[i], "tokens", "ts")
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        local need = math.ceil((cost - tokens) / rate)
+        if need > wait then
+            wait, blocked = need, i
+        end
+    end
+end
+if blocked > 0 then
+    return {0, wait, blocked}
+end
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[3 * i - 2])
+    local rate = tonumber(ARGV[3 * i - 1])
+    redis.call("HSET", KEYS[i], "tokens", levels[i] - tonumber(ARGV[3 * i]), "ts", now)
+    redis.call("PEXPIRE", KEYS[i], math.ceil(capacity / rate) + 1000)
+end
+return {1, 0, 0}
+"""
+
+# KEYS: the user's lease set, ARGV: limit, lease ms, lease id
+_ACQUIRE_SLOT = """
+local now_t = redis.call("TIME")
+local now = tonumber(now_t[1]) * 1000 + math.floor(tonumber(now_t[2]) / 1000)
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now)
+if redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call("ZADD", KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+redis.call("PEXPIRE", KEYS[1], tonumber(ARGV[2]))
+return 1
+"""
+
+# KEYS: the lease set, ARGV: lease ms, lease id
+# extends a lease still held, 0 when it ran out
+_RENEW_SLOT = """
+local now_t = redis.call("TIME")
+local now = tonumber(now_t[1]) * 1000 + math.floor(tonumber(now_t[2]) / 1000)
+if not redis.call("ZSCORE", KEYS[1], ARGV[2]) then
+    return 0
+end
+redis.call("ZADD", KEYS[1], now + tonumber(ARGV[1]), ARGV[2])
+redis.call("PEXPIRE", KEYS[1], tonumber(ARGV[1]))
+return 1
+"""
+
+# a lease that cannot be had right now, ask again shortly
+SLOT_RETRY_MS = 500
+
+
+class Bucket(NamedTuple):
+    name: str
+    capacity: float
+    # refill, in tokens per second
+    rate: float
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    retry_after_ms: int = 0
+    # which limit was hit: the bucket name, or "concurrency"
+    reason: str = ""
+
+
+SPEAK_REQUESTS = Bucket("speak", SPEAK_RATE_CAPACITY, SPEAK_RATE_PER_SEC)
+SPEAK_CHARACTERS = Bucket("speak_chars", SPEAK_CHARS_CAPACITY, SPEAK_CHARS_PER_SEC)
+MEASURE_REQUESTS = Bucket("measure", MEASURE_RATE_CAPACITY, MEASURE_RATE_PER_SEC)
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        concurrency: int = USER_SYNTHESIS_CONCURRENCY,
+        lease_ms: int = USER_SYNTHESIS_LEASE_MS,
+    ):
+        self.concurrency = concurrency
+        self.lease_ms = lease_ms
+        self._take = async_redis_client.register_script(_TAKE_TOKENS)
+        self._acquire = async_redis_client.register_script(_ACQUIRE_SLOT)
+        self._renew = async_redis_client.register_script(_RENEW_SLOT)
+
+    @staticmethod
+    def bucket_key(user_sub: str, bucket: Bucket) -> str:
+        return f"ratelimit:{bucket.name}:{user_sub}"
+
+    @staticmethod
+    def slots_key(user_sub: str) -> str:
+        return f"ratelimit:inflight:{user_sub}"
+
+    @staticmethod
+    def renders_key(user_sub: str) -> str:
+        return f"ratelimit:renders:{user_sub}"
+
+    async def take(self, user_sub: str, costs: List[Tuple[Bucket, float]]) -> Decision:
+        """Take cost tokens from each bucket, all or nothing"""
+        keys, args = [], []
+        for bucket, cost in costs:
+            keys.append(self.bucket_key(user_sub, bucket))
+            # one request larger than the whole burst still goes through, on a full bucket
+            args += [bucket.capacity, bucket.rate / 1000, min(cost, bucket.capacity)]
+        try:
+            allowed, wait_ms, blocked = await self._take(keys=keys, args=args)
+        except RedisError as e:
+            logger.warning(f"[RATE LIMIT] redis unavailable, letting {user_sub} through: {e}")
+            return Decision(True)
+        if allowed:
+            return Decision(True)
+        return Decision(False, int(wait_ms), costs[int(blocked) - 1][0].name)
+
+    async def admit_speak(self, user_sub: str, num_characters: int) -> Decision:
+        return await self.take(user_sub, [(SPEAK_REQUESTS, 1), (SPEAK_CHARACTERS, num_characters)])
+
+    async def admit_measure(self, user_sub: str) -> Decision:
+        return await self.take(user_sub, [(MEASURE_REQUESTS, 1)])
+
+    async def acquire_lease(self, key: str, limit: int, lease_ms: int, lease: str) -> bool:
+        """
+        One of limit leases in the set at key, held for lease_ms unless renewed
+        for long jobs, a render holds one of the user's render leases while it is queued or running
+        """
+        try:
+            return bool(await self._acquire(keys=[key], args=[limit, lease_ms, lease]))
+        except RedisError as e:
+            logger.warning(f"[RATE LIMIT] redis unavailable, no cap on {key}: {e}")
+            return True
+
+    async def renew_lease(self, key: str, lease_ms: int, lease: str) -> bool:
+        try:
+            return bool(await self._renew(keys=[key], args=[lease_ms, lease]))
+        except RedisError as e:
+            logger.warning(f"[RATE LIMIT] failed to renew a lease on {key}: {e}")
+            return False
+
+    async def release_lease(self, key: str, lease: str) -> None:
+        try:
+            await async_redis_client.zrem(key, lease)
+        except RedisError as e:
+            # the lease runs out by itself
+            logger.warning(f"[RATE LIMIT] failed to release a lease on {key}: {e}")
+
+    @asynccontextmanager
+    async def synthesis_slot(self, user_sub: str) -> AsyncIterator[Decision]:
+        """
+        Hold one of the user's concurrent synthesis slots for the block
+        yields a refused Decision when all of them are taken, the block must check
+        """
+        lease = uuid.uuid4().hex
+        key = self.slots_key(user_sub)
+        try:
+            acquired = await self._acquire(keys=[key], args=[self.concurrency, self.lease_ms, lease])
+        except RedisError as e:
+            logger.warning(f"[RATE LIMIT] redis unavailable, no concurrency cap for {user_sub}: {e}")
+            acquired = None
+        if acquired is None:
+            yield Decision(True)
+            return
+        if not acquired:
+            yield Decision(False, SLOT_RETRY_MS, "concurrency")
+            return
+        try:
+            yield Decision(True)
+        finally:
+            try:
+                await async_redis_client.zrem(key, lease)
+            except RedisError as e:
+                # the lease runs out by itself
+                logger.warning(f"[RATE LIMIT] failed to release a slot of {user_sub}: {e}")
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,105 @@
+"""
+Server side reading sessions
+
+`/sentence_measure/` stores the segmented sentences of a text_id here,
+speak events then only carry `text_id` and `play_idx`,
+instead of re-uploading the whole sentence list for every sentence played.
+
+A small in-process LRU sits in front of redis, redis shares the sessions across workers.
+Without redis a worker gets by on its LRU, a session it does not have
+is planned again from the database (app.get_reading_session).
+"""
+
+import json
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+from redis.exceptions import RedisError
+
+from logger import logger
+from redis_cache import async_redis_client
+from constants import READING_SESSION_TTL, READING_SESSION_MEMORY_SIZE
+
+
+class ReadingSession(NamedTuple):
+    text_id: str
+    user_sub: str
+    sentences: List[str]
+    # the stored text (text_blobs) and where each sentence sits in it,
+    # None for texts that are not stored, the sentences are recorded verbatim then
+    text_hash: Optional[str] = None
+    spans: Optional[List[Tuple[int, int]]] = None
+
+
+class ReadingSessionStore:
+    def __init__(
+        self,
+        ttl: int = READING_SESSION_TTL,
+        memory_size: int = READING_SESSION_MEMORY_SIZE,
+    ):
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self._memory: "OrderedDict[str, ReadingSession]" = OrderedDict()
+
+    @staticmethod
+    def redis_key(text_id: str) -> str:
+        return f"reading:{text_id}"
+
+    def _remember(self, session: ReadingSession) -> None:
+        self._memory[session.text_id] = session
+        self._memory.move_to_end(session.text_id)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    async def save(
+        self,
+        text_id: str,
+        user_sub: str,
+        sentences: List[str],
+        text_hash: Optional[str] = None,
+        spans: Optional[List[Tuple[int, int]]] = None,
+    ) -> ReadingSession:
+        session = ReadingSession(text_id, user_sub, sentences, text_hash, spans)
+        self._remember(session)
+        try:
+            await async_redis_client.set(
+                self.redis_key(text_id),
+                json.dumps({"user_sub": user_sub, "sentences": sentences, "text_hash": text_hash, "spans": spans}),
+                ex=self.ttl,
+            )
+        except RedisError as e:
+            # this worker still has it, the others plan it again
+            logger.warning(f"[READING] failed to share the session of {text_id}: {e}")
+        return session
+
+    async def get(self, text_id: str) -> Optional[ReadingSession]:
+        session = self._memory.get(text_id)
+        if session is not None:
+            self._memory.move_to_end(text_id)
+            return session
+
+        try:
+            res = await async_redis_client.get(self.redis_key(text_id))
+        except RedisError as e:
+            logger.warning(f"[READING] redis unavailable, no session for {text_id}: {e}")
+            return None
+        if res is None:
+            return None
+        try:
+            data = json.loads(res)
+            spans = data.get("spans")
+            session = ReadingSession(
+                text_id,
+                data["user_sub"],
+                data["sentences"],
+                data.get("text_hash"),
+                [tuple(span) for span in spans] if spans is not None else None,
+            )
+        except (ValueError, KeyError) as e:
+            logger.warning(f"[READING] broken session for {text_id}: {e}")
+            return None
+        self._remember(session)
+        return session
+
+
+reading_sessions = ReadingSessionStore()
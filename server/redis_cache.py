@@ -1,18 +1,40 @@
-from constants import REDIS_HOST, REDIS_PORT
+from constants import REDIS_HOST, REDIS_PORT, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT
+
+from typing import Optional
 
 import redis
+import redis.asyncio
 import json
 
 
 redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+# for the async handlers, never block the event loop on redis
+# a full pool makes the caller wait for a connection, instead of raising "Too many connections"
+async_redis_pool = redis.asyncio.BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=0,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+)
+async_redis_client = redis.asyncio.Redis(connection_pool=async_redis_pool)
+
+
+def auth_user_key(token: str, oauth_type: str = "google") -> str:
+    """token: the socket token of a session, see session_manage.session_token"""
+    return f"{oauth_type}:{token}"
 
 
-def set_auth_user(token: str, user: dict, oauth_type: str = "google"):
-    redis_client.set(f"{oauth_type}:{token[:20]}", json.dumps(user))
+async def set_auth_user(token: str, user: dict, ttl: Optional[int] = None, oauth_type: str = "google"):
+    await async_redis_client.set(auth_user_key(token, oauth_type), json.dumps(user), ex=ttl)
 
 
-def get_auth_user(token: str, oauth_type: str = "google"):
-    res = redis_client.get(f"{oauth_type}:{token[:20]}")
+async def get_auth_user(token: str, oauth_type: str = "google"):
+    res = await async_redis_client.get(auth_user_key(token, oauth_type))
     if res is not None:
         return json.loads(res)
     return None
+
+
+async def delete_auth_user(token: str, oauth_type: str = "google"):
+    await async_redis_client.delete(auth_user_key(token, oauth_type))
@@ -0,0 +1,476 @@
+"""
+Whole-document renders
+
+A render takes the reading session of a text entry, synthesizes every sentence,
+a few at a time and through the audio cache (clips synthesized before are reused),
+then stitches them into one mp3 with an index of where each sentence sits,
+in bytes and in seconds, so a player can highlight along offline.
+
+Each finished sentence goes to the render's parts directory straight away,
+a render stopped half way (crash, restart) picks up from there when it is submitted again.
+Progress lives in redis, any worker can report it,
+a lease keeps two workers from rendering the same text at once.
+
+    RENDER_DIR/<text>/<fingerprint>.parts/00012.mp3   finished sentences
+    RENDER_DIR/<text>/<fingerprint>.mp3               the stitched audio
+    RENDER_DIR/<text>/<fingerprint>.json              the sentence index
+
+<text> is a hash of the text_id, the fingerprint a hash of the voice and the sentences,
+a text planned into other sentences is rendered afresh.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from traceback import format_exc
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from redis.exceptions import RedisError
+
+from logger import logger
+from audio_cache import cached_to_speech
+from reading_session import ReadingSession
+from redis_cache import async_redis_client
+from rate_limit import rate_limiter
+from telemetry import TTSRequestWriter
+from metrics import THROTTLED, count_error, route_var
+from constants import (
+    DEFAULT_VOICE,
+    RENDER_DIR,
+    RENDER_WORKERS,
+    RENDER_QUEUE_SIZE,
+    RENDER_CONCURRENCY,
+    RENDER_PER_USER,
+    RENDER_STATE_TTL,
+    RENDER_LEASE_MS,
+)
+
+RENDER_QUEUED = "queued"
+RENDER_RUNNING = "running"
+RENDER_DONE = "done"
+RENDER_FAILED = "failed"
+# queued or running, but nobody holds the lease any more, the worker is gone: submit it again
+RENDER_INTERRUPTED = "interrupted"
+
+# tts_requests.status of a sentence synthesized for a render, "completed" is a speak event
+RENDER_REQUEST_STATUS = "rendered"
+
+# KEYS: the lease, ARGV: owner, lease ms
+_RENEW_LEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: the lease, ARGV: owner
+_RELEASE_LEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# ============== mp3 frames =================
+# MPEG audio layer III, by the version bits: 3 MPEG-1, 2 MPEG-2, 0 MPEG-2.5
+_MP3_BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    0: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+
+
+def _mp3_frame(data: bytes, pos: int) -> Optional[Tuple[int, float]]:
+    """Length in bytes and duration in seconds of the layer III frame at pos, None if no frame starts there"""
+    b1, b2 = data[pos + 1], data[pos + 2]
+    if data[pos] != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+    version, layer = (b1 >> 3) & 3, (b1 >> 1) & 3
+    bitrate_idx, rate_idx = b2 >> 4, (b2 >> 2) & 3
+    if version not in _MP3_BITRATES or layer != 1 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+    bitrate = _MP3_BITRATES[version][bitrate_idx] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_idx]
+    samples = 1152 if version == 3 else 576
+    padding = (b2 >> 1) & 1
+    return samples // 8 * bitrate // sample_rate + padding, samples / sample_rate
+
+
+def strip_id3(data: bytes) -> bytes:
+    """Drop a leading ID3v2 tag, it would end up in the middle of the stitched file"""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return data
+    size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | data[9] & 0x7F
+    footer = 10 if data[5] & 0x10 else 0
+    return data[10 + size + footer:]
+
+
+def mp3_duration(data: bytes) -> float:
+    """Seconds of layer III audio, summed over the frame headers"""
+    seconds, pos = 0.0, 0
+    while pos + 4 <= len(data):
+        frame = _mp3_frame(data, pos)
+        if frame is None:
+            # not a frame header, look for the next sync
+            pos += 1
+            continue
+        length, duration = frame
+        if pos + length > len(data):
+            # a frame cut short at the end of the clip, players drop it
+            break
+        seconds += duration
+        pos += length
+    return seconds
+
+
+# ============== files =================
+class RenderJob(NamedTuple):
+    text_id: str
+    user_sub: str
+    sentences: List[str]
+    # where the sentences sit in the stored text, for the tts_requests rows
+    text_hash: Optional[str]
+    spans: Optional[List[Tuple[int, int]]]
+    fingerprint: str
+
+
+def render_fingerprint(sentences: List[str], voice: str = DEFAULT_VOICE) -> str:
+    payload = "\x00".join([voice, *sentences]).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+
+def render_dir(text_id: str) -> str:
+    # text ids come from the client, they never make a path themselves
+    return os.path.join(RENDER_DIR, hashlib.sha256(text_id.encode("utf-8")).hexdigest()[:32])
+
+
+def render_path(text_id: str, fingerprint: str, suffix: str) -> str:
+    """The stitched audio (.mp3), the index (.json) or the parts directory (.parts)"""
+    return os.path.join(render_dir(text_id), f"{fingerprint}{suffix}")
+
+
+def part_path(parts: str, idx: int) -> str:
+    return os.path.join(parts, f"{idx:05d}.mp3")
+
+
+def finished_parts(parts: str) -> Set[int]:
+    try:
+        names = os.listdir(parts)
+    except FileNotFoundError:
+        return set()
+    # a tmp file is a part that was being written when the worker died
+    return {int(name[:-4]) for name in names if name.endswith(".mp3") and name[:-4].isdigit()}
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def stitch(job: RenderJob) -> dict:
+    """
+    Concatenate the parts into the render and write its index, then drop the parts
+    an mp3 is a stream of frames, the clips play back to back once their ID3 tags are off
+    """
+    parts = render_path(job.text_id, job.fingerprint, ".parts")
+    path = render_path(job.text_id, job.fingerprint, ".mp3")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    entries = []
+    offset, seconds = 0, 0.0
+    with open(tmp_path, "wb") as out:
+        for idx, sentence in enumerate(job.sentences):
+            with open(part_path(parts, idx), "rb") as f:
+                data = strip_id3(f.read())
+            out.write(data)
+            duration = mp3_duration(data)
+            entry = {
+                "play_idx": idx,
+                "text": sentence,
+                "byte_start": offset,
+                "byte_end": offset + len(data),
+                "time_start": round(seconds, 3),
+                "time_end": round(seconds + duration, 3),
+            }
+            if job.spans is not None:
+                entry["char_start"], entry["char_end"] = job.spans[idx]
+            entries.append(entry)
+            offset += len(data)
+            seconds += duration
+    index = {
+        "text_id": job.text_id,
+        "fingerprint": job.fingerprint,
+        "voice": DEFAULT_VOICE,
+        "bytes": offset,
+        "duration": round(seconds, 3),
+        "sentences": entries,
+    }
+    # the index first, an mp3 on disk always has its index
+    write_atomic(render_path(job.text_id, job.fingerprint, ".json"), json.dumps(index).encode("utf-8"))
+    os.replace(tmp_path, path)
+    shutil.rmtree(parts, ignore_errors=True)
+
+    # renders of an earlier plan of the same text
+    directory = render_dir(job.text_id)
+    for name in os.listdir(directory):
+        if name.startswith(job.fingerprint):
+            continue
+        stale = os.path.join(directory, name)
+        if os.path.isdir(stale):
+            shutil.rmtree(stale, ignore_errors=True)
+        else:
+            os.remove(stale)
+    return index
+
+
+# ============== jobs =================
+class RenderQueue:
+    def __init__(
+        self,
+        workers: int = RENDER_WORKERS,
+        queue_size: int = RENDER_QUEUE_SIZE,
+        concurrency: int = RENDER_CONCURRENCY,
+        per_user: int = RENDER_PER_USER,
+        lease_ms: int = RENDER_LEASE_MS,
+    ):
+        self.num_workers = workers
+        self.concurrency = concurrency
+        self.per_user = per_user
+        self.lease_ms = lease_ms
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # text_id => (user_sub, our lease), for the renders queued or running here
+        # the same lease id holds the text and one of the user's render slots
+        self.leases: Dict[str, Tuple[str, str]] = {}
+        self.workers: List[asyncio.Task] = []
+        # the renders are recorded in tts_requests like the speak events, set by start()
+        self.writer: Optional[TTSRequestWriter] = None
+        self._renew = async_redis_client.register_script(_RENEW_LEASE)
+        self._release = async_redis_client.register_script(_RELEASE_LEASE)
+
+    @staticmethod
+    def state_key(text_id: str) -> str:
+        return f"render:{text_id}"
+
+    @staticmethod
+    def lease_key(text_id: str) -> str:
+        return f"render:lease:{text_id}"
+
+    async def save_state(self, text_id: str, state: dict) -> None:
+        state["updated_at"] = time.time()
+        await async_redis_client.set(self.state_key(text_id), json.dumps(state), ex=RENDER_STATE_TTL)
+
+    async def get_state(self, text_id: str) -> Optional[dict]:
+        """
+        Progress of the render: status, total, done (sentences), fingerprint, error
+        """
+        res = await async_redis_client.get(self.state_key(text_id))
+        if res is None:
+            return None
+        state = json.loads(res)
+        if state["status"] in (RENDER_QUEUED, RENDER_RUNNING) and text_id not in self.leases:
+            if not await async_redis_client.exists(self.lease_key(text_id)):
+                state["status"] = RENDER_INTERRUPTED
+        return state
+
+    async def submit(self, session: ReadingSession) -> Optional[dict]:
+        """
+        Queue the render of the session's text, never waits
+        Returns the render state, the current one when it is rendered or being rendered already,
+        None when it is refused (queue full, or the user has too many renders pending, on any worker)
+        """
+        text_id, user_sub = session.text_id, session.user_sub
+        fingerprint = render_fingerprint(session.sentences)
+        state = await self.get_state(text_id)
+        if state is not None and state["status"] in (RENDER_QUEUED, RENDER_RUNNING):
+            return state
+        state = dict(
+            status=RENDER_DONE,
+            fingerprint=fingerprint,
+            user_sub=user_sub,
+            total=len(session.sentences),
+            done=len(session.sentences),
+            error=None,
+        )
+        if await asyncio.to_thread(os.path.exists, render_path(text_id, fingerprint, ".mp3")):
+            # rendered already, the state may have expired since
+            await self.save_state(text_id, state)
+            return state
+
+        if self.queue.full():
+            logger.info(f"[RENDER] refuse {text_id}, queue is full")
+            return None
+        lease = uuid.uuid4().hex
+        renders_key = rate_limiter.renders_key(user_sub)
+        if not await rate_limiter.acquire_lease(renders_key, self.per_user, self.lease_ms, lease):
+            logger.info(f"[RENDER] refuse {text_id}, {user_sub} has {self.per_user} renders pending")
+            return None
+        if not await async_redis_client.set(self.lease_key(text_id), lease, nx=True, px=self.lease_ms):
+            # another worker took it in the meantime
+            await rate_limiter.release_lease(renders_key, lease)
+            return await self.get_state(text_id)
+
+        parts = render_path(text_id, fingerprint, ".parts")
+        state.update(status=RENDER_QUEUED, done=len(await asyncio.to_thread(finished_parts, parts)))
+        await self.save_state(text_id, state)
+        self.queue.put_nowait(
+            RenderJob(text_id, user_sub, session.sentences, session.text_hash, session.spans, fingerprint)
+        )
+        self.leases[text_id] = (user_sub, lease)
+        return state
+
+    def record(
+        self,
+        job: RenderJob,
+        idx: int,
+        start_time: float,
+        status: str,
+        error_message: Optional[str] = None,
+        cache_status: Optional[str] = None,
+    ) -> None:
+        if self.writer is None:
+            return
+        sentence_text = job.sentences[idx]
+        text_ref = job.text_hash is not None and job.spans is not None
+        self.writer.record(
+            text_entry_id=job.text_id,
+            user_sub=job.user_sub,
+            sentence_text=None if text_ref else sentence_text,
+            text_hash=job.text_hash if text_ref else None,
+            char_start=job.spans[idx][0] if text_ref else None,
+            char_end=job.spans[idx][1] if text_ref else None,
+            sentence_index=idx,
+            audio_id=f"{job.text_id}-{idx:03d}",
+            character_count=len(sentence_text),
+            processing_time_ms=int((time.time() - start_time) * 1000),
+            status=status,
+            error_message=error_message,
+            cache_status=cache_status,
+        )
+
+    async def synthesize(self, job: RenderJob, idx: int) -> bytes:
+        """
+        One sentence of the render, charged to the user exactly like a speak event:
+        a synthesis slot, the request and character buckets, a tts_requests row.
+        Over a limit, the render waits it out instead of failing.
+        """
+        sentence_text = job.sentences[idx]
+        while True:
+            async with rate_limiter.synthesis_slot(job.user_sub) as decision:
+                if decision.allowed:
+                    decision = await rate_limiter.admit_speak(job.user_sub, len(sentence_text))
+                if decision.allowed:
+                    start_time = time.time()
+                    try:
+                        audio_bytes, cache_status = await cached_to_speech(sentence_text)
+                    except Exception as e:
+                        self.record(job, idx, start_time, "failed", error_message=repr(e))
+                        raise
+                    self.record(job, idx, start_time, RENDER_REQUEST_STATUS, cache_status=cache_status)
+                    return audio_bytes
+            THROTTLED.labels(route="render", reason=decision.reason).inc()
+            await asyncio.sleep(decision.retry_after_ms / 1000)
+
+    async def run_job(self, job: RenderJob) -> None:
+        route_var.set("render")
+        parts = render_path(job.text_id, job.fingerprint, ".parts")
+        finished = await asyncio.to_thread(finished_parts, parts)
+        todo = iter([idx for idx in range(len(job.sentences)) if idx not in finished])
+        state = dict(
+            status=RENDER_RUNNING,
+            fingerprint=job.fingerprint,
+            user_sub=job.user_sub,
+            total=len(job.sentences),
+            done=len(finished),
+            error=None,
+        )
+        await self.save_state(job.text_id, state)
+        logger.info(f"[RENDER] {job.text_id}: {len(finished)} / {len(job.sentences)} sentences from an earlier run")
+
+        async def work() -> None:
+            # the workers share the iterator, each sentence is taken once
+            for idx in todo:
+                audio_bytes = await self.synthesize(job, idx)
+                await asyncio.to_thread(write_atomic, part_path(parts, idx), audio_bytes)
+                state["done"] += 1
+                await self.save_state(job.text_id, state)
+
+        tasks = [asyncio.create_task(work()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            state.update(status=RENDER_FAILED, error=repr(e))
+            await self.save_state(job.text_id, state)
+            raise
+        finally:
+            # one sentence failed, or we are shutting down: the others stop too
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        index = await asyncio.to_thread(stitch, job)
+        state.update(status=RENDER_DONE)
+        await self.save_state(job.text_id, state)
+        logger.info(f"[RENDER] {job.text_id}: {index['duration']:.0f}s of audio, {index['bytes']} bytes")
+
+    async def _work(self) -> None:
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                count_error(e)
+                logger.error(f"[RENDER] {job.text_id} failed: {str(e)}")
+                logger.debug(f"[RENDER] Traceback: {format_exc()}")
+            finally:
+                held = self.leases.pop(job.text_id, None)
+                if held is not None:
+                    user_sub, lease = held
+                    await rate_limiter.release_lease(rate_limiter.renders_key(user_sub), lease)
+                    try:
+                        await self._release(keys=[self.lease_key(job.text_id)], args=[lease])
+                    except RedisError as e:
+                        # the lease runs out by itself
+                        logger.warning(f"[RENDER] failed to release the lease of {job.text_id}: {e}")
+                self.queue.task_done()
+
+    async def _heartbeat(self) -> None:
+        """Keep the leases of the renders queued or running here"""
+        while True:
+            await asyncio.sleep(self.lease_ms / 3000)
+            for text_id, (user_sub, lease) in list(self.leases.items()):
+                await rate_limiter.renew_lease(rate_limiter.renders_key(user_sub), self.lease_ms, lease)
+                try:
+                    renewed = await self._renew(keys=[self.lease_key(text_id)], args=[lease, self.lease_ms])
+                except RedisError as e:
+                    logger.warning(f"[RENDER] failed to renew the lease of {text_id}: {e}")
+                    continue
+                if not renewed:
+                    logger.warning(f"[RENDER] lost the lease of {text_id}")
+
+    def start(self, writer: TTSRequestWriter) -> None:
+        self.writer = writer
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._work()) for _ in range(self.num_workers)]
+            self.workers.append(asyncio.create_task(self._heartbeat()))
+
+    async def close(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+
+render_queue = RenderQueue()
@@ -0,0 +1,101 @@
+"""
+Sentence segmentation engine
+
+Only sentence boundaries are needed, so instead of the full `en_core_web_sm`
+pipeline (tok2vec, tagger, attribute_ruler, lemmatizer ...)
+we run a blank english tokenizer plus the rule based sentencizer.
+
+Segmentation runs in a process pool, off the event loop,
+and results are cached by the hash of the text,
+so opening the same entry again is instant.
+"""
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional
+
+import spacy
+
+from logger import logger
+from text_store import text_hash
+from constants import SEGMENTATION_WORKERS, SEGMENTATION_CACHE_SIZE
+
+
+class Sentence(NamedTuple):
+    text: str
+    # character offsets into the full text
+    start: int
+    end: int
+
+
+# one pipeline per pool process, built by the pool initializer
+_nlp = None
+
+
+def build_pipeline():
+    nlp = spacy.blank("en")
+    nlp.add_pipe("sentencizer")
+    return nlp
+
+
+def _init_worker() -> None:
+    global _nlp
+    _nlp = build_pipeline()
+
+
+def segment_sync(text: str) -> List[Sentence]:
+    """
+    Cut the text into sentences, drop the empty ones
+    """
+    global _nlp
+    if _nlp is None:
+        _nlp = build_pipeline()
+    sentences = []
+    for sentence in _nlp(text).sents:
+        if len(sentence.text.strip()) > 0:
+            sentences.append(Sentence(sentence.text, sentence.start_char, sentence.end_char))
+    return sentences
+
+
+class SegmentationEngine:
+    def __init__(
+        self,
+        workers: int = SEGMENTATION_WORKERS,
+        cache_size: int = SEGMENTATION_CACHE_SIZE,
+    ):
+        self.workers = workers
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, List[Sentence]]" = OrderedDict()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def start(self) -> None:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+            logger.info(f"[SEGMENT] process pool started, workers={self.workers}")
+
+    def close(self) -> None:
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool.shutdown(cancel_futures=True)
+            logger.info("[SEGMENT] process pool closed")
+
+    async def segment(self, text: str) -> List[Sentence]:
+        key = text_hash(text)
+        sentences = self._cache.get(key)
+        if sentences is not None:
+            self._cache.move_to_end(key)
+            return sentences
+
+        self.start()
+        loop = asyncio.get_running_loop()
+        sentences = await loop.run_in_executor(self._pool, segment_sync, text)
+
+        self._cache[key] = sentences
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return sentences
+
+
+segmentation_engine = SegmentationEngine()
+
@@ -2,6 +2,7 @@ from base64 import b64encode, b64decode
 import json
 import hmac
 import hashlib
+import time
 import functools
 from typing import Any, Dict, Optional, Callable
 from functools import wraps
@@ -11,7 +12,8 @@ from starlette.datastructures import Headers
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.responses import JSONResponse
 from logger import logger
-from redis_cache import set_auth_user, get_auth_user
+from auth_cache import auth_cache
+from constants import SESSION_MAX_AGE
 
 
 def serialize_json(data: Dict[str, Any]) -> str:
@@ -44,6 +46,14 @@ def load_session(token: Optional[str], secret_key: bytes) -> Dict:
         return {}
 
 
+def session_token(cookie: str) -> str:
+    """
+    What read.js opens the socket with, and what redis keeps the session under (auth_user_key)
+    a hash of the whole cookie: one per session, and the cookie cannot be rebuilt from it
+    """
+    return hashlib.sha256(cookie.encode("utf-8")).hexdigest()[:32]
+
+
 def create_signature(secret_key: bytes, data: str) -> bytes:
     """
     Create HMAC signature for data
@@ -61,13 +71,62 @@ def create_signature(secret_key: bytes, data: str) -> bytes:
     )
 
 
+class TrackedSession(dict):
+    """
+    Session dict that remembers whether it was changed
+    so the middleware only re-signs the cookie and writes redis when needed
+
+    Only top level writes are tracked, replace a nested value
+    (`session["user"] = {...}`) instead of mutating it in place.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.modified = False
+        # when the cookie was signed, None for cookies older than the field
+        self.issued_at: Optional[float] = None
+
+    def __setitem__(self, key, value):
+        self.modified = True
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.modified = True
+        super().__delitem__(key)
+
+    def clear(self):
+        self.modified = True
+        super().clear()
+
+    def pop(self, *args):
+        self.modified = True
+        return super().pop(*args)
+
+    def popitem(self):
+        self.modified = True
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.modified = True
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.modified = True
+        super().update(*args, **kwargs)
+
+
+# signing time, stored last in the cookie data, not part of the session itself
+ISSUED_AT = "_issued_at"
+
+
 class HTTPSSessionMiddleware(SessionMiddleware):
     def __init__(
         self,
         app,
         secret_key: str,
         session_cookie: str = "session",
-        max_age: int = 15 * 24 * 60 * 60,  # 15 days
+        max_age: int = SESSION_MAX_AGE,
     ):
         self.app = app
         self.secret_key = secret_key.encode("utf-8")
@@ -87,30 +146,49 @@ class HTTPSSessionMiddleware(SessionMiddleware):
 
         async def send_wrapper(message):
             if message["type"] == "http.response.start":
-                response = Response(status_code=message["status"], headers=Headers(raw=message["headers"]))
                 # Get potentially modified session from scope
-                self.save_session(scope["session"], response)
-                message["headers"] = response.raw_headers
+                session = scope["session"]
+                if not isinstance(session, TrackedSession) or session.modified or self._stale(session):
+                    response = Response(status_code=message["status"], headers=Headers(raw=message["headers"]))
+                    await self.save_session(session, response)
+                    message["headers"] = response.raw_headers
             await send(message)
 
         await self.app(scope, receive, send_wrapper)
 
-    def _load_session(self, request: Request) -> Dict:
+    def _load_session(self, request: Request) -> TrackedSession:
         """Load and verify session from cookie"""
         cookie = request.cookies.get(self.session_cookie)
-        return load_session(cookie, self.secret_key)
+        data = load_session(cookie, self.secret_key)
+        issued_at = data.pop(ISSUED_AT, None)
+        session = TrackedSession(data)
+        session.issued_at = issued_at
+        if cookie and not session:
+            # a broken or forged cookie, get rid of it
+            session.modified = True
+        return session
+
+    def _stale(self, session: TrackedSession) -> bool:
+        """
+        Half way through max_age, an unchanged session is signed again,
+        so the expiry keeps sliding while the user is active
+        """
+        if not session:
+            return False
+        return session.issued_at is None or time.time() - session.issued_at > self.max_age / 2
 
-    def save_session(self, session: Dict, response: Response) -> None:
+    async def save_session(self, session: Dict, response: Response) -> None:
         """Save session data to cookie"""
         if not session:
             response.delete_cookie(self.session_cookie)
             return
 
-        data_b64 = serialize_json(session)
+        data_b64 = serialize_json({**session, ISSUED_AT: int(time.time())})
         signature = create_signature(self.secret_key, data_b64)
         cookie_value = f"{data_b64}.{signature.decode()}"
-        logger.debug(f"set cookie: {cookie_value[:20]}")
-        set_auth_user(cookie_value, session)
+        token = session_token(cookie_value)
+        logger.debug(f"set cookie, token {token[:8]}")
+        await auth_cache.set(token, session, ttl=self.max_age)
 
         response.set_cookie(
             key=self.session_cookie,
@@ -145,11 +223,12 @@ class WebSocketAuthManager:
     #         samesite="lax",
     #     )
 
-    def verify_session_token(self, token: str, sub: str) -> Dict[str, Any]:
+    async def verify_session_token(self, token: str, sub: str) -> Dict[str, Any]:
         """
         Verify and decode a session token
+        warm tokens are answered from the in-process cache, no redis round trip
         """
-        user_data = get_auth_user(token)
+        user_data = await auth_cache.get(token)
         if not user_data:
             return {}
         if not user_data.get("user"):
@@ -180,7 +259,7 @@ class WebSocketAuthManager:
                 await self.auth_error_event(websocket)
                 return
 
-            user_data = self.verify_session_token(token, sub)
+            user_data = await self.verify_session_token(token, sub)
             if not user_data or len(user_data) == 0:
                 logger.error(f"Invalid session token: {token}")
                 await self.auth_error_event(websocket)
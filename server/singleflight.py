@@ -0,0 +1,193 @@
+"""
+Single-flight deduplication of identical syntheses
+
+Concurrent requests for the same audio key share one deepgram call.
+
+* in process, followers await the leader's future
+* across workers, the leader holds a redis lock for the key,
+  the other workers subscribe to the key's done channel and read the bytes
+  the leader leaves in redis for a short while
+
+A follower whose leader failed or vanished takes the lead itself on the next round.
+"""
+
+import asyncio
+import uuid
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Set, Tuple
+
+from redis.exceptions import RedisError
+
+from logger import logger
+from redis_cache import async_redis_client
+from constants import SINGLE_FLIGHT_LOCK_MS, SINGLE_FLIGHT_RESULT_TTL
+
+# delete the lock only if we still own it
+_RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class Flight(NamedTuple):
+    key: str
+    # None when redis was unreachable and the flight is in-process only
+    token: Optional[str]
+    future: asyncio.Future
+
+
+def _consume(future: asyncio.Future) -> None:
+    # nobody may be waiting, do not warn about an unretrieved exception
+    if not future.cancelled():
+        future.exception()
+
+
+class SingleFlight:
+    def __init__(
+        self,
+        lock_ms: int = SINGLE_FLIGHT_LOCK_MS,
+        result_ttl: int = SINGLE_FLIGHT_RESULT_TTL,
+    ):
+        self.lock_ms = lock_ms
+        self.result_ttl = result_ttl
+        # audio key => bytes of the flight in progress, None if it failed elsewhere
+        self._local: Dict[str, asyncio.Future] = {}
+        self._followers: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def lock_key(key: str) -> str:
+        return f"tts:lock:{key}"
+
+    @staticmethod
+    def result_key(key: str) -> str:
+        return f"tts:result:{key}"
+
+    @staticmethod
+    def done_channel(key: str) -> str:
+        return f"tts:done:{key}"
+
+    async def try_lead(self, key: str) -> Optional[Flight]:
+        """
+        Become the one producing key, or None if somebody (here or in another worker) already is,
+        then `wait` for their result
+        """
+        if key in self._local:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume)
+        # registered before the first await, the next local caller follows us
+        self._local[key] = future
+
+        token = uuid.uuid4().hex
+        try:
+            try:
+                acquired = await async_redis_client.set(self.lock_key(key), token, nx=True, px=self.lock_ms)
+            except RedisError as e:
+                logger.warning(f"[SINGLE FLIGHT] redis unavailable, in-process only: {e}")
+                acquired, token = True, None
+        except BaseException:
+            # cancelled (a seek drops the speak task) before we knew who leads,
+            # the local followers must not wait on this future forever
+            if self._local.get(key) is future:
+                del self._local[key]
+            if not future.done():
+                future.set_result(None)
+            raise
+        if acquired:
+            return Flight(key, token, future)
+
+        # another worker leads, one subscription serves all our local followers
+        follower = asyncio.create_task(self._follow_remote(key, future))
+        self._followers.add(follower)
+        follower.add_done_callback(self._followers.discard)
+        return None
+
+    async def wait(self, key: str) -> Optional[bytes]:
+        """Bytes of the flight in progress, None if its leader failed elsewhere or vanished"""
+        future = self._local.get(key)
+        if future is None:
+            return None
+        # shielded, one impatient follower must not cancel the flight for everybody
+        return await asyncio.shield(future)
+
+    async def finish(
+        self,
+        flight: Flight,
+        audio_bytes: Optional[bytes],
+        error: Optional[BaseException] = None,
+    ) -> None:
+        """Hand the result to every follower, release the lock"""
+        if self._local.get(flight.key) is flight.future:
+            del self._local[flight.key]
+        if not flight.future.done():
+            if error is None or not isinstance(error, Exception):
+                # a cancelled / closed leader: the followers take the lead themselves
+                flight.future.set_result(audio_bytes)
+            else:
+                flight.future.set_exception(error)
+
+        if flight.token is None:
+            return
+        try:
+            if audio_bytes is not None:
+                await async_redis_client.set(self.result_key(flight.key), audio_bytes, ex=self.result_ttl)
+            await async_redis_client.publish(self.done_channel(flight.key), "ok" if audio_bytes else "failed")
+            await async_redis_client.eval(_RELEASE_LOCK, 1, self.lock_key(flight.key), flight.token)
+        except RedisError as e:
+            logger.warning(f"[SINGLE FLIGHT] failed to publish {flight.key}: {e}")
+
+    async def _follow_remote(self, key: str, future: asyncio.Future) -> None:
+        audio_bytes = None
+        pubsub = async_redis_client.pubsub()
+        try:
+            await pubsub.subscribe(self.done_channel(key))
+            # the leader may have finished before we subscribed
+            audio_bytes = await async_redis_client.get(self.result_key(key))
+            if audio_bytes is None and await async_redis_client.exists(self.lock_key(key)):
+                async with asyncio.timeout(self.lock_ms / 1000):
+                    while True:
+                        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                        if message is not None:
+                            break
+                        if not await async_redis_client.exists(self.lock_key(key)):
+                            # the lock expired, the leader is gone
+                            break
+                audio_bytes = await async_redis_client.get(self.result_key(key))
+        except (RedisError, TimeoutError) as e:
+            logger.warning(f"[SINGLE FLIGHT] gave up following {key}: {e}")
+        finally:
+            if self._local.get(key) is future:
+                del self._local[key]
+            if not future.done():
+                future.set_result(audio_bytes)
+            await pubsub.aclose()
+
+    async def run(
+        self,
+        key: str,
+        produce: Callable[[], Awaitable[bytes]],
+    ) -> Tuple[bytes, bool]:
+        """
+        Produce the bytes for key once, however many callers ask at the same time
+        Returns the bytes and whether they came from somebody else's flight
+        """
+        for _ in range(2):
+            flight = await self.try_lead(key)
+            if flight is None:
+                audio_bytes = await self.wait(key)
+                if audio_bytes is not None:
+                    return audio_bytes, True
+                continue
+            try:
+                audio_bytes = await produce()
+            except BaseException as e:
+                await self.finish(flight, None, e)
+                raise
+            await self.finish(flight, audio_bytes)
+            return audio_bytes, False
+        # the leaders keep vanishing, stop waiting for them
+        return await produce(), False
+
+
+single_flight = SingleFlight()
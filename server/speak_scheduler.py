@@ -0,0 +1,155 @@
+import asyncio
+from traceback import format_exc
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from fastapi import WebSocket
+
+from logger import logger
+from metrics import WS_SEND_TIME, observe
+from constants import (
+    SPEAK_CONNECTION_CONCURRENCY,
+    SPEAK_WORKER_CONCURRENCY,
+    SPEAK_QUEUE_SIZE,
+    SPEAK_PREFETCH_WINDOW,
+)
+
+# bounds the in-flight syntheses of all the sockets on this worker
+worker_semaphore = asyncio.Semaphore(SPEAK_WORKER_CONCURRENCY)
+
+
+class SpeakConnection:
+    """
+    One `/speak` socket and the user behind it
+
+    Several speak events are handled at the same time on one socket,
+    sends go through a lock so the replies never interleave.
+    """
+
+    def __init__(self, websocket: WebSocket, user: dict):
+        self.websocket = websocket
+        self.user = user
+        self.send_lock = asyncio.Lock()
+        # raw audio frames instead of base64 in JSON, once the client says hello
+        self.binary = False
+
+    async def send_json(self, data: Dict[str, Any]) -> None:
+        with observe(WS_SEND_TIME, route="/speak", kind="json"):
+            async with self.send_lock:
+                await self.websocket.send_json(data)
+
+    async def send_bytes(self, data: bytes) -> None:
+        with observe(WS_SEND_TIME, route="/speak", kind="bytes"):
+            async with self.send_lock:
+                await self.websocket.send_bytes(data)
+
+
+class SpeakScheduler:
+    """
+    Per-connection priority scheduler for speak events
+
+    `read.js` fires its prefetch requests back to back,
+    up to `max_concurrency` of them are synthesized at once,
+    and each `audio_chunk` is sent as soon as its own synthesis finishes.
+
+    Whenever a slot frees up, the queued sentence closest to the current `play_idx`
+    goes first, the sentence being played always ranks above the prefetches.
+    A seek moves `play_idx`, queued or in-flight sentences outside the new
+    prefetch window are dropped / cancelled, so they stop taking deepgram calls.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Dict[str, Any]], Awaitable[None]],
+        max_concurrency: int = SPEAK_CONNECTION_CONCURRENCY,
+        queue_size: int = SPEAK_QUEUE_SIZE,
+        prefetch_window: int = SPEAK_PREFETCH_WINDOW,
+    ):
+        self.handler = handler
+        self.queue_size = queue_size
+        self.prefetch_window = prefetch_window
+        self.play_idx = 0
+
+        # play_idx => speak event data / synthesis task
+        self.pending: Dict[int, Dict[str, Any]] = {}
+        self.in_flight: Dict[int, asyncio.Task] = {}
+
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.wakeup = asyncio.Event()
+        self.dispatcher = asyncio.create_task(self._dispatch())
+
+    def priority(self, play_idx: int) -> Tuple[int, int]:
+        """Smaller goes first: the playing sentence, then the nearest prefetch"""
+        distance = play_idx - self.play_idx
+        return (0 if distance == 0 else 1 if distance > 0 else 2, abs(distance))
+
+    def in_window(self, play_idx: int) -> bool:
+        return self.play_idx <= play_idx < self.play_idx + self.prefetch_window
+
+    def submit(self, data: Dict[str, Any]) -> None:
+        play_idx = data.get("play_idx", 0)
+        current_idx = data.get("current_idx")
+        if current_idx is not None:
+            self.play_idx = current_idx
+
+        if play_idx in self.in_flight:
+            # a client side retry of a sentence we are synthesizing right now
+            return
+        self.pending[play_idx] = data
+
+        if len(self.pending) > self.queue_size:
+            # drop the least wanted one, the client will ask again if it still needs it
+            worst = max(self.pending, key=self.priority)
+            del self.pending[worst]
+            logger.debug(f"🔌 speak queue full, dropped {worst}")
+        self.wakeup.set()
+
+    def seek(self, play_idx: int) -> None:
+        """The reader jumped, drop everything outside the new prefetch window"""
+        self.play_idx = play_idx
+        self.cancel(idx for idx in list(self.pending) + list(self.in_flight) if not self.in_window(idx))
+
+    def cancel(self, play_idxs: Optional[Iterable[int]] = None) -> None:
+        """Abort the queued or in-flight syntheses, all of them if no play_idxs"""
+        if play_idxs is None:
+            play_idxs = list(self.pending) + list(self.in_flight)
+        for play_idx in list(play_idxs):
+            self.pending.pop(play_idx, None)
+            task = self.in_flight.get(play_idx)
+            if task is not None:
+                task.cancel()
+
+    async def _dispatch(self) -> None:
+        while True:
+            await self.slots.acquire()
+            while not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            play_idx = min(self.pending, key=self.priority)
+            data = self.pending.pop(play_idx)
+            task = asyncio.create_task(self._run(play_idx, data))
+            # a callback, not a `finally`, a task cancelled before it starts never runs its body
+            task.add_done_callback(lambda task, play_idx=play_idx: self._done(play_idx, task))
+            self.in_flight[play_idx] = task
+
+    async def _run(self, play_idx: int, data: Dict[str, Any]) -> None:
+        try:
+            async with worker_semaphore:
+                await self.handler(data)
+        except asyncio.CancelledError:
+            logger.debug(f"🔌 speak {play_idx} cancelled")
+            raise
+        except Exception as e:
+            # one failed sentence should not take down the whole socket
+            logger.error(f"🔌 speak event failed: {str(e)}")
+            logger.error(f"🔌 Traceback: {format_exc()}")
+
+    def _done(self, play_idx: int, task: asyncio.Task) -> None:
+        if self.in_flight.get(play_idx) is task:
+            del self.in_flight[play_idx]
+        self.slots.release()
+
+    async def close(self) -> None:
+        """Cancel the queued and in-flight events, the socket is gone"""
+        self.cancel()
+        self.dispatcher.cancel()
+        await asyncio.gather(self.dispatcher, *self.in_flight.values(), return_exceptions=True)
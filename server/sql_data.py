@@ -1,12 +1,24 @@
 from datetime import datetime
-from typing import Optional
+from typing import Any, Dict
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime, Index
+from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime, Index, LargeBinary, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
-from constants import SQL_DATABASE_URI
+from text_store import decompress_text
+from constants import (
+    SQL_DATABASE_URI,
+    SQL_ASYNC_DATABASE_URI,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING,
+    DB_STATEMENT_TIMEOUT_MS,
+)
 
 Base = declarative_base()
 
@@ -43,20 +55,53 @@ class User(Base, TimeMixin):
     usage_statistics = relationship("UsageStatistic", back_populates="user")
 
 
+class TextBlob(Base, TimeMixin):
+    """
+    A text stored once, compressed, keyed by the sha256 of its content
+    see text_store
+    """
+
+    __tablename__ = "text_blobs"
+
+    hash = Column(String(64), primary_key=True)
+    codec = Column(String(10), nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    char_length = Column(Integer, nullable=False)
+    # the start of the text, uncompressed, for the list views
+    preview = Column(Text)
+
+
+def blob_text(blob: TextBlob) -> str:
+    """The decompressed text, it takes a while on a long text: never on the event loop, go through a thread"""
+    return decompress_text(blob.codec, blob.data)
+
+
+def text_blob_insert(values: Dict[str, Any]):
+    """
+    INSERT of a blob, values from text_store.blob_values
+    a no-op when the same text is stored already
+    """
+    return pg_insert(TextBlob).values(**values).on_conflict_do_nothing(index_elements=[TextBlob.hash])
+
+
 class TextEntry(Base, TimeMixin):
     __tablename__ = "text_entries"
 
     text_id = Column(String(50), primary_key=True)
     user_sub = Column(String(255), ForeignKey("users.sub"), nullable=False)
-    full_text = Column(Text, nullable=False)
+    text_hash = Column(String(64), ForeignKey("text_blobs.hash"))
+    # only rows written before text_blobs, `migrate_text_blobs.py` moves them over
+    full_text = Column(Text)
     url = Column(String(2048))
 
     # Relationships
     user = relationship("User", back_populates="text_entries")
     tts_requests = relationship("TTSRequest", back_populates="text_entry")
+    # loaded only where the text is needed (get_text_entry), listings never pull the blobs
+    blob = relationship("TextBlob")
 
-    # Indexes
-    __table_args__ = (Index("idx_text_entries_user_sub", "user_sub"),)
+    # the listing pages through a user's entries by (created_at, text_id), newest first
+    __table_args__ = (Index("idx_text_entries_user_created", "user_sub", "created_at", "text_id"),)
 
 
 class TTSRequest(Base, TimeMixin, UserMixin):
@@ -65,7 +110,12 @@ class TTSRequest(Base, TimeMixin, UserMixin):
     id = Column(Integer, primary_key=True)
     text_entry_id = Column(String(50), ForeignKey("text_entries.text_id"), nullable=False)
     user_sub = Column(String(255), ForeignKey("users.sub"), nullable=False)
-    sentence_text = Column(Text, nullable=False)
+    # the sentence is blob_text(text_blobs[text_hash])[char_start:char_end],
+    # sentence_text only holds it when it is not part of a stored text (old clients)
+    sentence_text = Column(Text)
+    text_hash = Column(String(64), ForeignKey("text_blobs.hash"))
+    char_start = Column(Integer)
+    char_end = Column(Integer)
     sentence_index = Column(Integer, nullable=False)
     audio_id = Column(String(50), nullable=False)
     character_count = Column(Integer, nullable=False)
@@ -73,6 +123,9 @@ class TTSRequest(Base, TimeMixin, UserMixin):
     voice_model = Column(String(50), default="aura-asteria-en")
     status = Column(String(20), default="completed")
     error_message = Column(Text)
+    # "hit" when the audio came from the audio cache, "miss" when deepgram synthesized it,
+    # "coalesced" when it shared a concurrent identical synthesis
+    cache_status = Column(String(20))
 
     # Relationships
     user = relationship("User", back_populates="tts_requests", foreign_keys="TTSRequest.user_sub")
@@ -82,7 +135,8 @@ class TTSRequest(Base, TimeMixin, UserMixin):
 
     # Indexes
     __table_args__ = (
-        Index("idx_tts_requests_user_sub", "user_sub"),
+        # the per-user stats and listings scan a time range of one user
+        Index("idx_tts_requests_user_created", "user_sub", "created_at"),
         Index("idx_tts_requests_created_at", "created_at"),
         Index("idx_tts_requests_audio_id", "audio_id"),
     )
@@ -102,8 +156,29 @@ class UsageStatistic(Base, TimeMixin):
     # Relationships
     user = relationship("User", back_populates="usage_statistics")
 
-    # Indexes
-    __table_args__ = (Index("idx_usage_statistics_user_time", "user_sub", "year", "month"),)
+    # one rollup row per user and month, the usage upserts conflict on it
+    __table_args__ = (Index("uq_usage_statistics_user_month", "user_sub", "year", "month", unique=True),)
+
+
+# create_all does not touch existing tables,
+# columns added after a table was created are patched in here (idempotent)
+SCHEMA_UPGRADES = [
+    "ALTER TABLE tts_requests ADD COLUMN IF NOT EXISTS cache_status VARCHAR(20)",
+    "DROP INDEX IF EXISTS idx_usage_statistics_user_time",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_usage_statistics_user_month ON usage_statistics (user_sub, year, month)",
+    "CREATE INDEX IF NOT EXISTS idx_text_entries_user_created ON text_entries (user_sub, created_at, text_id)",
+    # a prefix of the one above
+    "DROP INDEX IF EXISTS idx_text_entries_user_sub",
+    "CREATE INDEX IF NOT EXISTS idx_tts_requests_user_created ON tts_requests (user_sub, created_at)",
+    "DROP INDEX IF EXISTS idx_tts_requests_user_sub",
+    # texts move to text_blobs, see migrate_text_blobs.py
+    "ALTER TABLE text_entries ADD COLUMN IF NOT EXISTS text_hash VARCHAR(64) REFERENCES text_blobs (hash)",
+    "ALTER TABLE text_entries ALTER COLUMN full_text DROP NOT NULL",
+    "ALTER TABLE tts_requests ADD COLUMN IF NOT EXISTS text_hash VARCHAR(64) REFERENCES text_blobs (hash)",
+    "ALTER TABLE tts_requests ADD COLUMN IF NOT EXISTS char_start INTEGER",
+    "ALTER TABLE tts_requests ADD COLUMN IF NOT EXISTS char_end INTEGER",
+    "ALTER TABLE tts_requests ALTER COLUMN sentence_text DROP NOT NULL",
+]
 
 
 def build_engine():
@@ -112,9 +187,28 @@ def build_engine():
     def init_db():
         """Initialize the database by creating all tables"""
         Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            for statement in SCHEMA_UPGRADES:
+                conn.execute(text(statement))
 
     def drop_db():
         """Drop all tables - use with caution!"""
         Base.metadata.drop_all(engine)
 
     return engine, init_db, drop_db
+
+
+def build_async_engine():
+    """
+    Engine for the async handlers (asyncpg driver)
+    a slow query only holds its own connection, the event loop keeps serving others
+    """
+    return create_async_engine(
+        SQL_ASYNC_DATABASE_URI,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args={"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}},
+    )
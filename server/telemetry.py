@@ -0,0 +1,179 @@
+"""
+Write-behind buffer for the `tts_requests` telemetry
+
+Speak events only drop a record into an in-memory queue,
+a background task flushes the queue with one multi-row INSERT
+when it has `flush_size` records, every `flush_interval` seconds, and at shutdown.
+Postgres commit latency never adds to the audio latency.
+"""
+
+import asyncio
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from logger import logger
+from async_crud_data import create_tts_requests
+from metrics import DB_WRITE_TIME, TELEMETRY_DROPPED, TELEMETRY_FLUSH_TIME, TELEMETRY_QUEUE_DEPTH, observe
+from constants import (
+    DEFAULT_VOICE,
+    TTS_REQUEST_FLUSH_SIZE,
+    TTS_REQUEST_FLUSH_INTERVAL,
+    TTS_REQUEST_QUEUE_SIZE,
+)
+
+
+class TTSRequestWriter:
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        flush_size: int = TTS_REQUEST_FLUSH_SIZE,
+        flush_interval: float = TTS_REQUEST_FLUSH_INTERVAL,
+        queue_size: int = TTS_REQUEST_QUEUE_SIZE,
+    ):
+        self.engine = engine
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+
+        # full, the oldest record makes room for the new one
+        self._buffer: Deque[Dict[str, Any]] = deque(maxlen=queue_size)
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Future] = None
+
+        # stats, for logs and metrics
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_flush_ms: Optional[float] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._buffer)
+
+    def record(
+        self,
+        text_entry_id: str,
+        user_sub: str,
+        sentence_text: Optional[str],
+        sentence_index: int,
+        audio_id: str,
+        character_count: int,
+        processing_time_ms: Optional[int] = None,
+        voice_model: str = DEFAULT_VOICE,
+        status: str = "completed",
+        error_message: Optional[str] = None,
+        cache_status: Optional[str] = None,
+        text_hash: Optional[str] = None,
+        char_start: Optional[int] = None,
+        char_end: Optional[int] = None,
+    ) -> None:
+        """
+        Queue one TTS request record, never blocks
+        same fields as crud_data.create_tts_request
+        """
+        if len(self._buffer) == self.queue_size:
+            # the database is far behind, telemetry is not worth holding the audio for
+            self.dropped += 1
+            TELEMETRY_DROPPED.inc()
+        self._buffer.append(
+            dict(
+                text_entry_id=text_entry_id,
+                user_sub=user_sub,
+                sentence_text=sentence_text,
+                sentence_index=sentence_index,
+                audio_id=audio_id,
+                character_count=character_count,
+                processing_time_ms=processing_time_ms,
+                voice_model=voice_model,
+                status=status,
+                error_message=error_message,
+                cache_status=cache_status,
+                text_hash=text_hash,
+                char_start=char_start,
+                char_end=char_end,
+                created_by=user_sub,
+                updated_by=user_sub,
+                # the row is written later, keep the time of the request
+                created_at=datetime.now(timezone.utc),
+            )
+        )
+        TELEMETRY_QUEUE_DEPTH.set(len(self._buffer))
+        if len(self._buffer) >= self.flush_size:
+            self._full.set()
+
+    async def flush(self) -> int:
+        """Write everything buffered so far"""
+        rows, self._buffer = list(self._buffer), deque(maxlen=self.queue_size)
+        self._full.clear()
+        TELEMETRY_QUEUE_DEPTH.set(0)
+        if not rows:
+            return 0
+
+        start_time = time.time()
+        flushed, failed = self.flushed, self.failed
+        try:
+            with observe(TELEMETRY_FLUSH_TIME):
+                await self._write(rows)
+        except Exception as e:
+            lost = len(rows) - (self.flushed - flushed) - (self.failed - failed)
+            self.failed += lost
+            logger.error(f"[TELEMETRY] failed to write {lost} tts requests: {str(e)}")
+            return self.flushed - flushed
+        self.last_flush_ms = (time.time() - start_time) * 1000
+        logger.debug(
+            f"[TELEMETRY] wrote {self.flushed - flushed} tts requests in {self.last_flush_ms:.1f}ms, "
+            f"queue depth {self.queue_depth}"
+        )
+        return self.flushed - flushed
+
+    async def _write(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        One INSERT for the rows, a batch a row of which breaks a constraint
+        is split in halves until that row is alone, the other rows are still written
+        """
+        try:
+            with observe(DB_WRITE_TIME, route="telemetry", table="tts_requests"):
+                await create_tts_requests(self.engine, rows)
+        except IntegrityError as e:
+            if len(rows) == 1:
+                self.failed += 1
+                logger.warning(f"[TELEMETRY] dropped the tts request {rows[0]['audio_id']}: {e.orig}")
+                return
+            middle = len(rows) // 2
+            await self._write(rows[:middle])
+            await self._write(rows[middle:])
+            return
+        self.flushed += len(rows)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            # shielded, a shutdown in the middle of a flush must not lose its rows
+            self._flushing = asyncio.ensure_future(self.flush())
+            await asyncio.shield(self._flushing)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the flush loop and write out whatever is left"""
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+        await self.flush()
+        logger.info(
+            f"[TELEMETRY] closed, flushed={self.flushed} dropped={self.dropped} failed={self.failed}"
+        )
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the server modules import each other by their bare names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# constants.py reads these at import, the tests never reach deepgram or google
+for _secret in ("READLY_DEEPGRAM_API_KEY", "GOOGLE_CLIENT_SECRET", "READLY_SECRET_KEY"):
+    os.environ.setdefault(_secret, "test")
@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+from fastapi import FastAPI, Request  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import audio_http  # noqa: E402
+from audio_cache import AudioCache, audio_key  # noqa: E402
+
+CLIP = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    cache = AudioCache(root=str(tmp_path), memory_bytes=0, disk_bytes=10 * len(CLIP))
+    cache.disk.put(audio_key("hello"), CLIP)
+    monkeypatch.setattr(audio_http, "audio_cache", cache)
+    app = FastAPI()
+
+    @app.api_route("/audio/{key}/{signature}", methods=["GET", "HEAD"])
+    async def get_audio(request: Request, key: str, signature: str):
+        return await audio_http.audio_response(request, key, signature)
+
+    return TestClient(app)
+
+
+def test_signed_url(client):
+    url = audio_http.audio_url(audio_key("hello"))
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == CLIP
+    assert "immutable" in response.headers["cache-control"]
+
+    assert client.get(url, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+    partial = client.get(url, headers={"Range": "bytes=10-19"})
+    assert partial.status_code == 206
+    assert partial.content == CLIP[10:20]
+    assert partial.headers["content-range"] == f"bytes 10-19/{len(CLIP)}"
+    assert client.get(url, headers={"Range": f"bytes={len(CLIP)}-"}).status_code == 416
+
+
+def test_guessed_key_tells_nothing(client):
+    # the clip exists, but a key hashed from a guessed sentence has no valid signature
+    cached = client.get(f"/audio/{audio_key('hello')}/{'0' * 32}")
+    missing = client.get(f"/audio/{audio_key('nobody said this')}/{'0' * 32}")
+    assert cached.status_code == missing.status_code == 404
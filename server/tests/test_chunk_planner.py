@@ -0,0 +1,58 @@
+import re
+
+import pytest
+
+pytest.importorskip("spacy")
+
+from chunk_planner import plan_units  # noqa: E402
+from segmentation import Sentence  # noqa: E402
+
+MIN_CHARS = 40
+MAX_CHARS = 100
+
+
+def sentences_of(text: str):
+    """A stand-in for the segmenter, a sentence ends after . ! or ?"""
+    return [Sentence(match.group(), match.start(), match.end()) for match in re.finditer(r"[^.!?]+[.!?]*", text)]
+
+
+def plan(text: str):
+    units = plan_units(text, sentences_of(text), min_chars=MIN_CHARS, max_chars=MAX_CHARS)
+    for unit in units:
+        assert unit.text == text[unit.start : unit.end]
+        assert unit.text == unit.text.strip()
+    return units
+
+
+def test_short_sentences_merge():
+    text = " ".join(f"Yes {idx}." for idx in range(30))
+    units = plan(text)
+    assert len(units) < 30
+    # up to the minimum, the last unit takes what is left
+    assert all(len(unit.text) >= MIN_CHARS for unit in units[:-1])
+    assert all(len(unit.text) <= MAX_CHARS for unit in units)
+    # every sentence is read, in order, exactly once
+    assert [idx for unit in units for idx in unit.sentences] == list(range(30))
+
+
+def test_long_sentence_splits():
+    clause = "the reader keeps going without a pause, "
+    text = "Then " + clause * 10 + "and it ends here."
+    units = plan(text)
+    assert len(units) > 1
+    assert all(len(unit.text) <= MAX_CHARS for unit in units)
+    # at the clause breaks
+    assert all(unit.text.endswith(",") for unit in units[:-1])
+    assert all(unit.sentences == (0,) for unit in units)
+    assert " ".join(unit.text for unit in units) == text
+
+
+def test_long_word_splits():
+    text = "x" * (2 * MAX_CHARS + 10) + "."
+    units = plan(text)
+    assert [len(unit.text) for unit in units] == [MAX_CHARS, MAX_CHARS, 11]
+
+
+@pytest.mark.parametrize("text", ["", "   ", "\n\n\t "])
+def test_empty_text(text):
+    assert plan(text) == []
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("redis")
+
+from redis.exceptions import ConnectionError  # noqa: E402
+
+import reading_session  # noqa: E402
+from reading_session import ReadingSessionStore  # noqa: E402
+
+
+class DownRedis:
+    """Every call fails, like a full pool past its timeout"""
+
+    async def get(self, *args, **kwargs):
+        raise ConnectionError("Too many connections")
+
+    async def set(self, *args, **kwargs):
+        raise ConnectionError("Too many connections")
+
+
+def test_redis_down(monkeypatch):
+    monkeypatch.setattr(reading_session, "async_redis_client", DownRedis())
+    store = ReadingSessionStore(memory_size=1)
+
+    async def main():
+        saved = await store.save("t1", "sub", ["One.", "Two."])
+        # kept in process
+        assert await store.get("t1") == saved
+        # evicted from the LRU, a miss instead of an error
+        await store.save("t2", "sub", ["Three."])
+        assert await store.get("t1") is None
+
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip("redis")
+
+from render import _mp3_frame, mp3_duration, strip_id3  # noqa: E402
+
+# MPEG-1 layer III, no CRC, 128 kbps, 44100 Hz
+MPEG1_128K = b"\xff\xfb\x90\x00"
+# MPEG-2 layer III, no CRC, 64 kbps, 22050 Hz
+MPEG2_64K = b"\xff\xf3\x80\x00"
+
+
+def frame(header: bytes, length: int, padding: bool = False) -> bytes:
+    if padding:
+        header = header[:2] + bytes([header[2] | 0x02]) + header[3:]
+    return header + b"\x00" * (length + padding - len(header))
+
+
+@pytest.mark.parametrize(
+    "header, length, duration",
+    [
+        # 1152 samples, 144 * 128000 / 44100 bytes
+        (MPEG1_128K, 417, 1152 / 44100),
+        # 576 samples, 72 * 64000 / 22050 bytes
+        (MPEG2_64K, 208, 576 / 22050),
+    ],
+)
+def test_frame(header, length, duration):
+    assert _mp3_frame(frame(header, length), 0) == (length, duration)
+    # the padding slot is one more byte, same duration
+    assert _mp3_frame(frame(header, length, padding=True), 0) == (length + 1, duration)
+
+
+def test_not_a_frame():
+    assert _mp3_frame(b"\x00\xfb\x90\x00", 0) is None
+    # layer II
+    assert _mp3_frame(b"\xff\xfd\x90\x00", 0) is None
+    # free format bitrate, reserved sample rate
+    assert _mp3_frame(b"\xff\xfb\x00\x00", 0) is None
+    assert _mp3_frame(b"\xff\xfb\x9c\x00", 0) is None
+
+
+def test_duration():
+    data = frame(MPEG1_128K, 417) + frame(MPEG1_128K, 417, padding=True) + frame(MPEG1_128K, 417)
+    assert mp3_duration(data) == pytest.approx(3 * 1152 / 44100)
+    # junk before the first frame is skipped
+    assert mp3_duration(b"\x00" * 7 + data) == pytest.approx(3 * 1152 / 44100)
+
+
+def test_truncated_trailing_frame():
+    data = frame(MPEG2_64K, 208) * 2 + frame(MPEG2_64K, 208)[:100]
+    assert mp3_duration(data) == pytest.approx(2 * 576 / 22050)
+
+
+def id3_tag(size: int, footer: bool = False) -> bytes:
+    # the size is syncsafe, 7 bits per byte, header and footer not included
+    syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    flags = 0x10 if footer else 0
+    tag = b"ID3\x04\x00" + bytes([flags]) + syncsafe + b"\x01" * size
+    if footer:
+        tag += b"3DI\x04\x00" + bytes([flags]) + syncsafe
+    return tag
+
+
+@pytest.mark.parametrize("footer", [False, True])
+def test_strip_id3(footer):
+    audio = frame(MPEG1_128K, 417)
+    assert strip_id3(id3_tag(200, footer) + audio) == audio
+
+
+def test_strip_id3_without_tag():
+    audio = frame(MPEG1_128K, 417)
+    assert strip_id3(audio) == audio
+    assert strip_id3(b"ID3") == b"ID3"
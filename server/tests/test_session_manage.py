@@ -0,0 +1,99 @@
+import asyncio
+import time
+from http.cookies import SimpleCookie
+
+import pytest
+
+pytest.importorskip("starlette")
+
+from starlette.requests import Request  # noqa: E402
+from starlette.responses import Response  # noqa: E402
+
+import redis_cache  # noqa: E402
+import session_manage  # noqa: E402
+from auth_cache import AuthCache  # noqa: E402
+from session_manage import (  # noqa: E402
+    ISSUED_AT,
+    HTTPSSessionMiddleware,
+    TrackedSession,
+    WebSocketAuthManager,
+    create_signature,
+    serialize_json,
+    session_token,
+)
+
+MAX_AGE = 100
+
+
+def cookie_request(middleware: HTTPSSessionMiddleware, data: dict) -> Request:
+    data_b64 = serialize_json(data)
+    cookie = f"{data_b64}.{create_signature(middleware.secret_key, data_b64).decode()}"
+    return Request({"type": "http", "headers": [(b"cookie", f"session={cookie}".encode())]})
+
+
+@pytest.mark.parametrize(
+    "age, stale",
+    [(10, False), (MAX_AGE / 2 + 1, True), (None, True)],
+)
+def test_sliding_expiry(age, stale):
+    middleware = HTTPSSessionMiddleware(None, secret_key="test", max_age=MAX_AGE)
+    data = {"user": {"sub": "sub"}}
+    if age is not None:
+        data[ISSUED_AT] = int(time.time() - age)
+    session = middleware._load_session(cookie_request(middleware, data))
+    # the signing time is not part of the session
+    assert dict(session) == {"user": {"sub": "sub"}}
+    assert not session.modified
+    assert middleware._stale(session) is stale
+
+
+class DictRedis:
+    """get / set / delete on a dict"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value.encode() if isinstance(value, str) else value
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+
+def login(middleware: HTTPSSessionMiddleware, sub: str) -> str:
+    """Sign the session of a fresh login, returns the token /my_profile hands to read.js"""
+    response = Response()
+    asyncio.run(middleware.save_session(TrackedSession({"user": {"sub": sub}}), response))
+    cookie = SimpleCookie(response.headers["set-cookie"])["session"].value
+    return session_token(cookie)
+
+
+def test_every_login_keeps_its_socket_auth(monkeypatch):
+    monkeypatch.setattr(redis_cache, "async_redis_client", DictRedis())
+    monkeypatch.setattr(session_manage, "auth_cache", AuthCache(pubsub=False))
+    middleware = HTTPSSessionMiddleware(None, secret_key="test", max_age=MAX_AGE)
+    sockets = WebSocketAuthManager("test")
+
+    alice = login(middleware, "alice")
+    bob = login(middleware, "bob")
+    assert alice != bob
+    assert asyncio.run(sockets.verify_session_token(alice, "alice"))["user"]["sub"] == "alice"
+    assert asyncio.run(sockets.verify_session_token(bob, "bob"))["user"]["sub"] == "bob"
+
+
+def test_logout_keeps_the_other_sessions(monkeypatch):
+    monkeypatch.setattr(redis_cache, "async_redis_client", DictRedis())
+    monkeypatch.setattr(session_manage, "auth_cache", AuthCache(pubsub=False))
+    middleware = HTTPSSessionMiddleware(None, secret_key="test", max_age=MAX_AGE)
+    sockets = WebSocketAuthManager("test")
+
+    alice = login(middleware, "alice")
+    bob = login(middleware, "bob")
+    # warm the in-process tier too, the logout must reach it
+    assert asyncio.run(sockets.verify_session_token(bob, "bob"))
+    asyncio.run(session_manage.auth_cache.invalidate(bob))
+    assert asyncio.run(sockets.verify_session_token(bob, "bob")) == {}
+    assert asyncio.run(sockets.verify_session_token(alice, "alice"))["user"]["sub"] == "alice"
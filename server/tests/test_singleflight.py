@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("redis")
+
+import singleflight  # noqa: E402
+from singleflight import SingleFlight  # noqa: E402
+
+
+class StuckRedis:
+    """SET NX never answers, the leader is stuck acquiring the lock"""
+
+    def __init__(self):
+        self.called = asyncio.Event()
+
+    async def set(self, *args, **kwargs):
+        self.called.set()
+        await asyncio.Event().wait()
+
+
+class FreeRedis:
+    """Every lock is free"""
+
+    async def set(self, *args, **kwargs):
+        return True
+
+    async def publish(self, *args, **kwargs):
+        return 0
+
+    async def eval(self, *args, **kwargs):
+        return 1
+
+
+def test_leader_cancelled_while_taking_the_lock(monkeypatch):
+    async def produce():
+        return b"audio"
+
+    async def main():
+        flights = SingleFlight()
+        stuck = StuckRedis()
+        monkeypatch.setattr(singleflight, "async_redis_client", stuck)
+        leader = asyncio.create_task(flights.run("k", produce))
+        await stuck.called.wait()
+        follower = asyncio.create_task(flights.run("k", produce))
+        await asyncio.sleep(0)
+
+        monkeypatch.setattr(singleflight, "async_redis_client", FreeRedis())
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # the follower takes the lead, nothing is left behind
+        assert await asyncio.wait_for(follower, 1) == (b"audio", False)
+        assert "k" not in flights._local
+        assert await asyncio.wait_for(flights.run("k", produce), 1) == (b"audio", False)
+
+    asyncio.run(main())
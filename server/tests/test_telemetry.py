@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy.exc import IntegrityError  # noqa: E402
+
+import telemetry  # noqa: E402
+from metrics import TELEMETRY_QUEUE_DEPTH  # noqa: E402
+from telemetry import TTSRequestWriter  # noqa: E402
+
+
+def test_bad_row_does_not_drop_the_batch(monkeypatch):
+    written = []
+
+    async def create_tts_requests(engine, rows):
+        if any(row["text_entry_id"] == "forged" for row in rows):
+            raise IntegrityError("INSERT", {}, Exception("tts_requests_text_entry_id_fkey"))
+        written.extend(rows)
+        return len(rows)
+
+    monkeypatch.setattr(telemetry, "create_tts_requests", create_tts_requests)
+
+    async def main():
+        writer = TTSRequestWriter(engine=None)
+        for idx in range(10):
+            text_id = "forged" if idx == 6 else "text"
+            writer.record(text_id, "sub", "a sentence", idx, f"{text_id}-{idx:03d}", 10)
+        assert await writer.flush() == 9
+        assert writer.failed == 1
+
+    asyncio.run(main())
+    assert sorted(row["sentence_index"] for row in written) == [0, 1, 2, 3, 4, 5, 7, 8, 9]
+
+
+def test_full_buffer_drops_the_oldest(monkeypatch):
+    written = []
+
+    async def create_tts_requests(engine, rows):
+        written.extend(rows)
+        return len(rows)
+
+    monkeypatch.setattr(telemetry, "create_tts_requests", create_tts_requests)
+
+    async def main():
+        writer = TTSRequestWriter(engine=None, queue_size=3)
+        for idx in range(5):
+            writer.record("text", "sub", "a sentence", idx, f"text-{idx:03d}", 10)
+        assert writer.queue_depth == 3
+        assert writer.dropped == 2
+        assert TELEMETRY_QUEUE_DEPTH._value.get() == 3
+        assert await writer.flush() == 3
+        assert TELEMETRY_QUEUE_DEPTH._value.get() == 0
+
+    asyncio.run(main())
+    assert [row["sentence_index"] for row in written] == [2, 3, 4]
@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("prometheus_client")
+
+from metrics import INFLIGHT_SYNTHESES, TTS_LATENCY, route_var  # noqa: E402
+from tts_provider import ResilientTTSProvider  # noqa: E402
+
+
+class SlowStreamClient:
+    async def stream_speech(self, text, voice):
+        for _ in range(3):
+            await asyncio.sleep(0.01)
+            yield b"chunk"
+
+
+def test_stream_latency_leaves_out_the_consumer():
+    route_var.set("test-stream")
+    histogram = TTS_LATENCY.labels(voice="v", route="test-stream", mode="stream")
+    gauge = INFLIGHT_SYNTHESES.labels(voice="v", route="test-stream")
+
+    async def main():
+        provider = ResilientTTSProvider(SlowStreamClient(), hedge=False)
+        chunks = []
+        async for chunk in provider.stream_speech("text", voice="v"):
+            chunks.append(chunk)
+            # a slow websocket send
+            assert gauge._value.get() == 0
+            await asyncio.sleep(0.2)
+        return chunks
+
+    assert asyncio.run(main()) == [b"chunk"] * 3
+    # three upstream reads of ~10ms, none of the 600ms spent in the consumer
+    assert histogram._sum.get() < 0.2
@@ -0,0 +1,62 @@
+"""
+Content addressed, compressed text storage
+
+A text is stored once in `text_blobs`, keyed by the sha256 of its utf-8 bytes,
+however many entries (users saving the same page, or one user saving it again) point to it.
+TTS request rows point into it with (hash, character offsets) instead of copying the sentence.
+
+zstd when `zstandard` is installed, gzip otherwise, the codec is stored with each blob,
+so blobs written either way stay readable.
+"""
+
+import gzip
+import hashlib
+from typing import Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_ZSTD = "zstd"
+CODEC_GZIP = "gzip"
+
+ZSTD_LEVEL = 9
+GZIP_LEVEL = 6
+
+# kept uncompressed on the blob, for the list views
+PREVIEW_CHARS = 200
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compress_text(text: str) -> Tuple[str, bytes]:
+    """Returns the codec and the compressed utf-8 bytes"""
+    data = text.encode("utf-8")
+    if zstandard is not None:
+        return CODEC_ZSTD, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return CODEC_GZIP, gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def decompress_text(codec: str, data: bytes) -> str:
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstd compressed text, install zstandard to read it")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    if codec == CODEC_GZIP:
+        return gzip.decompress(data).decode("utf-8")
+    raise ValueError(f"Unknown text codec: {codec}")
+
+
+def blob_values(text: str) -> dict:
+    """Column values of the TextBlob row for text"""
+    codec, data = compress_text(text)
+    return dict(
+        hash=text_hash(text),
+        codec=codec,
+        data=data,
+        char_length=len(text),
+        preview=text[:PREVIEW_CHARS],
+    )
@@ -8,29 +8,145 @@
 
 # The above is the example curl code for TTS on deepgram.
 
-from typing import Iterator
+from typing import AsyncIterator, Optional
 from logger import logger
 import httpx
 
-from constants import DEEPGRAM_API_KEY, SPEAK_URL
+from constants import (
+    DEEPGRAM_API_KEY,
+    SPEAK_URL,
+    DEFAULT_VOICE,
+    TTS_HTTP2,
+    TTS_MAX_CONNECTIONS,
+    TTS_MAX_KEEPALIVE_CONNECTIONS,
+    TTS_KEEPALIVE_EXPIRY,
+    TTS_CONNECT_TIMEOUT,
+    TTS_READ_TIMEOUT,
+    TTS_WRITE_TIMEOUT,
+    TTS_POOL_TIMEOUT,
+)
 
 
-def to_speech(
+class TTSClient:
+    """
+    Long-lived async client for the Deepgram speak API
+
+    One instance is shared by the whole worker, so every synthesis
+    reuses the pooled (HTTP/2, keep-alive) connections to deepgram
+    instead of paying a new TCP + TLS handshake per sentence.
+    """
+
+    def __init__(
+        self,
+        speak_url: str = SPEAK_URL,
+        api_key: str = DEEPGRAM_API_KEY,
+        http2: bool = TTS_HTTP2,
+        max_connections: int = TTS_MAX_CONNECTIONS,
+        max_keepalive_connections: int = TTS_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = TTS_KEEPALIVE_EXPIRY,
+        connect_timeout: float = TTS_CONNECT_TIMEOUT,
+        read_timeout: float = TTS_READ_TIMEOUT,
+        write_timeout: float = TTS_WRITE_TIMEOUT,
+        pool_timeout: float = TTS_POOL_TIMEOUT,
+    ):
+        self.speak_url = speak_url
+        self.api_key = api_key
+        self.http2 = http2
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(
+            connect=connect_timeout,
+            read=read_timeout,
+            write=write_timeout,
+            pool=pool_timeout,
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self) -> None:
+        """Open the connection pool, call once on app startup"""
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            http2=self.http2,
+            limits=self.limits,
+            timeout=self.timeout,
+            headers={
+                "Authorization": f"Token {self.api_key}",
+                "Content-Type": "application/json",
+            },
+        )
+        logger.info(f"[SPEAK] client started, http2={self.http2}, limits={self.limits}")
+
+    async def close(self) -> None:
+        """Drain and close the connection pool, call once on app shutdown"""
+        if self._client is None:
+            return
+        client, self._client = self._client, None
+        await client.aclose()
+        logger.info("[SPEAK] client closed")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("TTSClient is not started, call `await tts_client.start()` first")
+        return self._client
+
+    async def to_speech(
+        self,
+        text: str,
+        voice: str = DEFAULT_VOICE,
+    ) -> bytes:
+        logger.info(f"[SPEAK] @{voice}: {text}")
+
+        response = await self.client.post(
+            self.speak_url,
+            params={"model": voice},
+            json={"text": text},
+        )
+
+        response.raise_for_status()
+
+        return response.content
+
+    async def stream_speech(
+        self,
+        text: str,
+        voice: str = DEFAULT_VOICE,
+    ) -> AsyncIterator[bytes]:
+        """
+        Yield the audio as deepgram produces it,
+        instead of waiting for the whole response body
+        """
+        logger.info(f"[SPEAK:STREAM] @{voice}: {text}")
+
+        async with self.client.stream(
+            "POST",
+            self.speak_url,
+            params={"model": voice},
+            json={"text": text},
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                if chunk:
+                    yield chunk
+
+
+# shared by the whole worker, started / closed with the app lifecycle
+tts_client = TTSClient()
+
+
+async def to_speech(
     text: str,
-    voice: str = "aura-asteria-en",
+    voice: str = DEFAULT_VOICE,
 ) -> bytes:
-    url = f"{SPEAK_URL}?model={voice}"
-    logger.info(f"[SPEAK] @{voice}: {text}")
+    return await tts_client.to_speech(text, voice=voice)
 
-    response = httpx.post(
-        url,
-        headers={
-            "Authorization": f"Token {DEEPGRAM_API_KEY}",
-            "Content-Type": "application/json",
-        },
-        json={"text": text},
-    )
 
-    response.raise_for_status()
-
-    return response.content
+def stream_speech(
+    text: str,
+    voice: str = DEFAULT_VOICE,
+) -> AsyncIterator[bytes]:
+    return tts_client.stream_speech(text, voice=voice)
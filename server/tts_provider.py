@@ -0,0 +1,279 @@
+"""
+Resilient layer around the deepgram client
+
+* every attempt has its own deadline
+* transient errors (network, timeouts, 429, 5xx) are retried with jittered backoff
+* an attempt slower than the recent p95 latency gets a hedged duplicate, first one back wins
+* a circuit breaker fails fast while deepgram keeps failing, instead of piling up requests
+
+Point `READLY_SPEAK_URL` at a local stub server to exercise all of it offline.
+"""
+
+import asyncio
+import random
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from logger import logger
+from tts import TTSClient, tts_client
+from metrics import TTS_LATENCY, TTS_FIRST_BYTE, inflight, observe, route_var
+from constants import (
+    DEFAULT_VOICE,
+    TTS_ATTEMPT_TIMEOUT,
+    TTS_MAX_RETRIES,
+    TTS_RETRY_BACKOFF,
+    TTS_RETRY_BACKOFF_MAX,
+    TTS_HEDGE,
+    TTS_HEDGE_MIN_SAMPLES,
+    TTS_LATENCY_WINDOW,
+    TTS_BREAKER_FAILURES,
+    TTS_BREAKER_RESET,
+)
+
+
+class CircuitOpenError(Exception):
+    """Deepgram has been failing, requests are refused until the breaker resets"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"TTS provider unavailable, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def is_transient(error: BaseException) -> bool:
+    """Errors worth another attempt"""
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    closed: requests go through, consecutive failures are counted
+    open: after `failure_threshold` failures, requests fail fast for `reset_timeout` seconds
+    half open: then one trial request goes through, success closes, failure opens again
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = TTS_BREAKER_FAILURES,
+        reset_timeout: float = TTS_BREAKER_RESET,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def check(self) -> None:
+        state = self.state
+        if state == "open":
+            raise CircuitOpenError(self.reset_timeout - (time.monotonic() - self.opened_at))
+        if state == "half_open":
+            if self.trial_running:
+                raise CircuitOpenError(1.0)
+            self.trial_running = True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("[SPEAK] circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            logger.warning(f"[SPEAK] circuit open after {self.failures} failures")
+
+
+class LatencyTracker:
+    """Latencies of the recent successful attempts, for the hedging threshold"""
+
+    def __init__(self, window: int = TTS_LATENCY_WINDOW, min_samples: int = TTS_HEDGE_MIN_SAMPLES):
+        self.samples: deque = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class ResilientTTSProvider:
+    def __init__(
+        self,
+        client: TTSClient,
+        attempt_timeout: float = TTS_ATTEMPT_TIMEOUT,
+        max_retries: int = TTS_MAX_RETRIES,
+        backoff: float = TTS_RETRY_BACKOFF,
+        backoff_max: float = TTS_RETRY_BACKOFF_MAX,
+        hedge: bool = TTS_HEDGE,
+    ):
+        self.client = client
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyTracker()
+
+    async def _sleep_backoff(self, attempt: int) -> None:
+        # full jitter, retries from many sockets do not land at the same moment
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2**attempt))
+        await asyncio.sleep(delay)
+
+    async def _attempt(self, text: str, voice: str) -> bytes:
+        start_time = time.monotonic()
+        with inflight(voice), observe(TTS_LATENCY, voice=voice, route=route_var.get(), mode="full"):
+            audio_bytes = await asyncio.wait_for(
+                self.client.to_speech(text, voice=voice),
+                timeout=self.attempt_timeout,
+            )
+        self.latency.record(time.monotonic() - start_time)
+        return audio_bytes
+
+    async def _hedged_attempt(self, text: str, voice: str) -> bytes:
+        """
+        One attempt, plus a duplicate if it runs past the p95 latency
+        whichever succeeds first wins, the other one is cancelled
+        """
+        hedge_after = self.latency.p95() if self.hedge else None
+        tasks = {asyncio.create_task(self._attempt(text, voice))}
+        try:
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    logger.info(f"[SPEAK] hedging after {hedge_after * 1000:.0f}ms: {text[:30]}")
+                    tasks.add(asyncio.create_task(self._attempt(text, voice)))
+
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def to_speech(
+        self,
+        text: str,
+        voice: str = DEFAULT_VOICE,
+    ) -> bytes:
+        self.breaker.check()
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    audio_bytes = await self._hedged_attempt(text, voice)
+                except Exception as e:
+                    if not is_transient(e):
+                        # deepgram answered, it just did not like the request
+                        self.breaker.record_success()
+                        raise
+                    if attempt == self.max_retries:
+                        self.breaker.record_failure()
+                        raise
+                    logger.warning(f"[SPEAK] attempt {attempt + 1} failed, retrying: {repr(e)}")
+                    await self._sleep_backoff(attempt)
+                else:
+                    self.breaker.record_success()
+                    return audio_bytes
+        finally:
+            # a cancelled half-open trial must not keep the breaker shut
+            self.breaker.trial_running = False
+
+    async def stream_speech(
+        self,
+        text: str,
+        voice: str = DEFAULT_VOICE,
+    ) -> AsyncIterator[bytes]:
+        """
+        Streaming is retried only until the first chunk went out,
+        after that a failure is passed on to the caller
+        """
+        self.breaker.check()
+        try:
+            for attempt in range(self.max_retries + 1):
+                started = False
+                stream = self.client.stream_speech(text, voice=voice).__aiter__()
+                route = route_var.get()
+                # time spent waiting on deepgram, not on our consumer sending the chunks on
+                upstream = 0.0
+
+                async def next_chunk(timeout: Optional[float] = None) -> bytes:
+                    nonlocal upstream
+                    start_time = time.perf_counter()
+                    try:
+                        with inflight(voice):
+                            return await asyncio.wait_for(stream.__anext__(), timeout=timeout)
+                    finally:
+                        upstream += time.perf_counter() - start_time
+
+                try:
+                    # the deadline covers the wait for the first chunk
+                    with observe(TTS_FIRST_BYTE, voice=voice, route=route):
+                        chunk = await next_chunk(self.attempt_timeout)
+                    started = True
+                    yield chunk
+                    while True:
+                        yield await next_chunk()
+                except StopAsyncIteration:
+                    pass
+                except Exception as e:
+                    await stream.aclose()
+                    if not is_transient(e):
+                        self.breaker.record_success()
+                        raise
+                    if started or attempt == self.max_retries:
+                        self.breaker.record_failure()
+                        raise
+                    logger.warning(f"[SPEAK:STREAM] attempt {attempt + 1} failed, retrying: {repr(e)}")
+                    await self._sleep_backoff(attempt)
+                    continue
+                finally:
+                    TTS_LATENCY.labels(voice=voice, route=route, mode="stream").observe(upstream)
+                self.breaker.record_success()
+                return
+        finally:
+            self.breaker.trial_running = False
+
+
+tts_provider = ResilientTTSProvider(tts_client)
+
+
+async def to_speech(
+    text: str,
+    voice: str = DEFAULT_VOICE,
+) -> bytes:
+    return await tts_provider.to_speech(text, voice=voice)
+
+
+def stream_speech(
+    text: str,
+    voice: str = DEFAULT_VOICE,
+) -> AsyncIterator[bytes]:
+    return tts_provider.stream_speech(text, voice=voice)
@@ -0,0 +1,118 @@
+"""
+Monthly usage rollups, `usage_statistics`
+
+Every batch of tts_requests rows adds its counts to the (user_sub, year, month) rollup
+in the same transaction, with an upsert, so concurrent workers never lose an increment.
+Usage queries then read a row per month instead of scanning tts_requests.
+
+Rebuild the rollups from the tts_requests history with
+    python usage.py --backfill [--user SUB]
+"""
+
+import argparse
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
+
+from sql_data import UsageStatistic
+
+
+def usage_deltas(rows: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Sum tts_requests rows per user and month
+    sorted by key, concurrent upserts then lock the rollup rows in the same order
+    """
+    totals: Dict[Tuple[str, int, int], List[int]] = defaultdict(lambda: [0, 0, 0])
+    for row in rows:
+        created_at = row.get("created_at") or datetime.now(timezone.utc)
+        created_at = created_at.astimezone(timezone.utc)
+        total = totals[(row["user_sub"], created_at.year, created_at.month)]
+        total[0] += 1
+        total[1] += row.get("character_count") or 0
+        total[2] += row.get("processing_time_ms") or 0
+    return [
+        dict(
+            user_sub=user_sub,
+            year=year,
+            month=month,
+            total_requests=requests,
+            total_characters=characters,
+            total_processing_time_ms=processing_time_ms,
+        )
+        for (user_sub, year, month), (requests, characters, processing_time_ms) in sorted(totals.items())
+    ]
+
+
+def usage_upsert(deltas: List[Dict[str, Any]]):
+    """INSERT ... ON CONFLICT DO UPDATE adding the deltas to the rollups"""
+    statement = insert(UsageStatistic).values(deltas)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[UsageStatistic.user_sub, UsageStatistic.year, UsageStatistic.month],
+        set_={
+            "total_requests": UsageStatistic.total_requests + excluded.total_requests,
+            "total_characters": UsageStatistic.total_characters + excluded.total_characters,
+            "total_processing_time_ms": UsageStatistic.total_processing_time_ms + excluded.total_processing_time_ms,
+            "updated_at": func.now(),
+        },
+    )
+
+
+_BACKFILL_LOCK = "LOCK TABLE usage_statistics IN SHARE ROW EXCLUSIVE MODE"
+
+_BACKFILL_DELETE = "DELETE FROM usage_statistics {where}"
+
+_BACKFILL_INSERT = """
+INSERT INTO usage_statistics
+    (user_sub, year, month, total_requests, total_characters, total_processing_time_ms)
+SELECT
+    user_sub,
+    EXTRACT(YEAR FROM created_at AT TIME ZONE 'UTC')::int,
+    EXTRACT(MONTH FROM created_at AT TIME ZONE 'UTC')::int,
+    COUNT(*),
+    COALESCE(SUM(character_count), 0),
+    COALESCE(SUM(processing_time_ms), 0)
+FROM tts_requests
+{where}
+GROUP BY 1, 2, 3
+"""
+
+
+def backfill(engine, user_sub: Optional[str] = None) -> int:
+    """
+    Rebuild the rollups from tts_requests, for one user or everybody
+    The table lock holds off the live upserts until the rebuild commits,
+    their batches are then added on top, nothing is counted twice or lost.
+    """
+    where = "WHERE user_sub = :user_sub" if user_sub else ""
+    params = {"user_sub": user_sub} if user_sub else {}
+    with engine.begin() as conn:
+        conn.execute(text(_BACKFILL_LOCK))
+        conn.execute(text(_BACKFILL_DELETE.format(where=where)), params)
+        result = conn.execute(text(_BACKFILL_INSERT.format(where=where)), params)
+        return result.rowcount
+
+
+def main() -> None:
+    from sql_data import build_engine
+
+    parser = argparse.ArgumentParser(description="Monthly usage rollups")
+    parser.add_argument("--backfill", action="store_true", help="rebuild usage_statistics from tts_requests")
+    parser.add_argument("--user", default=None, help="only this user_sub")
+    args = parser.parse_args()
+    if not args.backfill:
+        parser.print_help()
+        return
+
+    engine, init_db, _ = build_engine()
+    # the unique index the upserts rely on
+    init_db()
+    months = backfill(engine, args.user)
+    print(f"rebuilt {months} monthly rollups")
+
+
+if __name__ == "__main__":
+    main()